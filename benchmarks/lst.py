@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+"""Timing benchmarks for `mskpy.observing.jd2lst`.
+
+Usage: python benchmarks/lst.py [--number N]
+
+"""
+
+from __future__ import print_function
+import argparse
+import timeit
+
+import numpy as np
+from mskpy.observing import jd2lst
+
+sizes = [10**3, 10**4, 10**5, 10**6]
+timezones = [-7.0, 'US/Arizona', 'Europe/London']
+
+parser = argparse.ArgumentParser(description='Benchmark observing.jd2lst.')
+parser.add_argument('--number', type=int, default=5,
+                    help='Number of calls per timing.')
+args = parser.parse_args()
+
+print('{:>8} {:>14} {:>12}'.format('size', 'tz', 'time (ms)'))
+for n in sizes:
+    jd = 2458923.5 + np.random.rand(n) * 30
+    for tz in timezones:
+        jd2lst(jd, -110.79, tz)  # fill the timezone cache
+        t = timeit.Timer(lambda: jd2lst(jd, -110.79, tz))
+        t1 = min(t.repeat(3, args.number)) / args.number
+        print('{:8d} {:>14} {:12.3f}'.format(n, str(tz), t1 * 1e3))
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+"""Timing benchmarks for `mskpy.image.rebin`.
+
+Usage: python benchmarks/rebin.py [--number N]
+
+"""
+
+from __future__ import print_function
+import argparse
+import timeit
+
+import numpy as np
+from mskpy.image import rebin
+
+sizes = [256, 512, 1024, 2048]
+factors = [-8, -4, -2, 2, 4, 8]
+
+parser = argparse.ArgumentParser(description='Benchmark image.rebin.')
+parser.add_argument('--number', type=int, default=5,
+                    help='Number of calls per timing.')
+args = parser.parse_args()
+
+print('{:>6} {:>6} {:>6} {:>12} {:>12}'.format(
+    'size', 'factor', 'flux', 'time (ms)', 'out= (ms)'))
+for n in sizes:
+    a = np.random.rand(n, n)
+    for factor in factors:
+        if factor > 0 and n * factor > 4096:
+            continue
+
+        for flux in [False, True]:
+            b = rebin(a, factor, flux=flux)
+            t = timeit.Timer(lambda: rebin(a, factor, flux=flux))
+            t1 = min(t.repeat(3, args.number)) / args.number
+
+            out = np.empty_like(b)
+            t = timeit.Timer(lambda: rebin(a, factor, flux=flux, out=out))
+            t2 = min(t.repeat(3, args.number)) / args.number
+
+            print('{:6d} {:6d} {:>6} {:12.3f} {:12.3f}'.format(
+                n, factor, str(flux), t1 * 1e3, t2 * 1e3))
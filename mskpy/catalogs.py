@@ -7,37 +7,451 @@ catalogs - Tools for working with lists of stars
 .. autosummary::
    :toctree: generated/
 
+   CatalogStore
+   SourceCatalog
+   apply_transform
    brightest
    faintest
    find_offset
    project_catalog
    nearest_match
+   pattern_match
+   sky_match
+   solve_transform
    triangles
    triangle_match
 
 """
 
 __all__ = [
+    'CatalogStore',
+    'SourceCatalog',
+    'apply_transform',
     'brightest',
     'faintest',
     'find_offset',
     'project_catalog',
     'nearest_match',
+    'pattern_match',
+    'sky_match',
+    'solve_transform',
     'triangles',
     'triangle_match',
 ]
 
 import numpy as np
 
+try:
+    _string_types = basestring
+except NameError:
+    _string_types = str
+
+class CatalogStore(object):
+    """A reference catalog on disk, indexed by declination zones.
+
+    Sources are partitioned into zones of constant declination height,
+    and sorted by zone then RA.  Each column is stored in its own
+    `.npy` file and memory-mapped, so that queries only read the
+    parts of the catalog they need.
+
+    Create a store with `CatalogStore.create`.
+
+    Parameters
+    ----------
+    path : string
+      The directory of the catalog store.
+
+    Attributes
+    ----------
+    path : string
+      The directory of the catalog store.
+    columns : list
+      The names of the columns, including 'ra' and 'dec'.
+    zone_height : float
+      The height of each zone.  [deg]
+
+    Methods
+    -------
+    box - Sources in a RA, Dec box.
+    cone - Sources within a radius of a point.
+    create - Create a new catalog store.
+
+    """
+
+    def __init__(self, path):
+        import os
+        import json
+
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as inf:
+            meta = json.load(inf)
+
+        self.columns = [str(c) for c in meta['columns']]
+        self.zone_height = meta['zone_height']
+        self._zones = np.load(os.path.join(path, 'zones.npy'))
+        self._data = dict()
+        for c in self.columns:
+            self._data[c] = np.load(os.path.join(path, c + '.npy'),
+                                    mmap_mode='r')
+
+    def __len__(self):
+        return len(self._data['ra'])
+
+    @classmethod
+    def create(cls, path, ra, dec, zone_height=0.5, overwrite=False,
+               **columns):
+        """Create a new catalog store.
+
+        Parameters
+        ----------
+        path : string
+          The directory in which to save the catalog.
+        ra, dec : array, Quantity, or Angle
+          The source coordinates.  [deg]
+        zone_height : float, optional
+          The height of each declination zone.  [deg]
+        overwrite : bool, optional
+          Set to `True` to overwrite an existing catalog.
+        **columns
+          Any other columns to save, e.g., `mag=array`.
+
+        Returns
+        -------
+        store : CatalogStore
+
+        """
+
+        import os
+        import json
+
+        meta_file = os.path.join(path, 'meta.json')
+        if os.path.exists(meta_file) and not overwrite:
+            raise IOError("{} exists.".format(path))
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        ra = _degrees(ra) % 360
+        dec = _degrees(dec)
+        nzones = int(np.ceil(180.0 / zone_height))
+        zone = _zone(dec, zone_height, nzones)
+        i = np.lexsort((ra, zone))
+
+        counts = np.bincount(zone, minlength=nzones)
+        np.save(os.path.join(path, 'zones.npy'), np.r_[0, np.cumsum(counts)])
+
+        data = dict(ra=ra, dec=dec)
+        for k, v in columns.items():
+            data[k] = np.asarray(v)
+            assert len(data[k]) == len(ra), \
+                "Column {} has the wrong length.".format(k)
+
+        names = ['ra', 'dec'] + sorted(columns.keys())
+        for k in names:
+            np.save(os.path.join(path, k + '.npy'), data[k][i])
+
+        with open(meta_file, 'w') as outf:
+            json.dump(dict(columns=names, zone_height=zone_height), outf)
+
+        return cls(path)
+
+    def box(self, ra, dec, columns=None):
+        """Sources in a RA, Dec box.
+
+        Parameters
+        ----------
+        ra : array, Quantity, or Angle
+          The RA limits.  If `ra[0] > ra[1]`, the box wraps through RA
+          = 0.  [deg]
+        dec : array, Quantity, or Angle
+          The Dec limits.  [deg]
+        columns : list, optional
+          The columns to return, or `None` for all.
+
+        Returns
+        -------
+        coords : astropy SkyCoord
+          The source coordinates, suitable for `project_catalog` and
+          `image.apphot_by_wcs`.
+        data : dict
+          The requested columns, and 'row', the index of each source
+          in the store.
+
+        """
+
+        ra = _degrees(ra) % 360
+        dec = _degrees(dec)
+        rows = self._rows(min(dec), max(dec), ra[0], ra[1])
+        d = self._take(rows, ['dec'])['dec']
+        rows = rows[(d >= min(dec)) * (d <= max(dec))]
+        return self._result(rows, columns)
+
+    def cone(self, ra, dec, radius, columns=None):
+        """Sources within a radius of a point.
+
+        Parameters
+        ----------
+        ra, dec : float, Quantity, or Angle
+          The center of the cone.  [deg]
+        radius : float, Quantity, or Angle
+          The radius of the cone.  [deg]
+        columns : list, optional
+          The columns to return, or `None` for all.
+
+        Returns
+        -------
+        coords : astropy SkyCoord
+          The source coordinates, suitable for `project_catalog` and
+          `image.apphot_by_wcs`.
+        data : dict
+          The requested columns, and 'row', the index of each source
+          in the store.
+
+        """
+
+        ra = float(_degrees(ra)) % 360
+        dec = float(_degrees(dec))
+        radius = float(_degrees(radius))
+
+        dec0 = max(dec - radius, -90.0)
+        dec1 = min(dec + radius, 90.0)
+        if dec1 >= 90 or dec0 <= -90:
+            rows = self._rows(dec0, dec1, 0, 360)
+        else:
+            # maximum RA extent of a small circle
+            x = np.sin(np.radians(radius)) / np.cos(np.radians(dec))
+            if x >= 1:
+                rows = self._rows(dec0, dec1, 0, 360)
+            else:
+                dra = np.degrees(np.arcsin(x))
+                rows = self._rows(dec0, dec1, (ra - dra) % 360,
+                                  (ra + dra) % 360)
+
+        c = self._take(rows, ['ra', 'dec'])
+        cosd = (np.sin(np.radians(dec)) * np.sin(np.radians(c['dec']))
+                + np.cos(np.radians(dec)) * np.cos(np.radians(c['dec']))
+                * np.cos(np.radians(c['ra'] - ra)))
+        rows = rows[cosd >= np.cos(np.radians(radius))]
+        return self._result(rows, columns)
+
+    def _rows(self, dec0, dec1, ra0, ra1):
+        """Row indices of sources in zones and RA ranges.
+
+        If `ra0 > ra1`, the range wraps through 0.
+
+        """
+
+        nzones = len(self._zones) - 1
+        z0, z1 = _zone(np.array([dec0, dec1]), self.zone_height, nzones)
+        if ra0 <= ra1:
+            ranges = [(ra0, ra1)]
+        else:
+            ranges = [(ra0, 360.0), (0.0, ra1)]
+
+        rows = []
+        for z in range(z0, z1 + 1):
+            start, stop = self._zones[z], self._zones[z + 1]
+            if start == stop:
+                continue
+            ra = self._data['ra'][start:stop]
+            for a, b in ranges:
+                i = np.searchsorted(ra, a, side='left')
+                j = np.searchsorted(ra, b, side='right')
+                rows.append(np.arange(start + i, start + j))
+
+        if len(rows) == 0:
+            return np.zeros(0, int)
+        return np.concatenate(rows)
+
+    def _take(self, rows, columns):
+        """Read columns for an array of rows."""
+        return dict([(c, np.asarray(self._data[c][rows])) for c in columns])
+
+    def _result(self, rows, columns):
+        """Query results for an array of rows."""
+        from astropy.coordinates import SkyCoord
+        import astropy.units as u
+
+        columns = self.columns if columns is None else columns
+        data = self._take(rows, set(list(columns) + ['ra', 'dec']))
+        coords = SkyCoord(ra=data['ra'] * u.deg, dec=data['dec'] * u.deg)
+        data = dict([(c, data[c]) for c in columns])
+        data['row'] = rows
+        return coords, data
+
+class SourceCatalog(object):
+    """A columnar catalog of sources in an image.
+
+    Columns are named arrays of equal length, e.g., `y`, `x`, `flux`,
+    and `flags`, or `ra` and `dec` for sky coordinates.  Columns are
+    not copied on creation or access.  The 2xN position array and a KD-tree of the
+    positions are cached, and the cache is cleared when `y` or `x` is
+    replaced through item assignment.  Changes made through other
+    views of the data are not detected; use `clear_cache` after such
+    changes.
+
+    Catalogs with `y` and `x` may be passed to functions that expect
+    2xN position arrays, e.g., `nearest_match`, `triangle_match`, and
+    `pattern_match`.  Catalogs with `ra` and `dec` (e.g., from
+    `CatalogStore` queries: `SourceCatalog(**data)`) may be passed to
+    `image.apphot_by_wcs`.
+
+    Parameters
+    ----------
+    y, x : array, optional
+      The source positions.
+    **columns
+      Any other columns, e.g., `flux=array`.
+
+    Attributes
+    ----------
+    columns : list
+      The column names.
+    yx : ndarray
+      2xN array of (y, x) positions.
+    tree : scipy.spatial.cKDTree
+      KD-tree of the positions.
+
+    Methods
+    -------
+    brightest - The brightest sources.
+    clear_cache - Remove the cached positions and KD-tree.
+    faintest - The faintest sources.
+    from_array - Create a catalog from a 2xN position array.
+    from_records - Create a catalog from a structured array.
+
+    """
+
+    def __init__(self, y=None, x=None, **columns):
+        self._columns = dict()
+        self._names = []
+        self._cache = dict()
+        if y is not None:
+            self['y'] = y
+        if x is not None:
+            self['x'] = x
+        for k in sorted(columns.keys()):
+            self[k] = columns[k]
+
+    @classmethod
+    def from_array(cls, yx, **columns):
+        """Create a catalog from a 2xN position array.
+
+        `y` and `x` will be views of `yx`.
+
+        """
+        yx = np.asarray(yx)
+        assert len(yx) == 2, "yx must be a 2xN array."
+        cat = cls(yx[0], yx[1], **columns)
+        cat._cache['yx'] = yx
+        return cat
+
+    @classmethod
+    def from_records(cls, rec):
+        """Create a catalog from a structured array, e.g., from `detect`.
+
+        The columns will be views of `rec`.
+
+        """
+        cat = cls()
+        for k in rec.dtype.names:
+            cat[k] = rec[k]
+        return cat
+
+    @property
+    def columns(self):
+        return list(self._names)
+
+    @property
+    def yx(self):
+        if 'yx' not in self._cache:
+            self._cache['yx'] = np.vstack((self['y'], self['x']))
+        return self._cache['yx']
+
+    @property
+    def tree(self):
+        from scipy.spatial import cKDTree
+        if 'tree' not in self._cache:
+            self._cache['tree'] = cKDTree(self.yx.T)
+        return self._cache['tree']
+
+    def __array__(self, dtype=None):
+        return np.asarray(self.yx, dtype=dtype)
+
+    def __contains__(self, name):
+        return name in self._columns
+
+    def __len__(self):
+        if len(self._names) == 0:
+            return 0
+        return len(self._columns[self._names[0]])
+
+    def __getitem__(self, k):
+        if isinstance(k, _string_types):
+            return self._columns[k]
+        cat = SourceCatalog()
+        for c in self._names:
+            cat[c] = self._columns[c][k]
+        return cat
+
+    def __setitem__(self, name, value):
+        value = np.asarray(value)
+        if len(self._names) > 0:
+            assert len(value) == len(self), \
+                "Column {} has the wrong length.".format(name)
+        if name not in self._columns:
+            self._names.append(name)
+        self._columns[name] = value
+        if name in ['y', 'x']:
+            self.clear_cache()
+
+    def __repr__(self):
+        return '<SourceCatalog: {} sources, columns: {}>'.format(
+            len(self), ', '.join(self._names))
+
+    def brightest(self, n, column='flux'):
+        """The `n` brightest sources, sorted by `column`."""
+        return self[_top(self[column], n, largest=True)]
+
+    def clear_cache(self):
+        """Remove the cached positions and KD-tree."""
+        self._cache = dict()
+
+    def faintest(self, n, column='flux'):
+        """The `n` faintest sources, sorted by `column`."""
+        return self[_top(self[column], n, largest=False)]
+
+def apply_transform(cat, T):
+    """Transform a catalog.
+
+    Parameters
+    ----------
+    cat : array
+      2xN array of (y, x) positions.
+    T : array
+      3x3 homogeneous transformation matrix, e.g., from
+      `solve_transform`.
+
+    Returns
+    -------
+    tcat : ndarray
+      2xN array of transformed positions.
+
+    """
+    cat = np.asarray(cat, float)
+    T = np.asarray(T, float)
+    return T[:2, :2].dot(cat) + T[:2, 2:]
+
 def brightest(cat0, flux, n, full_output=False):
     """Return the n brightest objects in the catalog.
 
     Parameters
     ----------
-    cat0 : array
-      2xN array of positions.
-    flux : array
-      N-element array of object brightness.
+    cat0 : array or SourceCatalog
+      2xN array of positions, or a source catalog.
+    flux : array or string
+      N-element array of object brightness, or the name of a
+      `SourceCatalog` column.
     n : int
       Return the brightest `n` objects.
     full_output : bool, optional
@@ -45,25 +459,22 @@ def brightest(cat0, flux, n, full_output=False):
 
     Returns
     -------
-    cat : ndarray
+    cat : ndarray or SourceCatalog
     i : ndarray
 
     """
-    i = np.argsort(flux)[::-1][:n]
-    if full_output:
-        return np.array(cat0)[:, i], i
-    else:
-        return np.array(cat0)[:, i]
+    return _select(cat0, flux, n, True, full_output)
 
 def faintest(cat0, flux, n, full_output=False):
     """Return the n faintest objects in the catalog.
 
     Parameters
     ----------
-    cat0 : array
-      2xN array of positions.
-    flux : array
-      N-element array of object brightness.
+    cat0 : array or SourceCatalog
+      2xN array of positions, or a source catalog.
+    flux : array or string
+      N-element array of object brightness, or the name of a
+      `SourceCatalog` column.
     n : int
       Return the brightest `n` objects.
     full_output : bool, optional
@@ -71,15 +482,11 @@ def faintest(cat0, flux, n, full_output=False):
 
     Returns
     -------
-    cat : ndarray
+    cat : ndarray or SourceCatalog
     i : ndarray
 
     """
-    i = np.argsort(flux)[:n]
-    if full_output:
-        return np.array(cat0)[:, i], i
-    else:
-        return np.array(cat0)[:, i]
+    return _select(cat0, flux, n, False, full_output)
 
 def find_offset(cat0, cat1, matches, tol=3.0):
     """Find the offset between two catalogs, given matched stars.
@@ -114,6 +521,229 @@ def find_offset(cat0, cat1, matches, tol=3.0):
     i = i[list(set(np.r_[j, k]))]
     return d[:, i].mean(1)
 
+def pattern_match(cat0, cat1, flux0=None, flux1=None, nbright=50, k=6,
+                  tol=0.01, a2c_tol=1.0, cbet_tol=0.2, max_ratio=10,
+                  sbin=0.02, rbin=2.0, min_frac=0, match_tol=None,
+                  min_votes=10, full_output=False, verbose=True):
+    """Find spatially matching sources with triangle pattern hashing.
+
+    A fast alternative to `triangle_match` for large catalogs:
+
+      1) Only the `nbright` brightest stars of each catalog are used,
+      and triangles are only formed between each star and pairs of
+      its `k` nearest neighbors.
+
+      2) Triangle shapes, `(a/c, cos(beta))`, as defined by
+      `triangles`, are indexed with a KD-tree, and each triangle of
+      `cat1` is paired with the nearest shape of `cat0`, rejecting
+      pairs farther than `tol`.
+
+      3) The pairs vote for the orientation, scale, and rotation
+      between the catalogs.  Only pairs near the most popular
+      transformation are kept.  If the vote is not significant, no
+      stars are matched.
+
+      4) The kept pairs vote for star matches, as in
+      `triangle_match`.
+
+      5) Optionally, the similarity transformation is fit to the
+      matched stars, and all stars of both catalogs are matched
+      within `match_tol`.
+
+    Parameters
+    ----------
+    cat0, cat1 : arrays or SourceCatalog
+      Each catalog is a 2xN array of (y, x) positions, or a source
+      catalog.
+    flux0, flux1 : array, optional
+      Object brightnesses used to select the brightest stars.  If
+      `None`, the `flux` column of a source catalog is used, or else
+      the first `nbright` stars, which only works when both catalogs
+      are sorted the same way, e.g., by brightness.
+    nbright : int, optional
+      The number of bright stars from which to form triangles.
+    k : int, optional
+      The number of nearest neighbors of each star used to form
+      triangles.
+    tol : float, optional
+      The triangle match tolerance in (a/c, cos(beta)) space.
+    a2c_tol, cbet_tol : float, optional
+      Tolerance factors for a/c and cos(beta) matching.
+    max_ratio : float, optional
+      Maximum ratio of longest to shortest triangle side.
+    sbin : float, optional
+      Bin size in log scale factor for the transformation vote.
+    rbin : float, optional
+      Bin size in rotation angle for the transformation vote.
+      [deg]
+    min_frac : float, optional
+      Only return voted stars with `frac > min_frac`.
+    match_tol : float, optional
+      If not `None`, match all stars with distances less than
+      `match_tol` after transforming `cat1` to the `cat0` frame.
+      [pixels of `cat0`]
+    min_votes : int, optional
+      The minimum number of triangle pairs voting for the
+      transformation.  The vote must also be 5 sigma above the
+      average bin of the vote histogram.
+    full_output : bool, optional
+      Set to `True` to also return the sparse `match_matrix` of
+      votes and the triangle match scores.
+    verbose : bool, optional
+      Print some feedback for the user.
+
+    Returns
+    -------
+    matches : dictionary
+      The best match for star `i` of `cat0` is `matches[i]` in `cat1`.
+    frac : dictionary
+      Fraction of times star `i` matched star `matches[i]` out of all
+      times stars `i` and `matches[i]` were matched to any star.
+      Stars only matched through `match_tol` have `frac` of 0.
+    match_matrix : scipy.sparse.csr_matrix, optional
+      If `full_output` is `True`, also return the `N0xN1` matrix of
+      all star votes.
+    scores : ndarray, optional
+      The scores for each triangle's nearest neighbor.
+
+    """
+
+    import scipy.sparse as sp
+    from scipy.spatial import cKDTree
+
+    if isinstance(cat0, SourceCatalog) and flux0 is None and 'flux' in cat0:
+        flux0 = cat0['flux']
+    if isinstance(cat1, SourceCatalog) and flux1 is None and 'flux' in cat1:
+        flux1 = cat1['flux']
+    cat0 = np.asarray(_positions(cat0), float)
+    cat1 = np.asarray(_positions(cat1), float)
+    assert len(cat0) == 2
+    assert len(cat1) == 2
+    N0 = cat0.shape[1]
+    N1 = cat1.shape[1]
+
+    def bright(cat, flux):
+        if flux is None:
+            return np.arange(min(nbright, cat.shape[1]))
+        return _top(flux, nbright)
+
+    def shapes(cat, b):
+        v = _neighbor_triangles(cat[:, b], k)
+        v, s = _triangle_shapes(cat[0, b], cat[1, b], v,
+                                max_ratio=max_ratio)
+        return b[v], s
+
+    b0 = bright(cat0, flux0)
+    b1 = bright(cat1, flux1)
+    v0, s0 = shapes(cat0, b0)
+    v1, s1 = shapes(cat1, b1)
+
+    # nearest triangle shapes
+    shape_scale = 1.0 / np.array((a2c_tol, cbet_tol))
+    tree = cKDTree(s0[1:3].T * shape_scale)
+    d, i = tree.query(s1[1:3].T * shape_scale)
+    good = d <= tol
+
+    if verbose:
+        print(("[pattern_match] cat0 = {} triangles, cat1 = {} triangles\n"
+               "[pattern_match] {} triangle pairs at or below given "
+               "tolerance ({})").format(v0.shape[1], v1.shape[1],
+                                       good.sum(), tol))
+
+    # vote for the orientation
+    ccw = s0[3, i] == s1[3]
+    parity = 1 if ccw[good].sum() >= (~ccw[good]).sum() else -1
+    good *= ccw if parity == 1 else ~ccw
+
+    # vote for the scale and rotation, using side c (vertex 0 to 1)
+    def side_c(cat, v):
+        dy = cat[0, v[1]] - cat[0, v[0]]
+        dx = cat[1, v[1]] - cat[1, v[0]]
+        return np.log(np.hypot(dy, dx)), np.degrees(np.arctan2(dy, dx))
+
+    l0, a0 = side_c(cat0, v0[:, i])
+    l1, a1 = side_c(cat1, v1)
+    logs = l0 - l1
+    rot = (a0 - parity * a1) % 360
+    if good.any():
+        h, ls, rs = np.histogram2d(
+            logs[good], rot[good],
+            bins=(np.arange(logs[good].min() - sbin,
+                            logs[good].max() + 2 * sbin, sbin),
+                  np.arange(0, 360 + rbin, rbin)))
+        # smooth over neighboring bins, wrapping in rotation
+        h = sum([np.roll(np.roll(h, dl, 0), dr, 1)
+                 for dl in (-1, 0, 1) for dr in (-1, 0, 1)])
+        pl, pr = np.unravel_index(h.argmax(), h.shape)
+        peak_logs = ls[pl] + sbin / 2.0
+        peak_rot = rs[pr] + rbin / 2.0
+        good *= np.abs(logs - peak_logs) < 1.5 * sbin
+        good *= np.abs((rot - peak_rot + 180) % 360 - 180) < 1.5 * rbin
+        if verbose:
+            print(("[pattern_match] Scale = {:.4g}, rotation = {:.4g} deg, "
+                   "parity = {}\n"
+                   "[pattern_match] {} triangle pairs voted for the "
+                   "transformation").format(np.exp(peak_logs), peak_rot,
+                                            parity, good.sum()))
+
+        # unrelated catalogs still produce a (small) peak
+        bg = h.mean()
+        if h.max() < bg + 5 * np.sqrt(bg) or good.sum() < min_votes:
+            good[:] = False
+            if verbose:
+                print("[pattern_match] The vote is not significant.")
+
+    # vote for stars
+    j = i[good]
+    n = good.sum()
+    match_matrix = sp.coo_matrix(
+        (np.ones(3 * n, int),
+         (v0[:, j].ravel(), v1[:, good].ravel())),
+        shape=(N0, N1)).tocsr()
+
+    m0 = np.asarray(match_matrix.argmax(1)).ravel()
+    m1 = np.asarray(match_matrix.argmax(0)).ravel()
+    peak = np.asarray(match_matrix[np.arange(N0), m0]).ravel()
+    total = (np.asarray(match_matrix.sum(1)).ravel()
+             + np.asarray(match_matrix.sum(0)).ravel()[m0])
+    voted = (peak > 0) * (m1[m0] == np.arange(N0))
+    frac = np.zeros(N0)
+    frac[voted] = 2.0 * peak[voted] / total[voted]
+    voted *= frac > min_frac
+
+    matches = dict(zip(np.flatnonzero(voted), m0[voted]))
+    frac = dict(zip(np.flatnonzero(voted), frac[voted]))
+
+    if verbose:
+        print("[pattern_match] {} stars matched by vote".format(len(matches)))
+
+    if match_tol is not None and len(matches) >= 2:
+        i0 = np.array(list(matches.keys()))
+        i1 = np.array([matches[m] for m in i0])
+        T = _transform_lstsq(cat1[:, i1].T, cat0[:, i0].T, 'similarity',
+                             reflect=parity == -1)
+        p1 = apply_transform(cat1, T).T
+        tree = cKDTree(cat0.T)
+        d1, j0 = tree.query(p1, distance_upper_bound=match_tol)
+        j1 = np.flatnonzero(np.isfinite(d1))
+        j0 = j0[j1]
+        # keep one-to-one matches
+        u, c = np.unique(j0, return_counts=True)
+        once = np.in1d(j0, u[c == 1])
+        taken = set(matches.values())
+        for a, b in zip(j0[once], j1[once]):
+            if a not in matches and b not in taken:
+                matches[a] = b
+                frac[a] = 0.0
+
+        if verbose:
+            print("[pattern_match] {} stars matched".format(len(matches)))
+
+    if full_output:
+        return matches, frac, match_matrix, d
+    else:
+        return matches, frac
+
 def project_catalog(cat, wcs=None):
     """Project a catalog onto the image plane.
 
@@ -161,8 +791,9 @@ def nearest_match(cat0, cat1, tol=1.0, **kwargs):
 
     Parameters
     ----------
-    cat0, cat1 : arrays
-      Each catalog is a 2xN array of (y, x) positions.
+    cat0, cat1 : arrays or SourceCatalog
+      Each catalog is a 2xN array of (y, x) positions, or a source
+      catalog.  The KD-tree of a `cat0` source catalog is reused.
     tol : float, optional
       The radial match tolerance in pixels.
     **kwargs
@@ -183,10 +814,18 @@ def nearest_match(cat0, cat1, tol=1.0, **kwargs):
     from scipy.spatial.ckdtree import cKDTree
     from .util import takefrom, meanclip
 
+    if isinstance(cat0, SourceCatalog):
+        tree = cat0.tree
+    else:
+        tree = None
+
+    cat0 = _positions(cat0)
+    cat1 = _positions(cat1)
     assert len(cat0) == 2
     assert len(cat1) == 2
 
-    tree = cKDTree(cat0.T)
+    if tree is None:
+        tree = cKDTree(cat0.T)
     d, i = tree.query(cat1.T)  # 0 of cat1 -> i[0] of cat0
 
     matches = dict()
@@ -201,6 +840,236 @@ def nearest_match(cat0, cat1, tol=1.0, **kwargs):
 
     return matches, dyx[:, j]
 
+def sky_match(coords0, coords1, radius, mode='one-to-one', nprocs=1,
+              chunk=100000):
+    """Cross-match two lists of sky coordinates.
+
+    Coordinates are converted to Cartesian vectors on the unit
+    sphere, and matched with KD-trees in chord distance, which is
+    monotonic with angular separation.  The query side is divided into
+    chunks, optionally distributed across processes.
+
+    Parameters
+    ----------
+    coords0, coords1 : SkyCoord, SourceCatalog, or tuple
+      The coordinates to match: astropy `SkyCoord`s (`coords1` is
+      transformed to the frame of `coords0`), source catalogs with
+      `ra` and `dec` columns, or `(ra, dec)` tuples, in degrees.
+    radius : float, Quantity, or Angle
+      The match radius.  [deg]
+    mode : string, optional
+      'one-to-one': each source of `coords1` is matched with its
+      nearest neighbor in `coords0`; where several sources matched
+      the same neighbor, only the closest is kept.
+      'all': all pairs within `radius`.
+      'mutual': pairs that are each other's nearest neighbor.
+    nprocs : int, optional
+      Number of processes.  Each process builds its own tree.
+    chunk : int, optional
+      Query this many sources at a time.
+
+    Returns
+    -------
+    i0, i1 : ndarray
+      Indices of the matched pairs in `coords0` and `coords1`, sorted
+      by `i1`, then separation.
+    sep : astropy Angle
+      The angular separation of each pair.
+
+    """
+
+    from astropy.coordinates import Angle
+    import astropy.units as u
+
+    assert mode in ['one-to-one', 'all', 'mutual']
+
+    xyz0, xyz1 = _unit_vectors(coords0, coords1)
+    if len(xyz0) == 0 or len(xyz1) == 0:
+        return (np.zeros(0, int), np.zeros(0, int),
+                Angle(np.zeros(0), u.deg))
+
+    radius = float(_degrees(radius))
+    r = 2 * np.sin(np.radians(radius) / 2)
+
+    k = None if mode == 'all' else 1
+    d, i1, i0 = _chunked_query(xyz0, xyz1, r, k, nprocs, chunk)
+
+    if mode == 'one-to-one':
+        # keep the closest match to each coords0 source
+        j = np.lexsort((d, i0))
+        first = np.ones(len(j), bool)
+        first[1:] = i0[j][1:] != i0[j][:-1]
+        j = np.sort(j[first])
+        d, i0, i1 = d[j], i0[j], i1[j]
+    elif mode == 'mutual':
+        back = np.empty(len(xyz0), int)
+        back.fill(-1)
+        d0, j0, j1 = _chunked_query(xyz1, xyz0, r, 1, nprocs, chunk)
+        back[j0] = j1
+        j = back[i0] == i1
+        d, i0, i1 = d[j], i0[j], i1[j]
+
+    sep = Angle(np.degrees(2 * np.arcsin(np.minimum(d / 2, 1))), u.deg)
+    return i0, i1, sep
+
+def solve_transform(cat0, cat1, matches=None, model='similarity',
+                    tol=1.0, ntrials=500, niter=5, reflect=None, seed=None,
+                    rematch=True, flux0=None, flux1=None, min_inliers=6):
+    """Solve for the transformation between two catalogs.
+
+    Candidate star pairs are first filtered with RANSAC: models are
+    computed from many random minimal sets of pairs (vectorized), and
+    the model with the most pairs within `tol` is kept.  The model is
+    then refined by least squares on its inliers.  Optionally, the
+    full catalogs are re-matched with the current model (one-to-one
+    nearest neighbors within `tol`) and re-fit, until the matches no
+    longer change.  The re-matched inliers must be significantly more
+    than expected from chance coincidences of the two catalogs.
+
+    Parameters
+    ----------
+    cat0, cat1 : arrays or SourceCatalog
+      Each catalog is a 2xN array of (y, x) positions, or a source
+      catalog.
+    matches : dict, optional
+      Candidate matches, e.g., from `triangle_match`,
+      `pattern_match`, or `nearest_match`: star `i` of `cat0` is
+      `matches[i]` in `cat1`.  False matches are allowed.  If
+      `None`, `pattern_match` is used, which requires fluxes.
+    model : string, optional
+      'shift', 'rigid' (rotation and shift), 'similarity' (rotation,
+      scale, and shift), or 'affine'.
+    tol : float, optional
+      Inlier tolerance.  [pixels of `cat0`]
+    ntrials : int, optional
+      Number of RANSAC trials.
+    niter : int, optional
+      Maximum number of re-match iterations.
+    reflect : bool, optional
+      Allow a reflection ('rigid' and 'similarity').  If `None`, both
+      parities are tried.
+    seed : int, optional
+      Random number generator seed.
+    rematch : bool, optional
+      Set to `False` to only use the candidate matches.
+    flux0, flux1 : array, optional
+      Object brightnesses for `pattern_match`.  If `None`, the `flux`
+      column of a source catalog is used.
+    min_inliers : int, optional
+      The minimum number of inliers, in excess of chance
+      coincidences after re-matching.
+
+    Returns
+    -------
+    T : ndarray
+      3x3 homogeneous transformation matrix from `cat1` to `cat0`,
+      see `apply_transform`.
+    inliers : dictionary
+      The inlier matches: star `i` of `cat0` is `inliers[i]` in
+      `cat1`.
+    stats : dict
+      Residual statistics of the inliers: `n`, `rms`, `median`, and
+      `max` distances, and the `scale` and `rotation` (deg, from +y
+      toward +x) of the transformation.
+
+    Raises
+    ------
+    ValueError
+      If there are no candidate matches and no fluxes, or not enough
+      candidate matches for the model.
+    RuntimeError
+      If no transformation with enough inliers is found.
+
+    """
+
+    from scipy.spatial import cKDTree
+
+    if matches is None:
+        if isinstance(cat0, SourceCatalog) and flux0 is None:
+            flux0 = cat0['flux'] if 'flux' in cat0 else None
+        if isinstance(cat1, SourceCatalog) and flux1 is None:
+            flux1 = cat1['flux'] if 'flux' in cat1 else None
+        if flux0 is None or flux1 is None:
+            raise ValueError("Candidate matches or fluxes are required.")
+        matches = pattern_match(cat0, cat1, flux0, flux1, verbose=False)[0]
+
+    cat0 = np.asarray(_positions(cat0), float)
+    cat1 = np.asarray(_positions(cat1), float)
+    assert len(cat0) == 2
+    assert len(cat1) == 2
+    assert model in ['shift', 'rigid', 'similarity', 'affine']
+
+    i0 = np.array(list(matches.keys()), int)
+    i1 = np.array([matches[i] for i in i0], int)
+    nmin = dict(shift=1, rigid=2, similarity=2, affine=3)[model]
+    min_inliers = max(min_inliers, nmin)
+    if len(i0) < min_inliers:
+        raise ValueError("Not enough matches for this model.")
+
+    p0 = cat0[:, i0].T
+    p1 = cat1[:, i1].T
+
+    # RANSAC
+    rs = np.random.RandomState(seed)
+    trials = np.array([rs.choice(len(i0), nmin, replace=False)
+                       for j in range(ntrials)])
+    parities = [False, True] if reflect is None else [reflect]
+    T = _minimal_transforms(p0[trials], p1[trials], model, parities)
+    d = np.sqrt(((np.einsum('tij,nj->tni', T[:, :2, :2], p1)
+                  + T[:, None, :2, 2] - p0)**2).sum(2))
+    best = (d < tol).sum(1).argmax()
+    det = np.linalg.det(T[best, :2, :2])
+    flip = bool(det < 0) if model in ['rigid', 'similarity'] else False
+    good = d[best] < tol
+    if good.sum() < min_inliers:
+        raise RuntimeError("No transformation found.")
+
+    T = _transform_lstsq(p1[good], p0[good], model, reflect=flip)
+    inliers = (i0[good], i1[good])
+
+    if rematch:
+        tree = cKDTree(cat0.T)
+        for j in range(niter):
+            d, k = tree.query(apply_transform(cat1, T).T,
+                              distance_upper_bound=tol)
+            k1 = np.flatnonzero(np.isfinite(d))
+            k0 = k[k1]
+            u, c = np.unique(k0, return_counts=True)
+            once = np.in1d(k0, u[c == 1])
+            k0, k1 = k0[once], k1[once]
+            if len(k0) < nmin:
+                break
+
+            T = _transform_lstsq(cat1[:, k1].T, cat0[:, k0].T, model,
+                                 reflect=flip)
+            if (len(k0) == len(inliers[0])
+                and np.all(np.sort(k0) == np.sort(inliers[0]))):
+                inliers = (k0, k1)
+                break
+            inliers = (k0, k1)
+
+        # chance coincidences within tol of the cat0 stars
+        lo = cat0.min(1)
+        hi = cat0.max(1)
+        p1 = apply_transform(cat1, T)
+        inside = np.all((p1 >= lo[:, None]) * (p1 <= hi[:, None]), 0)
+        area = max(np.prod(hi - lo), np.pi * tol**2)
+        chance = cat0.shape[1] * inside.sum() * np.pi * tol**2 / area
+        n = len(inliers[0])
+        if n - chance < min_inliers or n < chance + 5 * np.sqrt(chance):
+            raise RuntimeError("No significant transformation found.")
+
+    d = np.sqrt(((apply_transform(cat1[:, inliers[1]], T)
+                  - cat0[:, inliers[0]])**2).sum(0))
+    det = np.linalg.det(T[:2, :2])
+    stats = dict(n=len(d), rms=np.sqrt(np.mean(d**2)), median=np.median(d),
+                 max=d.max(), scale=np.sqrt(np.abs(det)),
+                 rotation=np.degrees(np.arctan2(T[1, 0] - T[0, 1],
+                                                T[1, 1] + T[0, 0]
+                                                * np.sign(det))))
+
+    return T, dict(zip(*inliers)), stats
+
 def triangles(y, x, max_ratio=100, min_sep=0):
     """Describe all possible triangles in a set of points.
 
@@ -237,36 +1106,7 @@ def triangles(y, x, max_ratio=100, min_sep=0):
     from itertools import combinations
 
     v = np.array(list(combinations(range(len(y)), 3)))
-
-    dy = y[v] - np.roll(y[v], 1, 1)
-    dx = x[v] - np.roll(x[v], 1, 1)
-    sides = np.sqrt(dy**2 + dx**2)
-
-    # numpy magic from
-    # http://stackoverflow.com/questions/10921893/numpy-sorting-a-multidimensional-array-by-a-multidimensional-array/
-    i = np.argsort(sides, 1)[:, ::-1]  # indices of sides a, b, c
-    i = list(np.ogrid[[slice(j) for j in i.shape]][:-1]) + [i]
-    v = v[i]
-    dy = dy[i]
-    dx = dx[i]
-    abc = sides[i]
-
-    a2c = abc[:, 0] / abc[:, 2]
-    i = (a2c < max_ratio) * (abc[:, 2] > min_sep)
-    dx = dx[i]
-    dy = dy[i]
-    abc = abc[i]
-    a2c = a2c[i]
-
-    perimeter = abc.sum(1)
-    cbet = ((abc[:, 0]**2 + abc[:, 2]**2 - abc[:, 1]**2)
-            / (2 * abc[:, 0] * abc[:, 2]))
-    rot = np.sign((x[v[:, 0]] - x[v[:, 2]]) * (y[v[:, 1]] - y[v[:, 0]])
-                  - (x[v[:, 0]] - x[v[:, 1]]) * (y[v[:, 2]] - y[v[:, 0]]))
-    rot = rot[i]
-    shapes = np.c_[perimeter, a2c, cbet, rot]
-
-    return v.T, shapes.T
+    return _triangle_shapes(y, x, v, max_ratio=max_ratio, min_sep=min_sep)
 
 def triangle_match(cat0, cat1, tol=0.01, a2c_tol=1.0, cbet_tol=0.2,
                    psig=1.0, pscale=None, min_frac=0, msig=None,
@@ -301,8 +1141,9 @@ def triangle_match(cat0, cat1, tol=0.01, a2c_tol=1.0, cbet_tol=0.2,
 
     Parameters
     ----------
-    cat0, cat1 : arrays
-      Each catalog is a 2xN array of (y, x) positions.
+    cat0, cat1 : arrays or SourceCatalog
+      Each catalog is a 2xN array of (y, x) positions, or a source
+      catalog.
     tol : float, optional
       The triangle match tolerance in (a/c, cos(beta)) space.
     a2c_tol : float, optional
@@ -348,6 +1189,8 @@ def triangle_match(cat0, cat1, tol=0.01, a2c_tol=1.0, cbet_tol=0.2,
 
     msig = -100 if msig is None else msig
 
+    cat0 = _positions(cat0)
+    cat1 = _positions(cat1)
     assert len(cat0) == 2
     v0, s0 = triangles(*cat0, **kwargs)
 
@@ -451,3 +1294,364 @@ def triangle_match(cat0, cat1, tol=0.01, a2c_tol=1.0, cbet_tol=0.2,
     else:
         return matches, frac
 
+_sky_match_state = dict()
+
+def _chunked_query(points, query, r, k, nprocs, chunk):
+    """Query a KD-tree in chunks, optionally with several processes.
+
+    Parameters
+    ----------
+    points : ndarray
+      `Nx3` points from which to build the tree.
+    query : ndarray
+      `Mx3` points to match.
+    r : float
+      The match radius.
+    k : int or None
+      1 for the nearest neighbor, or `None` for all neighbors within
+      `r`.
+    nprocs, chunk : int
+      See `sky_match`.
+
+    Returns
+    -------
+    d : ndarray
+      The distance of each pair.
+    iq, ip : ndarray
+      The `query` and `points` indices of each pair.
+
+    """
+
+    from multiprocessing import Pool
+
+    edges = list(range(0, len(query), chunk)) + [len(query)]
+    jobs = [(a, b, r, k) for a, b in zip(edges[:-1], edges[1:])]
+
+    if nprocs > 1 and len(jobs) > 1:
+        pool = Pool(nprocs, initializer=_sky_match_init,
+                    initargs=(points, query))
+        try:
+            results = pool.map(_sky_match_chunk, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _sky_match_init(points, query)
+        try:
+            results = [_sky_match_chunk(job) for job in jobs]
+        finally:
+            _sky_match_state.clear()
+
+    if len(results) == 0:
+        return np.zeros(0), np.zeros(0, int), np.zeros(0, int)
+
+    return [np.concatenate(x) for x in zip(*results)]
+
+def _degrees(a):
+    """Angles as an array in degrees."""
+    import astropy.units as u
+    return np.atleast_1d(u.Quantity(a, u.deg).value).astype(float)
+
+def _minimal_transforms(p0, p1, model, parities):
+    """Transformations from p1 to p0 for many minimal sets of points.
+
+    Parameters
+    ----------
+    p0, p1 : ndarray
+      `N x nmin x 2` arrays of (y, x) points.
+    model : string
+      See `solve_transform`.
+    parities : list
+      Reflection settings to try for 'rigid' and 'similarity'.
+
+    Returns
+    -------
+    T : ndarray
+      `M x 3 x 3` transformations.
+
+    """
+
+    N = len(p0)
+    if model == 'shift':
+        T = np.tile(np.eye(3), (N, 1, 1))
+        T[:, :2, 2] = p0[:, 0] - p1[:, 0]
+        return T
+
+    if model == 'affine':
+        # solve [y1 x1 1] M = [y0 x0] for each set
+        A = np.concatenate((p1, np.ones((N, 3, 1))), 2)
+        with np.errstate(all='ignore'):
+            ok = np.abs(np.linalg.det(A)) > 1e-12
+            M = np.linalg.solve(A[ok], p0[ok])
+        T = np.tile(np.eye(3), (ok.sum(), 1, 1))
+        T[:, :2, :2] = M[:, :2].transpose(0, 2, 1)
+        T[:, :2, 2] = M[:, 2]
+        return T
+
+    z0 = p0[..., 1] + 1j * p0[..., 0]
+    z1 = p1[..., 1] + 1j * p1[..., 0]
+    T = []
+    for reflect in parities:
+        w = z1.conj() if reflect else z1
+        with np.errstate(all='ignore'):
+            a = (z0[:, 1] - z0[:, 0]) / (w[:, 1] - w[:, 0])
+        ok = np.isfinite(a) * (a != 0)
+        a = a[ok]
+        if model == 'rigid':
+            a = a / np.abs(a)
+        t = np.tile(np.eye(3), (len(a), 1, 1))
+        t[:, :2, :2] = _complex_to_matrix(a, reflect)
+        t[:, :2, 2] = (p0[ok].mean(1)
+                       - np.einsum('nij,nj->ni', t[:, :2, :2],
+                                   p1[ok].mean(1)))
+        T.append(t)
+    return np.concatenate(T)
+
+def _neighbor_triangles(cat, k):
+    """Triangles between each star and pairs of its nearest neighbors.
+
+    Parameters
+    ----------
+    cat : ndarray
+      2xN array of positions.
+    k : int
+      The number of nearest neighbors.
+
+    Returns
+    -------
+    v : ndarray
+      Nx3 array of unique vertex indices.
+
+    """
+
+    from itertools import combinations
+    from scipy.spatial import cKDTree
+
+    N = cat.shape[1]
+    k = min(k, N - 1)
+    if k < 2:
+        return np.zeros((0, 3), int)
+
+    nn = cKDTree(cat.T).query(cat.T, k + 1)[1][:, 1:]
+    pairs = np.array(list(combinations(range(k), 2)))
+    v = np.c_[np.repeat(np.arange(N), len(pairs)),
+              nn[:, pairs].reshape((-1, 2))]
+    v = np.sort(v, 1)
+    v = v[(v[:, 0] != v[:, 1]) * (v[:, 1] != v[:, 2])]
+    return _unique_rows(v)
+
+def _positions(cat):
+    """2xN position array of a catalog, without copying."""
+    if isinstance(cat, SourceCatalog):
+        return cat.yx
+    return np.asarray(cat)
+
+def _select(cat0, flux, n, largest, full_output):
+    """Shared code for `brightest` and `faintest`."""
+    if isinstance(cat0, SourceCatalog):
+        if isinstance(flux, _string_types):
+            flux = cat0[flux]
+        i = _top(flux, n, largest)
+        cat = cat0[i]
+    else:
+        i = _top(flux, n, largest)
+        cat = np.asarray(cat0)[:, i]
+
+    if full_output:
+        return cat, i
+    else:
+        return cat
+
+def _transform_lstsq(p0, p1, model, reflect=False):
+    """Least-squares transformation from p0 to p1.
+
+    Parameters
+    ----------
+    p0, p1 : ndarray
+      Nx2 arrays of matched (y, x) points.
+    model : string
+      'shift', 'rigid', 'similarity', or 'affine'.
+    reflect : bool, optional
+      Include a reflection ('rigid' and 'similarity' only).
+
+    Returns
+    -------
+    T : ndarray
+      3x3 homogeneous transformation matrix, such that `p1 = T[:2,
+      :2] p0 + T[:2, 2]`.
+
+    """
+
+    p0 = np.asarray(p0, float)
+    p1 = np.asarray(p1, float)
+    m0 = p0.mean(0)
+    m1 = p1.mean(0)
+    q0 = p0 - m0
+    q1 = p1 - m1
+
+    if model == 'shift':
+        A = np.eye(2)
+    elif model == 'affine':
+        A = np.linalg.lstsq(q0, q1, rcond=None)[0].T
+    else:
+        # closed-form solution with complex numbers, x + iy
+        z0 = q0[:, 1] + 1j * q0[:, 0]
+        z1 = q1[:, 1] + 1j * q1[:, 0]
+        if reflect:
+            z0 = z0.conj()
+        a = (z0.conj() * z1).sum() / (np.abs(z0)**2).sum()
+        if model == 'rigid':
+            a /= np.abs(a)
+        A = _complex_to_matrix(a, reflect)
+
+    T = np.eye(3)
+    T[:2, :2] = A
+    T[:2, 2] = m1 - A.dot(m0)
+    return T
+
+def _complex_to_matrix(a, reflect=False):
+    """(y, x) matrices for z' = a z or a z*, where z = x + iy."""
+    a = np.asarray(a)
+    A = np.empty(a.shape + (2, 2))
+    if reflect:
+        A[..., 0, 0] = -a.real
+        A[..., 0, 1] = a.imag
+        A[..., 1, 0] = a.imag
+        A[..., 1, 1] = a.real
+    else:
+        A[..., 0, 0] = a.real
+        A[..., 0, 1] = a.imag
+        A[..., 1, 0] = -a.imag
+        A[..., 1, 1] = a.real
+    return A
+
+def _sky_match_chunk(args):
+    """Query a chunk of points for `_chunked_query`."""
+    start, stop, r, k = args
+    tree = _sky_match_state['tree']
+    q = _sky_match_state['query'][start:stop]
+    n = tree.n
+
+    if k == 1:
+        d, j = tree.query(q, distance_upper_bound=r)
+        i = np.flatnonzero(np.isfinite(d))
+        return d[i], start + i, j[i]
+
+    # all neighbors: increase k until every query is complete
+    D, I, J = [], [], []
+    todo = np.arange(len(q))
+    k = min(8, n)
+    while len(todo) > 0:
+        d, j = tree.query(q[todo], k, distance_upper_bound=r)
+        d = d.reshape((len(todo), -1))
+        j = j.reshape((len(todo), -1))
+        done = ~np.isfinite(d[:, -1]) | (k >= n)
+        m = np.isfinite(d) & done[:, None]
+        D.append(d[m])
+        I.append(start + np.repeat(todo, m.sum(1)))
+        J.append(j[m])
+        todo = todo[~done]
+        k = min(2 * k, n)
+
+    d, i, j = [np.concatenate(x) for x in (D, I, J)]
+    o = np.lexsort((d, i))
+    return d[o], i[o], j[o]
+
+def _sky_match_init(points, query):
+    """Build the tree for `_sky_match_chunk`."""
+    from scipy.spatial import cKDTree
+    _sky_match_state['tree'] = cKDTree(points)
+    _sky_match_state['query'] = query
+
+def _top(a, n, largest=True):
+    """Indices of the n largest (or smallest) values, sorted."""
+    a = np.asarray(a)
+    if largest:
+        a = -a
+    if n < len(a):
+        i = np.argpartition(a, n)[:n]
+    else:
+        i = np.arange(len(a))
+    return i[np.argsort(a[i], kind='mergesort')]
+
+def _triangle_shapes(y, x, v, max_ratio=100, min_sep=0):
+    """Shapes of a set of triangles, see `triangles`.
+
+    Parameters
+    ----------
+    y, x : arrays
+      Lists of coordinates.
+    v : ndarray
+      Nx3 array of triangle vertex indices.
+    max_ratio, min_sep : float
+      See `triangles`.
+
+    Returns
+    -------
+    v, s : ndarray
+      See `triangles`.
+
+    """
+
+    if len(v) == 0:
+        return np.zeros((3, 0), int), np.zeros((4, 0))
+
+    dy = y[v] - np.roll(y[v], 1, 1)
+    dx = x[v] - np.roll(x[v], 1, 1)
+    sides = np.sqrt(dy**2 + dx**2)
+
+    # numpy magic from
+    # http://stackoverflow.com/questions/10921893/numpy-sorting-a-multidimensional-array-by-a-multidimensional-array/
+    i = np.argsort(sides, 1)[:, ::-1]  # indices of sides a, b, c
+    i = tuple(np.ogrid[[slice(j) for j in i.shape]][:-1]) + (i,)
+    # side k connects vertices k and k - 1, opposite vertex k + 1
+    v = np.roll(v, -1, 1)[i]
+    abc = sides[i]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a2c = abc[:, 0] / abc[:, 2]
+    i = (a2c < max_ratio) * (abc[:, 2] > min_sep)
+    v = v[i]
+    abc = abc[i]
+    a2c = a2c[i]
+
+    perimeter = abc.sum(1)
+    cbet = ((abc[:, 0]**2 + abc[:, 2]**2 - abc[:, 1]**2)
+            / (2 * abc[:, 0] * abc[:, 2]))
+    rot = np.sign((x[v[:, 0]] - x[v[:, 2]]) * (y[v[:, 1]] - y[v[:, 0]])
+                  - (x[v[:, 0]] - x[v[:, 1]]) * (y[v[:, 2]] - y[v[:, 0]]))
+    shapes = np.c_[perimeter, a2c, cbet, rot]
+
+    return v.T, shapes.T
+
+def _unique_rows(a):
+    """Unique rows of an integer array."""
+    a = np.ascontiguousarray(a)
+    b = a.view(np.dtype((np.void, a.dtype.itemsize * a.shape[1])))
+    return a[np.unique(b, return_index=True)[1]]
+
+def _unit_vectors(coords0, coords1):
+    """Unit vectors of two sets of coordinates for `sky_match`."""
+    from astropy.coordinates import SkyCoord
+
+    def xyz(c):
+        if isinstance(c, SkyCoord):
+            return c.represent_as('unitspherical').to_cartesian().xyz.value.T
+        if isinstance(c, SourceCatalog):
+            ra, dec = c['ra'], c['dec']
+        else:
+            ra, dec = c
+        ra = np.radians(_degrees(ra))
+        dec = np.radians(_degrees(dec))
+        return np.c_[np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra),
+                     np.sin(dec)]
+
+    if isinstance(coords0, SkyCoord) and isinstance(coords1, SkyCoord):
+        coords1 = coords1.transform_to(coords0.frame)
+
+    return xyz(coords0), xyz(coords1)
+
+def _zone(dec, height, nzones):
+    """Declination zone numbers."""
+    z = np.floor((np.asarray(dec) + 90.0) / height).astype(int)
+    return np.clip(z, 0, nzones - 1)
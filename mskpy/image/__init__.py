@@ -14,6 +14,7 @@ image --- For working with images, maybe spectra.
    Core
    ----
    imshift
+   imshift_stack
    rarray
    rebin
    stack2grid
@@ -29,7 +30,9 @@ image --- For working with images, maybe spectra.
    azavg
    bgfit
    centroid
+   detect
    gcentroid
+   gcentroid_batch
    imstat
    linecut
    polyfit2d
@@ -44,7 +47,9 @@ image --- For working with images, maybe spectra.
    fixpix
    fwhmfit
    mkflat
+   psf_grid
    psfmatch
+   psfmatch_tiled
    stripes
 
 """
@@ -66,6 +71,15 @@ class Image(np.ndarray):
 
     A way package of some image analysis routines into an ndarray.
 
+    Sub-sampled images and background fits are cached with each
+    instance, and are cleared whenever the image is modified through
+    item assignment or an in-place operator.  Changes made through
+    other views of the data are not detected; use `clear_cache` after
+    such changes.  Cached products are read-only; `bgfit` returns a
+    copy.  Annulus weights for `anphot` and `radprof` depend only on
+    the image shape, and are kept in the module-level cache of
+    `analysis.anphot`.
+
     Parameters
     ----------
     arr : array
@@ -88,12 +102,15 @@ class Image(np.ndarray):
     bgfit - 2D polynomial fit to the background.
     bgphot - Background photometry in an annulus.
     centroid - Simple center of mass centroiding.
+    clear_cache - Remove all cached derived products.
     gcentroid - Simple centroiding by Gaussian fits.
     linecut - Photometry along a line.
+    radius - Distance of each pixel from a point.
     radprof - Radial profiling.
     rebin - Image scaling.
     shift - Shift an image (drizzle).
     stat - A suite of image statistics.
+    subsampled - Sub-sampled image.
     yx2rt - Transform from a rectangular to azimuthal projection.
 
     """
@@ -101,11 +118,62 @@ class Image(np.ndarray):
     def __new__(cls, im, yx=(0, 0)):
         obj = np.asarray(im).view(cls)
         obj.yx = np.array(yx)
+        obj._cache = dict()
         return obj
 
     def __array_finalize__(self, obj):
         if obj is None: return
         self.yx = np.array(getattr(obj, 'yx', (0, 0)))
+        self._cache = dict()
+
+    def __setitem__(self, index, value):
+        self.clear_cache()
+        np.ndarray.__setitem__(self, index, value)
+
+    def __setslice__(self, i, j, value):
+        self.clear_cache()
+        np.ndarray.__setslice__(self, i, j, value)
+
+    def __iadd__(self, other):
+        self.clear_cache()
+        return np.ndarray.__iadd__(self, other)
+
+    def __isub__(self, other):
+        self.clear_cache()
+        return np.ndarray.__isub__(self, other)
+
+    def __imul__(self, other):
+        self.clear_cache()
+        return np.ndarray.__imul__(self, other)
+
+    def __idiv__(self, other):
+        self.clear_cache()
+        return np.ndarray.__idiv__(self, other)
+
+    def __itruediv__(self, other):
+        self.clear_cache()
+        return np.ndarray.__itruediv__(self, other)
+
+    def __ipow__(self, other):
+        self.clear_cache()
+        return np.ndarray.__ipow__(self, other)
+
+    def fill(self, value):
+        self.clear_cache()
+        np.ndarray.fill(self, value)
+
+    def _cached(self, key, func, *args, **kwargs):
+        """Return a derived product from the cache, or generate it."""
+        if key not in self._cache:
+            product = func(*args, **kwargs)
+            product.flags.writeable = False
+            self._cache[key] = product
+        return self._cache[key]
+
+    def _center(self, yx):
+        """`yx` or `self.yx` as a hashable tuple of floats."""
+        yx = self.yx if yx is None else yx
+        return tuple(np.array(yx, float).ravel())
 
     def __array_wrap__(self, out_arr, context=None):
         if out_arr.ndim == 2:
@@ -136,8 +204,20 @@ class Image(np.ndarray):
           `f` will have shape `N x len(rap)`.
 
         """
-        yx = self.yx if yx is None else yx
-        return anphot(self, yx, rap, subsample=subsample)
+        yx = np.array(self.yx if yx is None else yx, float)
+        if not np.iterable(rap):
+            rap = np.array([rap])
+
+        im = self.view(np.ndarray)
+        if yx.ndim == 1:
+            n, f = analysis._annulus_sums(im, yx, rap, subsample)[:2]
+        else:
+            n, f = np.zeros((2, len(yx), len(rap)))
+            for i in range(len(yx)):
+                n[i], f[i] = analysis._annulus_sums(im, yx[i], rap,
+                                                    subsample)[:2]
+
+        return n.squeeze(), f.squeeze()
 
     def apphot(self, rap, yx=None, subsample=4):
         """Simple aperture photometry.
@@ -162,8 +242,8 @@ class Image(np.ndarray):
           `f` will have shape `N x len(rap)`.
 
         """
-        yx = self.yx if yx is None else yx
-        return apphot(self, yx, rap, subsample=subsample)
+        n, f = self.anphot(rap, yx=yx, subsample=subsample)
+        return n.cumsum(-1), f.cumsum(-1)
 
     def azavg(self, yx=None, **kwargs):
         """Compute an azimuthally averaged image.
@@ -195,16 +275,23 @@ class Image(np.ndarray):
         Returns
         -------
         bg : ndarray
-          An image of the best-fit background.
+          An image of the best-fit background.  When only `order`,
+          `cross`, or `step` are specified, the fit is cached, and a
+          copy is returned.
 
         """
-        return bgfit(self, **kwargs)
+        im = self.view(np.ndarray)
+        if set(kwargs.keys()) <= set(['order', 'cross', 'step']):
+            key = ('bgfit', kwargs.get('order', 1),
+                   kwargs.get('cross', False), kwargs.get('step', 1))
+            return self._cached(key, bgfit, im, **kwargs).copy()
+        return bgfit(im, **kwargs)
 
     def bgphot(self, rap, yx=None, **kwargs):
         """Background photometry and error analysis in an annulus.
 
-        Pixels are not sub-sampled.  The annulus is processed via
-        `util.uclip`.
+        Pixels are not sub-sampled.  The annulus is sigma clipped as
+        in `util.meanclip`.
 
         Parameters
         ----------
@@ -230,8 +317,24 @@ class Image(np.ndarray):
 
         """
 
-        yx = self.yx if yx is None else yx
-        return bgphot(self, yx, rap, **kwargs)
+        ufunc = kwargs.pop('ufunc', np.mean)
+        squeeze = kwargs.pop('squeeze', True)
+        yx = np.array(self.yx if yx is None else yx, float).reshape((-1, 2))
+        rap = np.array(rap, float)
+        assert rap.shape == (2,), "rap has incorrect shape."
+
+        im = self.view(np.ndarray).reshape((1,) + self.shape)
+        index = analysis._annulus_index(self.shape, yx, rap)
+        n, bg, sig = analysis._bgphot_clipped(im, index, ufunc, **kwargs)
+
+        if squeeze:
+            return n.squeeze(), bg.squeeze(), sig.squeeze()
+        else:
+            return n, bg, sig
+
+    def clear_cache(self):
+        """Remove all cached derived products."""
+        self._cache.clear()
 
     def centroid(self, yx=None, **kwargs):
         """Simple center of mass centroiding.
@@ -285,7 +388,7 @@ class Image(np.ndarray):
           total length of `length`.  If `length` is an array, it
           specifies the bin edges along `pa`, each bin having a width
           of `width`.
-        pa : float
+        pa : float or array
           Position angle measured counter-clockwise from the
           x-axis. [degrees]
         yx : array, optional
@@ -301,13 +404,38 @@ class Image(np.ndarray):
         n : ndarray
           The number of pixels per bin.
         f : ndarray
-          The line cut photometry.
+          The line cut photometry.  If `pa` is an array, the first
+          axis of `n` and `f` iterates over position angle.
 
         """
         yx = self.yx if yx is None else yx
         return linecut(self, yx, width, length, pa, subsample=subsample)
 
-    def radprof(self, yx=None, **kwargs):
+    def radius(self, yx=None, subsample=1):
+        """Distance of each pixel from a point.
+
+        Parameters
+        ----------
+        yx : array, optional
+          The center, or `None` to use `self.yx`.
+        subsample : int, optional
+          Compute distances for the image sub-sampled by this factor,
+          as in `subsampled`.
+
+        Returns
+        -------
+        r : ndarray
+          The distance from `yx` computed with `core.rarray`.  [pixels
+          (not sub-sampled)]
+
+        """
+        yx = self._center(yx)
+        s = max(subsample, 1)
+        shape = (self.shape[0] * s, self.shape[1] * s)
+        yxs = np.array(yx) * s + (s - 1) / 2.0
+        return rarray(shape, yx=yxs, subsample=10) / float(s)
+
+    def radprof(self, yx=None, bins=10, range=None, subsample=4):
         """Radial profile.
 
         Parameters
@@ -315,6 +443,13 @@ class Image(np.ndarray):
         yx : array
           The center of the profile.  If `yx` is `None`, `self.yx`
           will be used.
+        bins : int or array, optional
+          The number of radial bins, or the radial bin edges.
+        range : array, optional
+          If bins is a single number, set the bin range to this,
+          otherwise set the range to from 0 to the maximal radius.
+        subsample : int, optional
+          Sub-sample the image at this scale factor.
 
         Returns
         -------
@@ -328,8 +463,11 @@ class Image(np.ndarray):
           The mean radius of the points in each radial bin.
 
         """
-        yx = self.yx if yx is None else yx
-        return radprof(self, yx, **kwargs)
+        yx = self._center(yx)
+        rap = analysis._radprof_bins(self.shape, yx, bins, range)
+        n, f, rsum = analysis._annulus_sums(self.view(np.ndarray), yx, rap,
+                                            subsample)
+        return analysis._radprof_sb(rap, n, f, rsum)
 
     def rebin(self, factor, **kwargs):
         """Rebin by integer amounts.
@@ -348,7 +486,7 @@ class Image(np.ndarray):
         """
         return rebin(self, factor, **kwargs)
 
-    def shift(self, yx, subsample=4):
+    def shift(self, yx, subsample=4, **kwargs):
         """Shift the image, allowing for sub-pixel offsets (drizzle).
 
         Parameters
@@ -358,6 +496,8 @@ class Image(np.ndarray):
           up/right. [unsampled pixels]
         subsample : int, optional
           The sub-sampling factor.
+        **kwargs
+          Any valid `core.imshift` keywords, e.g., `method`.
 
         Returns
         -------
@@ -365,7 +505,7 @@ class Image(np.ndarray):
           The shifted image (at the original pixel scale).
 
         """
-        return imshift(self, yx, subsample=subsample)
+        return imshift(self, yx, subsample=subsample, **kwargs)
 
     def stat(self, **kwargs):
         """Some quick image statistics.
@@ -383,6 +523,29 @@ class Image(np.ndarray):
         """
         return imstat(self, **kwargs)
 
+    def subsampled(self, subsample):
+        """The image sub-sampled (drizzled) by an integer factor.
+
+        Flux is preserved, as used for photometry.  The result is
+        cached and read-only.
+
+        Parameters
+        ----------
+        subsample : int
+          The sub-pixel sampling factor.  Values `<= 1` return a view
+          of the original image.
+
+        Returns
+        -------
+        sim : ndarray
+
+        """
+        im = self.view(np.ndarray)
+        if subsample <= 1:
+            return im
+        return self._cached(('subsampled', subsample), rebin, im,
+                            subsample, flux=True)
+
     def yx2rt(self, yx=None, **kwargs):
         """Cartesian to polar transformation.
 
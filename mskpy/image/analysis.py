@@ -10,17 +10,22 @@ image.analysis --- Analyze (astronomical) images.
    anphot
    apphot
    apphot_by_wcs
+   apphot_series
    azavg
    bgfit
    bgphot
    centroid
+   detect
    find
    fwhm
+   fwhm_batch
    gcentroid
+   gcentroid_batch
    imstat
    linecut
    polyfit2d
    radprof
+   read_apphot_series
    trace
 
 .. todo:: Re-write anphot to generate pixel weights via rarray, rather
@@ -38,17 +43,22 @@ __all__ = [
     'anphot',
     'apphot',
     'apphot_by_wcs',
+    'apphot_series',
     'azavg',
     'bgfit',
     'bgphot',
     'centroid',
+    'detect',
     'gcentroid',
+    'gcentroid_batch',
     'find',
     'fwhm',
+    'fwhm_batch',
     'imstat',
     'linecut',
     'polyfit2d',
     'radprof',
+    'read_apphot_series',
     'trace'
 ]
 
@@ -93,7 +103,7 @@ def anphot(im, yx, rap, subsample=4, squeeze=True):
 
     """
 
-    _im = np.array(im)
+    _im = np.asarray(im)
     assert _im.ndim in [2, 3], ("Only images, data cubes, or tuples/lists"
                                 " of images are allowed.")
     if _im.ndim == 2:
@@ -118,8 +128,7 @@ def anphot(im, yx, rap, subsample=4, squeeze=True):
 
     # flatten all arrays for digitize
     N = _im.shape[0]
-    M = _im.shape[1] * _im.shape[2]
-    _im = _im.flatten().reshape((N, M))
+    _im = _im.reshape((N, -1))
 
     n = np.zeros((len(yx), len(rap)))
     f = np.zeros((N, len(yx), len(rap)))
@@ -128,11 +137,7 @@ def anphot(im, yx, rap, subsample=4, squeeze=True):
     # save CPU time when mulitiple images are passed
     for i in range(len(yx)):
         r = core.rarray(sz, yx=yx[i], subsample=10) / float(subsample)
-        bins = np.digitize(r.flatten(), rap)
-        for j in range(len(rap)):
-            ap = np.flatnonzero(bins == j)
-            f[:, i, j] = np.sum(_im[:, ap], 1)
-            n[i, j] = len(ap)
+        n[i], f[:, i] = _anphot_binned(_im, r, rap)
 
     n /= float(subsample**2)
     if squeeze:
@@ -194,8 +199,9 @@ def apphot_by_wcs(im, coords, wcs, rap, centroid=False,
       An image, cube, or tuple of images on which to measure
       photometry.  For data cubes, the first axis iterates over the
       images.  All images must have the same shape.
-    coords : astropy SkyCoord
-      The coordinates (e.g., RA, Dec) of the targets.  Only sources
+    coords : astropy SkyCoord or SourceCatalog
+      The coordinates (e.g., RA, Dec) of the targets, or a source
+      catalog with `ra` and `dec` columns in degrees.  Only sources
       interior to the image and at least `2 * max(rap)` from the edges
       are considered.
     wcs : astropy WCS
@@ -207,7 +213,8 @@ def apphot_by_wcs(im, coords, wcs, rap, centroid=False,
       multiple images are provided, the centroid is based on the first
       image.
     cfunc : function, optional
-      The centroiding function to use, or `None` for `gcentroid`.
+      The centroiding function to use, or `None` to center all sources
+      at once with `gcentroid_batch`.
     ckwargs: dict
       Any `cfunc` keyword arguments.
     **kwargs:
@@ -215,8 +222,10 @@ def apphot_by_wcs(im, coords, wcs, rap, centroid=False,
 
     Returns
     -------
-    yx : ndarray
-      Pixel positions of all sources, `Nx2`.
+    yx : ndarray or SourceCatalog
+      Pixel positions of all sources, `Nx2`.  If `coords` is a source
+      catalog, a new catalog with the same columns and the pixel
+      positions, `y` and `x`, is returned instead.
     n : ndarray
       The number of pixels per aperture, either shape `(len(rap),)` or
       `(len(yx), len(rap))`.
@@ -228,16 +237,24 @@ def apphot_by_wcs(im, coords, wcs, rap, centroid=False,
 
     """
 
+    from astropy.coordinates import SkyCoord
+    from ..catalogs import SourceCatalog
+
     squeeze = kwargs.pop('squeeze', True)
 
+    catalog = None
+    if isinstance(coords, SourceCatalog):
+        catalog = coords
+        coords = SkyCoord(catalog['ra'], catalog['dec'], unit='deg')
+
     x, y = coords.to_pixel(wcs)
     yx = np.c_[y, x]
 
     n = np.zeros((len(yx), np.size(rap)))
-    shape = np.array(im).shape
+    shape = np.shape(im)
     if len(shape) == 3:
-        shape = shape[1:]
         f = np.zeros((shape[0], ) + n.shape)
+        shape = shape[1:]
     else:
         f = np.zeros((1, ) + n.shape)
 
@@ -248,26 +265,122 @@ def apphot_by_wcs(im, coords, wcs, rap, centroid=False,
                              * (y <= (shape[0] - 2 * max_rap)))
 
     if centroid:
+        im0 = im[0] if np.ndim(im) == 3 else im
         if cfunc is None:
-            cfunc = gcentroid
-
-        for i in sources:
-            try:
-                if len(shape) == 3:
-                    yx[i] = cfunc(im[0], yx[i], **ckwargs)
-                else:
-                    yx[i] = cfunc(im, yx[i], **ckwargs)
-            except UnableToCenter:
-                pass
+            cyx, good = gcentroid_batch(im0, yx[sources], **ckwargs)
+            yx[sources[good]] = cyx[good]
+        else:
+            for i in sources:
+                try:
+                    yx[i] = cfunc(im0, yx[i], **ckwargs)
+                except UnableToCenter:
+                    pass
 
     _n, _f = apphot(im, yx[sources], rap, squeeze=False, **kwargs)
     n[sources] = _n
     f[:, sources] = _f
+
+    if catalog is not None:
+        cat = SourceCatalog.from_array(yx.T)
+        for c in catalog.columns:
+            if c not in ['y', 'x']:
+                cat[c] = catalog[c]
+        yx = cat
+
     if squeeze:
         return yx, n.squeeze(), f.squeeze()
     else:
         return yx, n, f
 
+def apphot_series(files, coords, rap, filename, bgap=None, centroid=True,
+                  cfunc=None, ckwargs={}, time_key='DATE-OBS', nthreads=4,
+                  overwrite=False, **kwargs):
+    """Aperture photometry of a catalog of sources in a series of images.
+
+    Each image is processed as in `apphot_by_wcs`, using the WCS of
+    its own FITS header.  Images are processed in parallel and the
+    results are appended to a FITS file, one table extension per
+    image, as they are completed.  Re-running the same command after
+    an interruption skips the images already in the file.
+
+    Parameters
+    ----------
+    files : list of strings
+      The FITS files to measure.  The first extension with data is
+      used.
+    coords : astropy SkyCoord
+      The coordinates of the sources.  Only sources at least
+      `2 * max(rap)` from the edges of an image are measured.
+    rap : float or array
+      Aperture radii.  [pixels]
+    filename : string
+      The name of the output FITS file.
+    bgap : array, optional
+      Inner and outer radii of a background annulus, measured with
+      `bgphot`.  [pixels]
+    centroid : bool, optional
+      Set to `True` to centroid on each source with `cfunc`.
+    cfunc : function, optional
+      The centroiding function to use, or `None` to center all sources
+      at once with `gcentroid_batch`.
+    ckwargs: dict
+      Any `cfunc` keyword arguments.
+    time_key : string, optional
+      Copy this header keyword into the results.
+    nthreads : int, optional
+      The number of images to process at a time.
+    overwrite : bool, optional
+      Set to `True` to replace `filename`, rather than resume.
+    **kwargs:
+      Any `apphot` keyword arguments.
+
+    Returns
+    -------
+    n : int
+      The number of images measured.
+
+    Notes
+    -----
+    Each table has columns `source` (the index into `coords`), `y`,
+    `x`, `flags` (1 for a failed centroid), `n`, and `flux` (the
+    aperture areas and photometry, one element for each aperture).
+    With `bgap`, the tables also have `nbg`, `bg`, and `bgsig`, from
+    `bgphot`.  The table headers record the image file name and
+    observation time in `FILENAME` and `TIME`.  Read the results with
+    `read_apphot_series`.
+
+    Sources are converted to pixel positions once for each distinct
+    set of WCS header keywords.
+
+    """
+
+    import os
+    from multiprocessing.pool import ThreadPool
+    from astropy.io import fits
+
+    if overwrite and os.path.exists(filename):
+        os.remove(filename)
+
+    done = _apphot_series_done(filename)
+    todo = [(i, f) for i, f in enumerate(files) if f not in done]
+    if not os.path.exists(filename):
+        fits.PrimaryHDU().writeto(filename)
+
+    wcs_cache = dict()
+    def measure(args):
+        return _apphot_series_frame(
+            args[0], args[1], coords, rap, bgap, centroid, cfunc, ckwargs,
+            time_key, wcs_cache, **kwargs)
+
+    pool = ThreadPool(nthreads)
+    try:
+        for hdu in pool.imap(measure, todo):
+            fits.append(filename, hdu.data, hdu.header)
+    finally:
+        pool.terminate()
+
+    return len(todo)
+
 def azavg(im, yx, raps=None, subsample=4, **kwargs):
     """Create an aziumthally averaged image.
 
@@ -311,6 +424,7 @@ def azavg(im, yx, raps=None, subsample=4, **kwargs):
     kind = kwargs.pop('kind', 'zero')
     bounds_error = kwargs.pop('bounds_error', False)
 
+    im = np.asarray(im)
     r = core.rarray(im.shape, yx, subsample=10)
 
     if raps is None:
@@ -320,7 +434,7 @@ def azavg(im, yx, raps=None, subsample=4, **kwargs):
         maxr = int(r.max()) + 1
         raps = np.logspace(0, np.log2(maxr), raps, base=2)
 
-    n, f = anphot(im, yx, raps, subsample=subsample)
+    n, f = _annulus_sums(im, yx, raps, subsample)[:2]
     n, f, raps = takefrom((n, f, raps), n != 0)
 
     f /= n
@@ -333,20 +447,27 @@ def azavg(im, yx, raps=None, subsample=4, **kwargs):
 
     return aa
 
-def bgfit(im, unc=None, order=1, mask=True):
+def bgfit(im, unc=None, order=1, mask=True, cross=False, step=1):
     """Fit an image background.
 
     Parameters
     ----------
     im : array
-      The image.
+      The image, or a cube of images, in which case each image is
+      fit separately.
     unc : array, optional
-      Image uncertainties as a 2D array.
+      Image uncertainties with the same shape as `im`.
     order : int
       The polynomial order (in one dimension) of the fitting function.
     mask : array, optional
       A pixel mask, where `True` indicates background pixels.  NaNs
       are always ignored.
+    cross : bool, optional
+      Set to `True` to include the cross terms, `y**i * x**j` with
+      `i + j <= order`, in the fit.
+    step : int, optional
+      Fit every `step`th pixel along each axis, which is much faster
+      for large images with smooth backgrounds.
 
     Returns
     -------
@@ -355,33 +476,54 @@ def bgfit(im, unc=None, order=1, mask=True):
 
     """
 
-    mask *= np.isfinite(im)
-
-    # yy and xx are the coordinates for the original image, y and x
-    # are the coordinates in the flux array
-    yy, xx = np.indices(im.shape)
-    x = xx[mask]
-    y = yy[mask]
-
-    # the flux array: u
-    u = im[mask]
-
-    # the uncertanty array: v
-    if unc is None:
-        v = np.ones_like(u)
-    else:
-        v = unc[mask]
-
-    cx, cy, cov = polyfit2d(u, y, x, unc=v, order=order)
-    bg = np.polyval(cy, yy) + np.polyval(cx, xx)
+    im = np.asarray(im)
+    stack = im.reshape((-1, ) + im.shape[-2:])
+    ny, nx = im.shape[-2:]
+
+    # only the fitted pixels are gathered: y and x are their
+    # coordinates, u the fluxes, and w the weights
+    y, x = np.meshgrid(np.arange(0, ny, step), np.arange(0, nx, step),
+                       indexing='ij')
+    y = y.ravel()
+    x = x.ravel()
+    u = stack[:, ::step, ::step]
+    mask = np.asarray(mask, bool)
+    if mask.ndim >= 2:
+        mask = mask[..., ::step, ::step]
+    w = (np.ones(u.shape, bool) * mask * np.isfinite(u)).astype(float)
+    w = w.reshape((len(stack), -1))
+    u = u.reshape(w.shape)
+    if unc is not None:
+        v = np.asarray(unc, float)
+        if v.ndim >= 2:
+            v = v[..., ::step, ::step]
+        w /= (np.ones(stack[:, ::step, ::step].shape) * v).reshape(
+            w.shape)**2
+    u = np.where(w > 0, u, 0)
+
+    A = _polyfit2d_design(y, x, order, cross)
+    c = _lstsq_batch(A, u, w)[0]
+
+    # evaluate the surface separably: bg = Vy C Vx^T, where C[i, j]
+    # is the coefficient of y**i * x**j
+    C = np.zeros((len(c), order + 1, order + 1))
+    for k in range(len(c)):
+        if cross:
+            C[k] = _polyfit2d_unpack(c[k], order)
+        else:
+            C[k, :, 0] = c[k, order::-1]
+            C[k, 0, :] += c[k, :order:-1]
+    Vy = np.arange(ny, dtype=float)[:, np.newaxis]**np.arange(order + 1)
+    Vx = np.arange(nx, dtype=float)[:, np.newaxis]**np.arange(order + 1)
+    bg = np.dot(np.dot(Vy, C).transpose(1, 0, 2), Vx.T)
 
-    return bg
+    return bg.reshape(im.shape)
 
 def bgphot(im, yx, rap, ufunc=np.mean, squeeze=True, **kwargs):
     """Background photometry and error analysis in an annulus.
 
-    Pixels are not sub-sampled.  The annulus is processed via
-    `util.uclip`.
+    Pixels are not sub-sampled.  The annulus is sigma clipped as in
+    `util.meanclip`, for all sources and images at once.
 
     Parameters
     ----------
@@ -399,12 +541,14 @@ def bgphot(im, yx, rap, ufunc=np.mean, squeeze=True, **kwargs):
       Set to `True` to sqeeze single length dimensions out of the
       results.
     **kwargs :
-      Keyword arguments passed to `util.uclip`.
+      `lsig`, `hsig`, `maxiter`, or `minfrac`, as for
+      `util.meanclip`.
 
     Returns
     -------
     n : ndarray
-      The number of pixels for each aperture.
+      The number of pixels for each aperture, after clipping the
+      last image.
     bg : ndarray
       The background level in the annulus, shape `(len(yx),)` or
       `(len(im), len(yx))`.
@@ -414,9 +558,7 @@ def bgphot(im, yx, rap, ufunc=np.mean, squeeze=True, **kwargs):
 
     """
 
-    from ..util import uclip
-
-    _im = np.array(im)
+    _im = np.asarray(im)
     assert _im.ndim in [2, 3], ("Only images, data cubes, or tuples/lists"
                                 " of images are allowed.")
     if _im.ndim == 2:
@@ -433,19 +575,8 @@ def bgphot(im, yx, rap, ufunc=np.mean, squeeze=True, **kwargs):
     rap = np.array(rap, float)
     assert rap.shape == (2,), "rap has incorrect shape."
 
-    sz = _im.shape[-2:]
-
-    n = np.zeros(len(yx))
-    bg, sig = np.zeros((2, len(_im), len(yx)))
-
-    for i in range(len(yx)):
-        r = core.rarray(sz, yx=yx[i], subsample=10)
-        annulus = (r >= rap.min()) * (r <= rap.max())
-        for j in range(len(_im)):
-            f = _im[j][annulus]
-            bg[j, i], k, niter = uclip(f, ufunc, full_output=True, **kwargs)
-            n[i] = len(k)
-            sig[j, i] = np.std(f[k])
+    index = _annulus_index(_im.shape[-2:], yx, rap)
+    n, bg, sig = _bgphot_clipped(_im, index, ufunc, **kwargs)
 
     if squeeze:
         return n.squeeze(), bg.squeeze(), sig.squeeze()
@@ -522,7 +653,144 @@ def centroid(im, yx=None, box=None, niter=1, shrink=True, silent=True):
 
     return cyx
 
-def find(im, sigma=None, thresh=2, centroid=None, fwhm=2, **kwargs):
+def detect(im, sigma=None, thresh=2, fwhm=2, box=None, niter=1,
+           shrink=True):
+    """Detect sources in an image, and measure their basic properties.
+
+    Detections are labeled with `scipy.ndimage`, then fluxes, moments,
+    and bounding boxes are computed for all sources at once with
+    labeled reductions.  Centers are refined with `gcentroid_batch`.
+    Generally designed for point-ish sources.
+
+    Parameters
+    ----------
+    im : array
+      The image to search.
+    sigma : float, optional
+      The 1-sigma uncertainty in the background, or `None` to estimate
+      the uncertainty with the sigma-clipped mean and standard
+      deviation of `meanclip`.  If provided, then the image should be
+      background subtracted.
+    thresh : float, optional
+      The detection threshold in sigma.  If a pixel is detected above
+      `sigma * thresh`, it is an initial source candidate.
+    fwhm : int, optional
+      A rough estimate of the FWHM of a source, used for binary
+      morphology operations.
+    box : int, optional
+      The centroiding box size for `gcentroid_batch`, or `None` to use
+      `4 * fwhm + 1`.  Set to 0 to skip centroid refinement.
+    niter : int, optional
+      The number of `gcentroid_batch` iterations.
+    shrink : bool, optional
+      When iterating, decrease the box size by sqrt(2) each time.
+
+    Returns
+    -------
+    cat : ndarray
+      A structured array with one row per source and the fields:
+        `y`, `x` : the source center;
+        `ym`, `xm` : the first moments of the source;
+        `y2`, `x2`, `xy` : the second central moments;
+        `flux` : the total flux in the detection footprint (a
+          background estimate is removed if `sigma` is `None`);
+        `peak` : the peak pixel value;
+        `npix` : the number of pixels in the footprint;
+        `ymin`, `ymax`, `xmin`, `xmax` : the bounding box of the
+          footprint, i.e., `im[ymin:ymax, xmin:xmax]`;
+        `flags` : a bitwise combination of 1 - the footprint
+          contains non-finite pixels, 2 - the Gaussian centroid
+          failed, and `y`, `x` are the first moments, 4 - the center
+          is outside of the bounding box.
+
+    """
+
+    import scipy.ndimage as nd
+    from ..util import meanclip
+
+    assert isinstance(fwhm, int), 'FWHM must be integer'
+
+    _im = np.array(im, float)
+
+    if sigma is None:
+        stats = meanclip(_im, full_output=True)[:2]
+        _im -= stats[0]
+        sigma = stats[1]
+
+    with np.errstate(invalid='ignore'):
+        det = _im > thresh * sigma
+    det = nd.binary_erosion(det, iterations=fwhm)  # remove small objects
+    det = nd.binary_dilation(det, iterations=fwhm * 2 + 1)  # grow aperture size
+    label, n = nd.label(det)
+
+    cat = np.zeros(n, dtype=[
+        ('y', float), ('x', float), ('ym', float), ('xm', float),
+        ('y2', float), ('x2', float), ('xy', float), ('flux', float),
+        ('peak', float), ('npix', int), ('ymin', int), ('ymax', int),
+        ('xmin', int), ('xmax', int), ('flags', int)])
+    if n == 0:
+        return cat
+
+    # all footprint pixels, grouped by label
+    k = np.flatnonzero(label)
+    lab = label.ravel()[k]
+    i = np.argsort(lab, kind='mergesort')
+    k = k[i]
+    lab = lab[i] - 1
+    y, x = np.divmod(k, _im.shape[1])
+    f = _im.ravel()[k]
+
+    finite = np.isfinite(f)
+    f[~finite] = 0
+    w = np.maximum(f, 0)
+
+    def total(a):
+        return np.bincount(lab, a, minlength=n)
+
+    cat['npix'] = np.bincount(lab, minlength=n)
+    cat['flux'] = total(f)
+    cat['flags'] |= 1 * (total(~finite) > 0)
+
+    W = total(w)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cat['ym'] = total(w * y) / W
+        cat['xm'] = total(w * x) / W
+        cat['y2'] = total(w * y**2) / W - cat['ym']**2
+        cat['x2'] = total(w * x**2) / W - cat['xm']**2
+        cat['xy'] = total(w * x * y) / W - cat['xm'] * cat['ym']
+
+    start = np.r_[0, np.cumsum(cat['npix'])[:-1]]
+    cat['peak'] = np.maximum.reduceat(np.where(finite, f, -np.inf), start)
+    cat['ymin'] = np.minimum.reduceat(y, start)
+    cat['ymax'] = np.maximum.reduceat(y, start) + 1
+    cat['xmin'] = np.minimum.reduceat(x, start)
+    cat['xmax'] = np.maximum.reduceat(x, start) + 1
+
+    cat['y'] = cat['ym']
+    cat['x'] = cat['xm']
+    if box is None:
+        box = 4 * fwhm + 1
+
+    if box > 0:
+        j = np.flatnonzero((cat['flags'] & 1) == 0)
+        cyx, good = gcentroid_batch(_im, np.c_[cat['ym'], cat['xm']][j],
+                                    box=box, niter=niter, shrink=shrink)
+        cat['y'][j[good]] = cyx[good, 0]
+        cat['x'][j[good]] = cyx[good, 1]
+        cat['flags'][j[~good]] |= 2
+
+    with np.errstate(invalid='ignore'):
+        outside = ((cat['y'] < cat['ymin'] - 0.5)
+                   + (cat['y'] > cat['ymax'] - 0.5)
+                   + (cat['x'] < cat['xmin'] - 0.5)
+                   + (cat['x'] > cat['xmax'] - 0.5)
+                   + ~np.isfinite(cat['y']) + ~np.isfinite(cat['x']))
+    cat['flags'] |= 4 * outside
+
+    return cat
+
+def find(im, sigma=None, thresh=2, centroid=None, fwhm=2, catalog=False,
+         **kwargs):
     """Find sources in an image.
 
     Generally designed for point-ish sources.
@@ -540,14 +808,21 @@ def find(im, sigma=None, thresh=2, centroid=None, fwhm=2, **kwargs):
       The detection threshold in sigma.  If a pixel is detected above
       `sigma * thresh`, it is an initial source candidate.
     centroid : function, optional
-      The centroiding function, or `None` to use `gcentroid`.  The
-      function is passed a subsection of the image.  All other
-      parameters are provided via `kwargs`.
+      The centroiding function, or `None` to centroid all sources at
+      once with `detect`.  The function is passed a subsection of the
+      image.  All other parameters are provided via `kwargs`.
     fwhm : int, optional
       A rough estimate of the FWHM of a source, used for binary
       morphology operations.
+    catalog : bool, optional
+      Set to `True` to return a `catalogs.SourceCatalog` instead.
+      When `centroid` is `None`, the catalog has all `detect`
+      columns.
     **kwargs
-      Any keyword arguments for `centroid`.
+      Any keyword arguments for `centroid`, or `detect` when
+      `centroid` is `None`.  For backwards compatibility, `gcentroid`
+      keywords are also accepted: `box`, `niter`, and `shrink` are
+      passed on to `detect`, and `yx` and `silent` are ignored.
 
     Returns
     -------
@@ -557,13 +832,33 @@ def find(im, sigma=None, thresh=2, centroid=None, fwhm=2, **kwargs):
       An array of approximate source fluxes (a background estimate is
       removed if `sigma` is `None`).
 
+    or, if `catalog` is `True`:
+
+    cat : SourceCatalog
+      The sources, with `y`, `x`, and `flux` columns.
+
     """
     
     import scipy.ndimage as nd
     from ..util import meanclip
+    from ..catalogs import SourceCatalog
 
     assert isinstance(fwhm, int), 'FWHM must be integer'
 
+    if centroid is None:
+        # find used gcentroid on each source before detect
+        kwargs.pop('yx', None)
+        kwargs.pop('silent', None)
+        if np.iterable(kwargs.get('box')):
+            kwargs['box'] = int(max(kwargs['box']))
+        cat = detect(im, sigma=sigma, thresh=thresh, fwhm=fwhm, **kwargs)
+        good = cat['flags'] == 0
+        print('[find] {} good, {} bad sources'.format(
+            good.sum(), (~good).sum()))
+        if catalog:
+            return SourceCatalog.from_records(cat[good])
+        return np.c_[cat['y'], cat['x']][good], cat['flux'][good]
+
     _im = im.copy()
 
     if sigma is None:
@@ -571,9 +866,6 @@ def find(im, sigma=None, thresh=2, centroid=None, fwhm=2, **kwargs):
         _im -= stats[0]
         sigma = stats[1]
 
-    if centroid is None:
-        centroid = gcentroid
-
     det = _im > thresh * sigma
     det = nd.binary_erosion(det, iterations=fwhm)  # remove small objects
     det = nd.binary_dilation(det, iterations=fwhm * 2 + 1)  # grow aperture size
@@ -613,7 +905,10 @@ def find(im, sigma=None, thresh=2, centroid=None, fwhm=2, **kwargs):
         f.append(star.sum())
 
     print('[find] {} good, {} bad sources'.format(len(yx), bad))
-    return np.array(yx), np.array(f)
+    yx = np.array(yx).reshape((-1, 2))
+    if catalog:
+        return SourceCatalog.from_array(yx.T, flux=np.array(f))
+    return yx, np.array(f)
 
 def fwhm(im, yx, bg=True, **kwargs):
     """Compute the FWHM of an image.
@@ -656,6 +951,74 @@ def fwhm(im, yx, bg=True, **kwargs):
 
     return abs(fit[0]) * 2.35
 
+def fwhm_batch(im, yx, box=15, bg=True, maxiter=20):
+    """Compute the FWHMs of many sources at once.
+
+    A stamp around each source is extracted into a single array, and
+    the radius of each stamp pixel is computed for all sources at
+    once.  Gaussian profiles are fit to the unbinned radial profiles
+    of all sources together with a damped Gauss-Newton solver,
+    initialized with the moments of each profile.  NaNs, and stamp
+    pixels beyond the edges of the image, are ignored.
+
+    Parameters
+    ----------
+    im : ndarray
+      The image to fit.
+    yx : array
+      The `(y, x)` center of a source, or an `Nx2` array of centers.
+    box : int, optional
+      The size of the box over which to measure each source.
+    bg : bool, optional
+      Set to `True` to fit a constant background along with each
+      Gaussian.
+    maxiter : int, optional
+      The maximum number of Gauss-Newton steps.
+
+    Returns
+    -------
+    fwhm : ndarray
+      The FWHM of each radial profile.
+    amp : ndarray
+      The peak of each Gaussian.
+    bg : ndarray
+      The background level, or zeros if `bg` is `False`.
+    good : ndarray
+      `True` for each source that was successfully fit.
+    summary : tuple
+      The median FWHM of the good sources, the standard deviation
+      estimated from the median absolute deviation, and the number of
+      good sources.
+
+    """
+
+    yx = np.array(yx, float).reshape((-1, 2))
+    halfbox = int(box) // 2
+    stamps, origin = _stamps(im, yx, np.array((halfbox, halfbox)))
+
+    # radial profiles of all sources: the stamp pixel offsets are
+    # shared, only the sub-pixel centers differ
+    d = np.arange(2 * halfbox + 1)
+    dyx = yx - origin
+    r = np.sqrt((d[:, None] - dyx[:, 0, None, None])**2
+                + (d - dyx[:, 1, None, None])**2)
+    N = len(yx)
+    R = r.reshape((N, -1))
+    f = stamps.reshape((N, -1))
+    w = np.isfinite(f).astype(float)
+
+    sigma, amp, b, good = _rgfit_batch(R, f, w, bg, maxiter=maxiter)
+    good *= sigma < halfbox
+    fw = sigma * 2 * np.sqrt(2 * np.log(2))
+
+    if np.any(good):
+        m = np.median(fw[good])
+        mad = 1.4826 * np.median(np.abs(fw[good] - m))
+    else:
+        m, mad = np.nan, np.nan
+
+    return fw, amp, b, good, (m, mad, good.sum())
+
 def gcentroid(im, yx=None, box=None, niter=1, shrink=True, silent=True):
     """Centroid (x-/y-cut Gaussian fit) of an image.
 
@@ -768,6 +1131,94 @@ def gcentroid(im, yx=None, box=None, niter=1, shrink=True, silent=True):
 
     return cyx
 
+def gcentroid_batch(im, yx, box=7, niter=1, shrink=True, maxiter=20):
+    """Centroid many sources at once by x-/y-cut Gaussian fits.
+
+    A vectorized version of `gcentroid`.  A stamp around each source
+    is extracted into a single array, the marginal sums are computed,
+    and all 1D Gaussians are fit together with a damped Gauss-Newton
+    solver, initialized with the moments of each profile.  NaNs, and
+    stamp pixels beyond the edges of the image, are ignored.
+
+    Parameters
+    ----------
+    im : ndarray
+      A 2D image on which to centroid.
+    yx : array
+      `(y, x)` guess for the centroid, or an `Nx2` array of guesses.
+    box : int or array, optional
+      The size of the box over which to compute each centroid.  This
+      may be an integer, or an array (height, width).
+    niter : int, optional
+      Iterate `niter` times, re-centering the boxes each time.
+    shrink : bool, optional
+      When iterating, decrease the box size by sqrt(2) each time.
+    maxiter : int, optional
+      The maximum number of Gauss-Newton steps per fit.
+
+    Returns
+    -------
+    cyx : ndarray
+      The computed centers.  The lower-left corner of a pixel is -0.5,
+      -0.5.  Sources that could not be centered retain their last
+      good position.
+    good : ndarray
+      `True` for each source that was successfully centered.
+
+    """
+
+    yx = np.array(yx, float)
+    assert yx.ndim in [1, 2], "yx must be one or two dimensional."
+    squeeze = yx.ndim == 1
+    cyx = yx.reshape((-1, 2)).copy()
+    good = np.isfinite(cyx).all(1)
+
+    box = np.array(box, int)
+    if box.size == 1:
+        box = np.array((box, box)).reshape((2,))
+
+    for i in range(niter):
+        halfbox = box // 2
+        if any(halfbox < 1):
+            break
+
+        j = np.flatnonzero(good)
+        stamps, origin = _stamps(im, cyx[j], halfbox)
+
+        # marginal sums; rows/columns without any valid pixels are
+        # given zero weight
+        valid = np.isfinite(stamps)
+        _stamp = np.where(valid, stamps, 0)
+        fy = _stamp.sum(2)
+        fx = _stamp.sum(1)
+        wy = valid.any(2).astype(float)
+        wx = valid.any(1).astype(float)
+
+        if fy.shape[1] == fx.shape[1]:
+            p, ok = _gfit_batch(np.r_[fy, fx], np.r_[wy, wx],
+                                maxiter=maxiter)
+            py, px = p[:len(j)], p[len(j):]
+            ok = ok[:len(j)] * ok[len(j):]
+        else:
+            py, oky = _gfit_batch(fy, wy, maxiter=maxiter)
+            px, okx = _gfit_batch(fx, wx, maxiter=maxiter)
+            ok = oky * okx
+
+        cyx[j[ok]] = origin[ok] + np.c_[py[ok, 1], px[ok, 1]]
+        good[j[~ok]] = False
+
+        if shrink:
+            box = (halfbox * 2 / np.sqrt(2)).round().astype(int)
+            box = box + (box % 2 - 1)  # keep it odd
+
+        if max(box) < 2:
+            break
+
+    if squeeze:
+        return cyx[0], good[0]
+    else:
+        return cyx, good
+
 def imstat(im, **kwargs):
     """Get some basic statistics from an array.
 
@@ -829,7 +1280,7 @@ def linecut(im, yx, width, length, pa, subsample=4):
       `width` x `width` along position angle `pa`, spanning a total
       length of `length`.  If `length` is an array, it specifies the
       bin edges along `pa`, each bin having a width of `width`.
-    pa : float
+    pa : float or array
       Position angle measured counter-clockwise from the
       x-axis. [degrees]
     subsample : int, optional
@@ -840,15 +1291,23 @@ def linecut(im, yx, width, length, pa, subsample=4):
     x : ndarray
       The centers of the bins, measured along the line cut.
     n : ndarray
-      The number of pixels per bin.
+      The number of pixels per bin.  If `pa` is an array, the first
+      axis iterates over position angle.
     f : ndarray
-      The line cut photometry.
-      
+      The line cut photometry.  If `pa` is an array, the first axis
+      iterates over position angle.
+
+    Notes
+    -----
+    Only the part of the image that bounds the line cuts is
+    sub-sampled, and the bin of each pixel is computed once for all
+    images.
+
     """
 
     from ..util import midstep
 
-    _im = np.array(im)
+    _im = np.asarray(im)
     ndim = _im.ndim  # later, we will flatten the images
     assert ndim in [2, 3], ("Only images, data cubes, or tuples/lists"
                             " of images are allowed.")
@@ -856,72 +1315,45 @@ def linecut(im, yx, width, length, pa, subsample=4):
     yx = np.array(yx, float)
     assert yx.shape == (2,), "yx has incorrect shape."
 
-    if subsample > 1:
-        if ndim == 3:
-            _im = np.array([core.rebin(x, subsample, flux=True) for x in _im])
-        else:
-            _im = core.rebin(_im, subsample, flux=True)
-        
-        yx = yx * subsample + (subsample - 1) / 2.0
-
-    sz = _im.shape[-2:]
-
-    # x is parallel to length, y is perpendicular to it
-    a = np.radians(pa)
-
-    x = core.xarray(sz, yx, rot=a, dtype=float) / subsample
-    y = np.abs(core.yarray(sz, yx, rot=a, dtype=float) / subsample)
-
     if np.iterable(length):
         Nbins = len(length) - 1
-        xap = np.array(length)
+        xap = np.array(length, float)
     else:
         # carefully set up the bins along x, the first bin is thrown away
         Nbins = int(np.floor(length / float(width)))
         xap = width * (np.arange(Nbins + 1) - Nbins / 2.0)
 
-    # line cut photometry via histograms, histogram via digitize() to
-    # save CPU time when mulitiple images are passed
+    subsample = max(subsample, 1)
+    _im, j, bins = _linecut_bins(_im, yx, width, xap, np.atleast_1d(pa),
+                                 subsample)
 
-    # flatten all arrays for digitize
-    x = x.flatten()
-    y = y.flatten()
-    if ndim == 3:
-        N = _im.shape[0]
-        M = _im.shape[1] * _im.shape[2]
-        _im = _im.flatten().reshape((N, M))
-    else:
-        _im = _im.flatten()
+    # line cut photometry via histograms, one bincount per image
+    size = np.size(pa) * Nbins
+    n = np.bincount(bins, minlength=size).astype(float)
+    n /= float(subsample**2)
+    _im = _im.reshape((-1, _im.shape[-2] * _im.shape[-1]))[:, j]
+    f = np.array([np.bincount(bins, weights=x, minlength=size)
+                  for x in _im])
 
-    # Bin data with digitize().  Note that bin 0 is to the left of our
-    # line cut.  We will discard this bin below.
-    bins = np.digitize(x, xap)
-    n = np.zeros(Nbins)
+    n = n.reshape(np.shape(pa) + (Nbins, ))
     if ndim == 3:
-        f = np.zeros((len(_im), Nbins))
-        for i in range(Nbins):
-            ap = (bins == (i + 1)) * (y < width / 2.0)
-            j = np.flatnonzero(ap)
-            n[i] = len(j)
-            f[:, i] = np.sum(_im[:, j], 1)
+        f = f.reshape((len(f), ) + n.shape)
+        if np.ndim(pa) > 0:
+            f = np.rollaxis(f, 1)
     else:
-        f = np.zeros(Nbins)
-        for i in range(Nbins):
-            ap = (bins == (i + 1)) * (y < width / 2.0)
-            j = np.flatnonzero(ap)
-            n[i] = len(j)
-            f[i] = np.sum(_im[j])
+        f = f.reshape(n.shape)
 
-    n /= float(subsample**2)
     return midstep(xap), n, f
 
-def polyfit2d(f, y, x, unc=None, order=1):
+def polyfit2d(f, y, x, unc=None, order=1, cross=False):
     """Fit a polynomial surface to 2D data.
 
-    Assumes the axes are independent of each other.
-
+    By default, assumes the axes are independent of each other.
     Evaluate the fit via: np.polyval(polyy, y) + np.polyval(polyx, x).
 
+    With `cross=True`, the fit includes the cross terms, and is
+    evaluated via: np.polynomial.polynomial.polyval2d(y, x, c).
+
     Parameters
     ----------
     f : array
@@ -933,46 +1365,56 @@ def polyfit2d(f, y, x, unc=None, order=1):
       all points.  If `None`, then 1 is assumed.
     order : int, optional
       The polynomial order (in one dimension) of the fit.
+    cross : bool, optional
+      Set to `True` to include the cross terms, `y**i * x**j` with
+      `i + j <= order`.
 
     Returns
     -------
     polyx, polyy : ndarray
       The polynomial coefficients, in the same format as from
-      `np.polyfit`.
-
+      `np.polyfit`.  Only returned when `cross` is `False`.
+    c : ndarray
+      The `(order + 1, order + 1)` coefficients for
+      `np.polynomial.polynomial.polyval2d`, where `c[i, j]` is the
+      coefficient of `y**i * x**j`.  Only returned when `cross` is
+      `True`.
     cov : ndarray
       The covariance matrix.
 
+    Notes
+    -----
+    The model is linear in its coefficients, and is fit with a
+    weighted linear least-squares solution of the Vandermonde system.
+    Without cross terms, the constant is split equally between
+    `polyx` and `polyy`.
+
     v1.0.0 Written by Michael S. Kelley, UMD, Mar 2009
     """
 
-    from scipy.optimize import leastsq as lsq
-
-    # the fitting function
-    def chi(p, y, x, f, unc, order):
-        cy = p[:1+order]
-        cx = p[1+order:]
-        model = np.zeros(f.shape) + np.polyval(cy, y) + np.polyval(cx, x)
-        chi = (f - model) / unc
-        return chi
-
+    f = np.ravel(f)
+    y = np.ravel(y)
+    x = np.ravel(x)
     if unc is None:
         unc = 1.0
+    w = np.ones(f.shape) / np.asarray(unc, float)**2
+
+    A = _polyfit2d_design(y, x, order, cross)
+    c, cov = _lstsq_batch(A, f[np.newaxis], w[np.newaxis])
+    c = c[0]
+    cov = cov[0]
 
-    # run the fit
-    guess = np.zeros((order + 1) * 2)
-    result = lsq(chi, guess, args=(y, x, f, unc, order), full_output=True)
-    fit = result[0]
-    cov = result[1]
-    cy = fit[:1+order]
-    cx = fit[1+order:]
+    if cross:
+        return _polyfit2d_unpack(c, order), cov
 
+    cy = c[:1+order]
+    cx = c[1+order:]
     return cx, cy, cov
 
 def radprof(im, yx, bins=10, range=None, subsample=4):
     """Radial surface brightness profile of an image.
 
-    Profile is generated via `anphot`.
+    Profile is generated via annular photometry, as in `anphot`.
 
     Parameters
     ----------
@@ -1001,38 +1443,47 @@ def radprof(im, yx, bins=10, range=None, subsample=4):
 
     """
 
-    from ..util import midstep
+    im = np.asarray(im)
+    rap = _radprof_bins(im.shape, yx, bins, range)
+    n, f, rsum = _annulus_sums(im, yx, rap, subsample)
+    return _radprof_sb(rap, n, f, rsum)
 
-    if range is None:
-        yx = np.array(yx)
-        rmax = np.sqrt(max(
-                sum(yx**2),
-                sum((yx - np.r_[0, im.shape[1]])**2),
-                sum((yx - np.r_[im.shape[0], 0])**2),
-                sum((yx - np.r_[im.shape])**2)))
-        range = [0, int(rmax) + 1]
+def read_apphot_series(filename):
+    """Read the results of `apphot_series`.
 
-    if np.iterable(bins):
-        rap = bins
-    else:
-        rap = np.linspace(range[0], range[1], bins + 1)
+    Parameters
+    ----------
+    filename : string
+      The `apphot_series` output file.
 
-    r = core.rarray(im.shape, yx=yx, subsample=10)
-    n, f = anphot(im, yx, rap, subsample=subsample)
-    rmean = anphot(r, yx, rap, subsample=subsample)[1]
+    Returns
+    -------
+    tab : astropy Table
+      All measurements, with the additional columns `frame`, the
+      index of the image in the original file list, `filename`, and
+      `time`.
 
-    # flux -> surface brightness
-    i = n != 0
-    f[i] /= n[i]
-    rmean[i] /= n[i]
+    """
 
-    # first rap is really an inner edge, but anphot doesn't know that
-    n = n[1:]
-    f = f[1:]
-    rmean = rmean[1:]
-    rc = midstep(rap)
+    from astropy.io import fits
+    from astropy.table import Table, vstack
 
-    return rc, f, n, rmean
+    tables = []
+    with fits.open(filename) as hdulist:
+        for hdu in hdulist[1:]:
+            tab = Table(hdu.data)
+            tab.add_column(Table.Column([hdu.header['FRAME']] * len(tab),
+                                        name='frame'), index=0)
+            tab['filename'] = hdu.header['FILENAME']
+            tab['time'] = hdu.header.get('TIME', '')
+            tables.append(tab)
+
+    if len(tables) == 0:
+        return Table()
+
+    tab = vstack(tables)
+    tab.sort(['frame', 'source'])
+    return tab
 
 def trace(im, err, guess):
     """Trace the peak pixels along the second axis of an image.
@@ -1081,6 +1532,893 @@ def trace(im, err, guess):
 
     return y
 
+_annulus_cache = dict()
+def _annulus_weights(shape, yx, rap, subsample, maxsize=16):
+    """Annulus weights of each pixel, cached.
+
+    Pixels are sub-sampled as in `anphot`, but rather than binning a
+    sub-sampled image, the sub-pixels are collected into a sparse
+    matrix of the fraction of each pixel in each annulus.
+
+    Parameters
+    ----------
+    shape : tuple
+      The image shape.
+    yx : array
+      The center of the annuli.
+    rap : array
+      Aperture radii.  The inner-most aperture is the annulus 0 to
+      `rap[0]`.
+    subsample : int
+      The sub-pixel sampling factor.
+    maxsize : int, optional
+      Keep at most this many weight matrices in the cache.
+
+    Returns
+    -------
+    w : scipy.sparse.csr_matrix
+      `len(rap) x M` matrix of weights for the `M` pixels.
+    n : ndarray
+      The number of pixels per annulus.
+    rsum : ndarray
+      The sum of the radii of the pixels in each annulus.
+
+    """
+
+    from scipy import sparse
+
+    s = max(int(subsample), 1)
+    key = (tuple(shape), tuple(np.ravel(yx)),
+           tuple(np.ravel(rap).astype(float)), s)
+    if key in _annulus_cache:
+        return _annulus_cache[key]
+
+    nbins = len(rap)
+    ny, nx = shape
+    yxs = np.array(yx, float) * s + (s - 1) / 2.0
+
+    # Work through the image in bands of rows to limit memory use.
+    # Most pixels fall entirely within one annulus; only pixels that
+    # straddle an annulus edge are split into fractional weights.
+    rows, cols, weights = [], [], []
+    step = max(2**22 // (nx * s**2), 1)
+    for y0 in range(0, ny, step):
+        y1 = min(y0 + step, ny)
+        rs = core.rarray(((y1 - y0) * s, nx * s), subsample=10,
+                         yx=yxs - np.array((y0 * s, 0))) / float(s)
+        b = np.digitize(rs.ravel(), rap).reshape((y1 - y0, s, nx, s))
+        lo = b.min(3).min(1).ravel()
+        hi = b.max(3).max(1).ravel()
+        parent = np.arange(y0 * nx, y1 * nx)
+
+        i = np.flatnonzero((lo == hi) * (lo < nbins))
+        rows.append(lo[i])
+        cols.append(parent[i])
+        weights.append(np.ones(len(i)))
+
+        i = np.flatnonzero(lo != hi)
+        sub = b[i // nx, :, i % nx, :].reshape((len(i), s**2))
+        k = (np.arange(len(i))[:, np.newaxis] * (nbins + 1) + sub).ravel()
+        k, count = np.unique(k, return_counts=True)
+        j = k % (nbins + 1) < nbins
+        rows.append(k[j] % (nbins + 1))
+        cols.append(parent[i[k[j] // (nbins + 1)]])
+        weights.append(count[j] / float(s**2))
+
+    w = sparse.coo_matrix(
+        (np.concatenate(weights),
+         (np.concatenate(rows), np.concatenate(cols))),
+        shape=(nbins, ny * nx)).tocsr()
+
+    r = core.rarray(shape, yx=yx, subsample=10).ravel()
+    n = np.asarray(w.sum(1)).ravel()
+    rsum = w.dot(r)
+
+    if len(_annulus_cache) >= maxsize:
+        _annulus_cache.clear()
+    _annulus_cache[key] = w, n, rsum
+
+    return w, n, rsum
+
+def _annulus_sums(im, yx, rap, subsample):
+    """Annular photometry with cached annulus weights.
+
+    Parameters
+    ----------
+    im : ndarray
+      The image, or a cube of images.
+    yx : array
+      The center of the annuli.
+    rap : array
+      Aperture radii.
+    subsample : int
+      The sub-pixel sampling factor.
+
+    Returns
+    -------
+    n : ndarray
+      The number of pixels per annulus.
+    f : ndarray
+      The annular photometry, `len(rap)`, or `len(im) x len(rap)`.
+    rsum : ndarray
+      The sum of the radii of the pixels in each annulus.
+
+    """
+
+    w, n, rsum = _annulus_weights(im.shape[-2:], yx, rap, subsample)
+    f = w.dot(im.reshape((-1, w.shape[1])).T).T
+    if im.ndim == 2:
+        f = f[0]
+    return n.copy(), f, rsum.copy()
+
+_wcs_keywords = ('WCSAXES', 'CRPIX', 'CRVAL', 'CDELT', 'CD1_', 'CD2_',
+                 'PC1_', 'PC2_', 'CTYPE', 'CUNIT', 'CROTA', 'PV1_', 'PV2_',
+                 'A_', 'B_', 'AP_', 'BP_', 'LONPOLE', 'LATPOLE', 'RADESYS',
+                 'EQUINOX')
+
+def _apphot_series_frame(i, f, coords, rap, bgap, centroid, cfunc, ckwargs,
+                         time_key, wcs_cache, **kwargs):
+    """Photometry of one image for `apphot_series`."""
+
+    from astropy.io import fits
+    from astropy.wcs import WCS
+
+    im, h = fits.getdata(f, header=True)
+    im = np.asarray(im, float)
+
+    # pixel positions, cached by WCS
+    key = tuple((card.keyword, card.value) for card in h.cards
+                if card.keyword.startswith(_wcs_keywords))
+    if key not in wcs_cache:
+        x, y = coords.to_pixel(WCS(h))
+        wcs_cache[key] = np.c_[y, x]
+    yx = wcs_cache[key].copy()
+
+    max_rap = np.max(rap)
+    shape = im.shape
+    sources = np.flatnonzero((yx[:, 1] >= 2 * max_rap)
+                             * (yx[:, 1] <= (shape[1] - 2 * max_rap))
+                             * (yx[:, 0] >= 2 * max_rap)
+                             * (yx[:, 0] <= (shape[0] - 2 * max_rap)))
+    yx = yx[sources]
+
+    flags = np.zeros(len(sources), int)
+    if centroid and len(sources) > 0:
+        if cfunc is None:
+            cyx, good = gcentroid_batch(im, yx, **ckwargs)
+            yx[good] = cyx[good]
+            flags[~good] = 1
+        else:
+            for j in range(len(yx)):
+                try:
+                    yx[j] = cfunc(im, yx[j], **ckwargs)
+                except UnableToCenter:
+                    flags[j] = 1
+
+    nap = np.size(rap)
+    n, flux = np.zeros((2, len(sources), nap))
+    if len(sources) > 0:
+        n[:], flux[:] = apphot(im, yx, rap, squeeze=False, **kwargs)
+
+    columns = [fits.Column(name='source', format='K', array=sources),
+               fits.Column(name='y', format='D', array=yx[:, 0]),
+               fits.Column(name='x', format='D', array=yx[:, 1]),
+               fits.Column(name='flags', format='J', array=flags),
+               fits.Column(name='n', format='{}D'.format(nap), array=n),
+               fits.Column(name='flux', format='{}D'.format(nap),
+                           array=flux)]
+
+    if bgap is not None:
+        nbg, bg, bgsig = np.zeros((3, len(sources)))
+        if len(sources) > 0:
+            nbg[:], bg[:], bgsig[:] = bgphot(im, yx, bgap, squeeze=False)
+        columns += [fits.Column(name='nbg', format='D', array=nbg),
+                    fits.Column(name='bg', format='D', array=bg),
+                    fits.Column(name='bgsig', format='D', array=bgsig)]
+
+    hdu = fits.BinTableHDU.from_columns(columns)
+    hdu.header['FRAME'] = i, 'Index of the image in the file list'
+    hdu.header['FILENAME'] = f
+    if time_key in h:
+        hdu.header['TIME'] = h[time_key], 'From {}'.format(time_key)
+    return hdu
+
+def _apphot_series_done(filename):
+    """Images already measured by `apphot_series`.
+
+    An incomplete table, e.g., from an interrupted write, and any
+    following it are removed from the file.
+
+    """
+
+    import os
+    from astropy.io import fits
+
+    if not os.path.exists(filename):
+        return set()
+
+    done = []
+    hdus = []
+    complete = True
+    try:
+        with fits.open(filename, ignore_missing_end=True) as hdulist:
+            for hdu in hdulist:
+                if len(hdus) > 0:
+                    n = 0 if hdu.data is None else len(hdu.data)
+                    if n != hdu.header['NAXIS2']:
+                        complete = False
+                        break
+                    done.append(hdu.header['FILENAME'])
+                hdus.append(hdu.copy())
+    except Exception:
+        # truncated data may also fail to read
+        complete = False
+
+    if not complete:
+        # rewrite the good part of the file
+        if len(hdus) == 0:
+            hdus = [fits.PrimaryHDU()]
+        fits.HDUList(hdus).writeto(filename + '.tmp', overwrite=True)
+        os.rename(filename + '.tmp', filename)
+
+    return set(done)
+
+def _anphot_binned(im, r, rap):
+    """Annular photometry of flattened images, given a radius map.
+
+    Parameters
+    ----------
+    im : ndarray
+      `NxM` array of `N` flattened images.
+    r : ndarray
+      The radius of each of the `M` pixels.
+    rap : array
+      Aperture radii.
+
+    Returns
+    -------
+    n : ndarray
+      The number of pixels per annular bin.
+    f : ndarray
+      `N x len(rap)` array of annular photometry.
+
+    """
+    nbins = len(rap)
+    bins = np.digitize(np.ravel(r), rap)
+    n = np.bincount(bins, minlength=nbins + 1)[:nbins]
+    f = np.array([np.bincount(bins, x, minlength=nbins + 1)[:nbins]
+                  for x in im])
+    return n, f
+
+def _annulus_index(shape, yx, rap):
+    """Pixel indices of annuli.
+
+    Parameters
+    ----------
+    shape : tuple
+      The image shape.
+    yx : ndarray
+      `Nx2` array of annulus centers.
+    rap : array
+      Inner and outer radii of the annuli.  [pixels]
+
+    Returns
+    -------
+    index : ndarray
+      `N x M` array of flattened pixel indices, where `M` is the size
+      of the largest annulus.  Smaller annuli are padded with -1.
+
+    """
+
+    rmin, rmax = min(rap), max(rap)
+    h = int(np.ceil(rmax)) + 1
+    index = []
+    for i in range(len(yx)):
+        # only consider the box around the annulus
+        y0, x0 = np.round(yx[i]).astype(int) - h
+        y1, x1 = np.round(yx[i]).astype(int) + h + 1
+        y0, x0 = max(y0, 0), max(x0, 0)
+        y1, x1 = min(y1, shape[0]), min(x1, shape[1])
+        if y1 <= y0 or x1 <= x0:
+            index.append(np.zeros(0, int))
+            continue
+
+        r = core.rarray((y1 - y0, x1 - x0), subsample=10,
+                        yx=yx[i] - np.array((y0, x0)))
+        y, x = np.nonzero((r >= rmin) * (r <= rmax))
+        index.append((y + y0) * shape[1] + x + x0)
+
+    padded = -np.ones((len(yx), max([len(i) for i in index] + [1])), int)
+    for i in range(len(yx)):
+        padded[i, :len(index[i])] = index[i]
+    return padded
+
+def _bgphot_clipped(im, index, ufunc, lsig=3.0, hsig=3.0, maxiter=5,
+                    minfrac=0.001, chunk=2**20):
+    """Sigma-clipped annulus statistics for all images and sources.
+
+    Clipping follows `util.meanclip`, vectorized over images and
+    sources.
+
+    Parameters
+    ----------
+    im : ndarray
+      The images, `NxMxL`.
+    index : ndarray
+      The annulus pixels, from `_annulus_index`.
+    ufunc : function
+      See `bgphot`.
+    lsig, hsig, maxiter, minfrac :
+      See `util.meanclip`.
+    chunk : int, optional
+      Process at most this many pixels at a time.  Each pixel needs
+      about 40 bytes of working memory.
+
+    Returns
+    -------
+    n : ndarray
+      The number of pixels in each clipped annulus of the last image.
+    bg, sig : ndarray
+      The background level and standard deviation for each image and
+      source.
+
+    Notes
+    -----
+    Clipping about the median always keeps a contiguous range of the
+    sorted pixel values.  Each annulus is sorted once, and the clipped
+    range is tracked with its first and last indices.  Means and
+    variances of the range are computed from cumulative sums.
+
+    """
+
+    N = len(im)
+    n = np.zeros(len(index), int)
+    bg, sig = np.zeros((2, N, len(index))) + np.nan
+    step = max(chunk // max(index.size, 1), 1)
+    im = im.reshape((N, -1))
+    for i0 in range(0, N, step):
+        i1 = min(i0 + step, N)
+        f = np.array(im[i0:i1][:, index], float, copy=False)
+        f[:, index < 0] = np.nan
+
+        # sort, putting NaNs at the end; the good data are f[lo:hi]
+        f = np.sort(f, -1)
+        lo = np.zeros(f.shape[:2], int)
+        hi = np.isfinite(f).sum(-1)
+
+        # offset by the initial median for numerical stability
+        mid = _sorted_median(f, lo, hi)
+        f -= mid[..., np.newaxis]
+        z = np.zeros(f.shape[:2] + (1, ))
+        f0 = np.where(np.isfinite(f), f, 0)
+        s1 = np.concatenate((z, f0.cumsum(-1)), -1)
+        s2 = np.concatenate((z, (f0**2).cumsum(-1)), -1)
+        del f0
+
+        active = hi > 0
+        for j in range(maxiter):
+            ngood = hi - lo
+            m = np.maximum(ngood, 1).astype(float)
+            mean = (_take(s1, hi) - _take(s1, lo)) / m
+            var = (_take(s2, hi) - _take(s2, lo)) / m - mean**2
+            sd = np.sqrt(np.maximum(var, 0))[..., np.newaxis]
+            med = _sorted_median(f, lo, hi)[..., np.newaxis]
+
+            # keep the range (med - lsig * sd, med + hsig * sd)
+            with np.errstate(invalid='ignore'):
+                new_lo = np.maximum(lo, (f <= med - lsig * sd).sum(-1))
+                new_hi = np.minimum(hi, (f < med + hsig * sd).sum(-1))
+            nkeep = np.maximum(new_hi - new_lo, 0)
+
+            update = active * (nkeep > 0)
+            lo = np.where(update, new_lo, lo)
+            hi = np.where(update, new_hi, hi)
+            cutfrac = (ngood - nkeep) / np.maximum(ngood, 1).astype(float)
+            active = update * (cutfrac > minfrac)
+            if not np.any(active):
+                break
+
+        # final statistics on the good data
+        k = np.arange(f.shape[-1])
+        good = (k >= lo[..., np.newaxis]) * (k < hi[..., np.newaxis])
+        ngood = good.sum(-1)
+        m = np.maximum(ngood, 1).astype(float)
+        f0 = np.where(good, f, 0)
+        mean = f0.sum(-1) / m
+        f0 = np.where(good, f - mean[..., np.newaxis], 0)
+        sig[i0:i1] = np.sqrt((f0**2).sum(-1) / m)
+        del f0
+
+        if ufunc is np.mean:
+            bg[i0:i1] = mean + mid
+        elif ufunc is np.median:
+            bg[i0:i1] = _sorted_median(f, lo, hi) + mid
+        else:
+            for a in range(i1 - i0):
+                for b in range(len(index)):
+                    if hi[a, b] > lo[a, b]:
+                        bg[i0 + a, b] = ufunc(f[a, b, lo[a, b]:hi[a, b]]
+                                              + mid[a, b])
+
+        empty = ngood == 0
+        bg[i0:i1][empty] = np.nan
+        sig[i0:i1][empty] = np.nan
+        n = ngood[-1]
+
+    return n, bg, sig
+
+def _sorted_median(f, lo, hi):
+    """Median of `f[..., lo:hi]`, for `f` sorted along the last axis."""
+    n = hi - lo
+    a = _take(f, lo + np.maximum(n - 1, 0) // 2)
+    b = _take(f, lo + n // 2)
+    return np.where(n > 0, (a + b) / 2.0, np.nan)
+
+def _take(a, i):
+    """`a[..., i]`, for an index array `i` with shape `a.shape[:-1]`."""
+    i = np.minimum(i, a.shape[-1] - 1)
+    return np.take_along_axis(a, i[..., np.newaxis], -1)[..., 0]
+
+def _linecut_bins(im, yx, width, xap, pa, subsample):
+    """Line cut bin of each pixel.
+
+    Parameters
+    ----------
+    im : ndarray
+      The image or cube.
+    yx : ndarray
+      The center of the line cuts.
+    width : float
+      The width of the line cuts.
+    xap : ndarray
+      The bin edges along the line cuts.
+    pa : ndarray
+      The position angles of the line cuts. [degrees]
+    subsample : int
+      The sub-pixel sampling factor.
+
+    Returns
+    -------
+    sub : ndarray
+      The sub-sampled part of `im` that bounds the line cuts.
+    j : ndarray
+      The flattened indices of the pixels of `sub` in the line cuts.
+    bins : ndarray
+      The bin of each pixel, `Nbins * i + k` for the `k`th bin of the
+      `i`th position angle.
+
+    """
+
+    from ..util import rotmat
+
+    # bounding box of the line cuts
+    a = np.radians(pa)
+    h = width / 2.0
+    L = np.abs(xap).max()
+    hy = np.max(L * np.abs(np.sin(a)) + h * np.abs(np.cos(a)))
+    hx = np.max(L * np.abs(np.cos(a)) + h * np.abs(np.sin(a)))
+    y0 = int(min(max(np.floor(yx[0] - hy) - 1, 0), im.shape[-2]))
+    y1 = int(min(max(np.ceil(yx[0] + hy) + 2, 0), im.shape[-2]))
+    x0 = int(min(max(np.floor(yx[1] - hx) - 1, 0), im.shape[-1]))
+    x1 = int(min(max(np.ceil(yx[1] + hx) + 2, 0), im.shape[-1]))
+
+    sub = im[..., y0:y1, x0:x1]
+    yx = yx - np.array((y0, x0))
+    if subsample > 1:
+        if sub.ndim == 3:
+            sub = np.array([core.rebin(x, subsample, flux=True)
+                            for x in sub])
+        else:
+            sub = core.rebin(sub, subsample, flux=True)
+        yx = yx * subsample + (subsample - 1) / 2.0
+
+    # x is parallel to length, y is perpendicular to it
+    dy = core.yarray(sub.shape[-2:], yx, dtype=float).ravel() / subsample
+    dx = core.xarray(sub.shape[-2:], yx, dtype=float).ravel() / subsample
+
+    # Bin data with digitize().  Note that bin 0 is to the left of our
+    # line cut.  We will discard this bin below.
+    Nbins = len(xap) - 1
+    j = []
+    bins = []
+    for i in range(len(a)):
+        R = rotmat(a[i])
+        x = dx * R[0, 0] + dy * R[0, 1]
+        y = np.abs(dx * R[1, 0] + dy * R[1, 1])
+        b = np.digitize(x, xap)
+        k = np.flatnonzero((b > 0) * (b <= Nbins) * (y < h))
+        j.append(k)
+        bins.append(b[k] - 1 + Nbins * i)
+
+    return sub, np.concatenate(j), np.concatenate(bins)
+
+def _polyfit2d_design(y, x, order, cross):
+    """Vandermonde design matrix for `polyfit2d`.
+
+    Without cross terms, the columns are `y**order, ..., y**0,
+    x**order, ..., x**0`, i.e., as `np.polyval` coefficients.  With
+    cross terms, the columns are `y**i * x**j` for `i + j <= order`,
+    in the order of `_polyfit2d_unpack`.
+
+    """
+
+    y = np.asarray(y, float)
+    x = np.asarray(x, float)
+    if cross:
+        columns = [y**i * x**j for i, j in _polyfit2d_terms(order)]
+    else:
+        columns = ([y**i for i in range(order, -1, -1)]
+                   + [x**i for i in range(order, -1, -1)])
+    return np.array(columns).T
+
+def _polyfit2d_terms(order):
+    """Exponents `(i, j)` of the cross-term polynomial."""
+    return [(i, j) for i in range(order + 1) for j in range(order + 1 - i)]
+
+def _polyfit2d_unpack(c, order):
+    """Cross-term coefficients as a `polyval2d` coefficient array."""
+    c2 = np.zeros((order + 1, order + 1))
+    for k, (i, j) in enumerate(_polyfit2d_terms(order)):
+        c2[i, j] = c[k]
+    return c2
+
+def _lstsq_batch(A, f, w):
+    """Weighted linear least squares for many data sets.
+
+    Parameters
+    ----------
+    A : ndarray
+      `P x M` design matrix.
+    f : ndarray
+      `K x P` data to fit.
+    w : ndarray
+      `K x P` weights, i.e., inverse variances.  Points with zero
+      weight are ignored.
+
+    Returns
+    -------
+    c : ndarray
+      `K x M` coefficients.
+    cov : ndarray
+      `K x M x M` covariance matrices.
+
+    Notes
+    -----
+    Columns of the design matrix are normalized to improve the
+    conditioning of the problem.  Data sets that share weights are
+    solved together with one SVD-based `np.linalg.lstsq` call.
+    Degenerate columns yield the minimum-norm solution.
+
+    """
+
+    scale = np.sqrt((A**2).sum(0))
+    scale[scale == 0] = 1
+    An = A / scale
+
+    # group data sets by weights
+    groups = dict()
+    for k in range(len(f)):
+        groups.setdefault(w[k].tostring(), []).append(k)
+
+    c = np.zeros((len(f), A.shape[1]))
+    cov = np.zeros((len(f), A.shape[1], A.shape[1]))
+    for same in groups.values():
+        sw = np.sqrt(w[same[0]])
+        i = sw > 0
+        Aw = An[i] * sw[i, np.newaxis]
+        b = (f[same][:, i] * sw[i]).T
+        c[same] = np.linalg.lstsq(Aw, b, rcond=None)[0].T
+        cov[same] = np.linalg.pinv(np.dot(Aw.T, Aw))
+
+    c /= scale
+    cov /= scale[:, np.newaxis] * scale
+    return c, cov
+
+def _radprof_bins(shape, yx, bins, range):
+    """Radial bin edges for `radprof`."""
+    if range is None:
+        yx = np.array(yx)
+        rmax = np.sqrt(max(
+                sum(yx**2),
+                sum((yx - np.r_[0, shape[1]])**2),
+                sum((yx - np.r_[shape[0], 0])**2),
+                sum((yx - np.r_[shape])**2)))
+        range = [0, int(rmax) + 1]
+
+    if np.iterable(bins):
+        rap = bins
+    else:
+        rap = np.linspace(range[0], range[1], bins + 1)
+
+    return rap
+
+def _radprof_sb(rap, n, f, rmean):
+    """Convert `_annulus_sums` results into `radprof` results."""
+
+    from ..util import midstep
+
+    # flux -> surface brightness
+    i = n != 0
+    f[i] /= n[i]
+    rmean[i] /= n[i]
+
+    # first rap is really an inner edge, but anphot doesn't know that
+    n = n[1:]
+    f = f[1:]
+    rmean = rmean[1:]
+    rc = midstep(rap)
+
+    return rc, f, n, rmean
+
+def _rgfit_batch(R, f, w, bg=True, maxiter=20, tol=1e-6):
+    """Fit many radial profiles with Gaussians.
+
+    The model is `a * exp(-R**2 / 2 / sigma**2) + b`.
+
+    Parameters
+    ----------
+    R, f : ndarray
+      `NxM` arrays of the radii and values of `N` radial profiles.
+    w : ndarray
+      `NxM` array of weights, e.g., 1 for good pixels.  Zero weight
+      excludes a point.
+    bg : bool, optional
+      Set to `True` to fit the background `b`, otherwise it is zero.
+    maxiter : int, optional
+      The maximum number of iterations.
+    tol : float, optional
+      Stop when all relative parameter changes are below this value.
+
+    Returns
+    -------
+    sigma, a, b : ndarray
+      The best-fit parameters.
+    ok : ndarray
+      `True` for each successful fit.
+
+    """
+
+    w = np.asarray(w, float)
+    npar = 3 if bg else 2
+    f = np.where(w > 0, f, 0)
+
+    # initial guess: the background from the outer half of each
+    # profile, the peak from the inner-most points, and sigma from the
+    # area above half maximum, which is less sensitive to noise than
+    # the second moment
+    if bg:
+        outer = (w > 0) * (R >= np.median(R, 1)[:, None])
+        b = (np.sum(f * w * outer, 1)
+             / np.maximum(np.sum(w * outer, 1), 1))
+    else:
+        b = np.zeros(len(f))
+    inner = (w > 0) * (R <= np.min(np.where(w > 0, R, np.inf), 1)[:, None]
+                       + 1)
+    a = np.max(np.where(inner, f, -np.inf), 1) - b
+    a[~np.isfinite(a)] = 1.0
+    above = np.sum(w * (f - b[:, None] > a[:, None] / 2), 1)
+    sigma = np.sqrt(np.maximum(above, 1) / np.pi) / np.sqrt(2 * np.log(2))
+
+    p = np.c_[sigma, a, b][:, :npar]
+
+    def model(p):
+        e = np.exp(-R**2 / 2 / p[:, :1]**2)
+        m = p[:, 1:2] * e
+        if bg:
+            m = m + p[:, 2:3]
+        return m, (e, )
+
+    def jacobian(p, m, aux):
+        e = aux[0]
+        J = np.empty(R.shape + (npar, ))
+        J[..., 0] = p[:, 1:2] * e * R**2 / p[:, :1]**3
+        J[..., 1] = e
+        if bg:
+            J[..., 2] = 1
+        return J
+
+    def constrain(trial):
+        trial[:, 0] = np.abs(trial[:, 0])
+        return trial
+
+    def converged(step, p, chi2, new_chi2):
+        change = np.abs(step / np.where(p == 0, 1, p))
+        done = chi2 - new_chi2 <= tol * chi2
+        return np.all(done * np.all(change < tol, 1))
+
+    p = _lm_batch(model, jacobian, p, f, w, maxiter=maxiter,
+                  constrain=constrain, converged=converged)
+
+    sigma = p[:, 0]
+    a = p[:, 1]
+    b = p[:, 2] if bg else np.zeros(len(f))
+    ok = (np.isfinite(p).all(1) * (a > 0) * (sigma > 0)
+          * (np.sum(w > 0, 1) > npar))
+    return sigma, a, b, ok
+
+def _stamps(im, yx, halfbox):
+    """Extract sub-images centered on many sources.
+
+    Parameters
+    ----------
+    im : ndarray
+      The image.
+    yx : array
+      `Nx2` array of centers.
+    halfbox : array
+      The stamp half-sizes `(y, x)`, each stamp will have shape `2 *
+      halfbox + 1`.
+
+    Returns
+    -------
+    stamps : ndarray
+      `N x (2 * halfbox[0] + 1) x (2 * halfbox[1] + 1)` array of
+      sub-images.  Pixels beyond the edges of the image are NaN.
+    origin : ndarray
+      `Nx2` array of the image coordinates of each stamp's `[0, 0]`
+      pixel.
+
+    """
+
+    iyx = np.round(np.reshape(yx, (-1, 2))).astype(int)
+    origin = iyx - halfbox
+    y = origin[:, 0, None, None] + np.arange(2 * halfbox[0] + 1)[:, None]
+    x = origin[:, 1, None, None] + np.arange(2 * halfbox[1] + 1)
+    outside = ((y < 0) + (y >= im.shape[0])) + ((x < 0) + (x >= im.shape[1]))
+    stamps = np.asarray(im, float)[np.clip(y, 0, im.shape[0] - 1),
+                                   np.clip(x, 0, im.shape[1] - 1)]
+    stamps[outside] = np.nan
+    return stamps, origin
+
+def _gfit_batch(f, w, maxiter=20, tol=1e-6):
+    """Simultaneously fit many 1D Gaussians.
+
+    The model is `a * exp(-(x - mu)**2 / 2 / sigma**2)`, with `x =
+    0, 1, ..., M - 1`.  Initial guesses come from the moments of each
+    profile, which are then refined with a damped Gauss-Newton
+    (Levenberg-Marquardt) solver, vectorized over all profiles.
+
+    Parameters
+    ----------
+    f : ndarray
+      `NxM` array of profiles.
+    w : ndarray
+      `NxM` array of weights, e.g., 0 for bad data.
+    maxiter : int, optional
+      The maximum number of iterations.
+    tol : float, optional
+      Stop iterating when all fitted centers change by less than
+      `tol`.
+
+    Returns
+    -------
+    p : ndarray
+      `Nx3` array of the best-fit parameters: `a, mu, sigma`.  The
+      amplitudes are relative to the peak of each profile.
+    ok : ndarray
+      `True` for each successful fit.
+
+    """
+
+    N, M = f.shape
+    x = np.arange(M, dtype=float)
+    w = w * np.isfinite(f)
+    f = np.where(w > 0, f, 0)
+
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        # normalize each profile to its peak, like gcentroid
+        scale = np.where(w > 0, f, -np.inf).max(1)
+        scale[(scale <= 0) + ~np.isfinite(scale)] = np.nan
+        f = f / scale[:, None]
+
+        # initial guess: profile moments above the profile minimum
+        fmin = np.where(w > 0, f, np.inf).min(1)
+        g = (f - fmin[:, None]) * w
+        mu = (g * x).sum(1) / g.sum(1)
+        sigma = np.sqrt((g * (x - mu[:, None])**2).sum(1) / g.sum(1))
+        p = np.c_[np.ones(N), np.clip(mu, 0, M - 1), np.clip(sigma, 0.5, M)]
+        p[~np.isfinite(p)] = 1.0
+        lo = np.array((0, 0, 1e-3))
+        hi = np.array((np.inf, M - 1, M))
+
+        def model(p):
+            z = (x - p[:, 1, None]) / p[:, 2, None]
+            e = np.exp(-z**2 / 2.0)
+            return p[:, 0, None] * e, (e, z)
+
+        def jacobian(p, m, aux):
+            e, z = aux
+            J = np.empty((N, M, 3))
+            J[..., 0] = e
+            J[..., 1] = m * z / p[:, 2, None]
+            J[..., 2] = m * z**2 / p[:, 2, None]
+            return J
+
+        def constrain(trial):
+            return np.clip(trial, lo, hi)
+
+        def converged(step, p, chi2, new_chi2):
+            return np.all(np.abs(step[:, 1]) < tol)
+
+        p = _lm_batch(model, jacobian, p, f, w, maxiter=maxiter,
+                      constrain=constrain, converged=converged)
+
+        ok = (np.isfinite(p).all(1) * np.isfinite(scale)
+              * (p[:, 0] > 0) * (p[:, 1] > 0) * (p[:, 1] < M - 1)
+              * (p[:, 2] < M) * ((w > 0).sum(1) >= 3))
+
+    return p, ok
+
+def _lm_batch(model, jacobian, p, f, w, maxiter=20, constrain=None,
+              converged=None):
+    """Damped Gauss-Newton (Levenberg-Marquardt) fits to many data sets.
+
+    Parameters
+    ----------
+    model : function
+      `model(p)` returns the `NxM` model for the `NxP` parameters
+      `p`, and a tuple of `NxM` arrays passed on to `jacobian`.
+    jacobian : function
+      `jacobian(p, m, aux)` returns the `NxMxP` derivatives of the
+      model `m` with respect to the parameters.
+    p : ndarray
+      `NxP` array of initial guesses, updated in place.
+    f, w : ndarray
+      `NxM` arrays of data and weights.
+    maxiter : int, optional
+      The maximum number of iterations.
+    constrain : function, optional
+      `constrain(trial)` returns the trial parameters limited to
+      their allowed ranges.
+    converged : function, optional
+      `converged(step, p, chi2, new_chi2)` returns `True` to stop
+      iterating.
+
+    Returns
+    -------
+    p : ndarray
+      The best-fit parameters.
+
+    """
+
+    N, P = p.shape
+    diag = np.arange(P)
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        m, aux = model(p)
+        chi2 = (w * (f - m)**2).sum(1)
+        lam = np.ones(N) * 1e-3
+        for i in range(maxiter):
+            J = jacobian(p, m, aux)
+            JW = J * w[..., None]
+            A = np.einsum('nmi,nmj->nij', JW, J)
+            b = np.einsum('nmi,nm->ni', JW, f - m)
+            A[:, diag, diag] *= 1 + lam[:, None]
+            A[:, diag, diag] += 1e-12
+
+            bad = ~np.isfinite(A).all(2).all(1) + ~np.isfinite(b).all(1)
+            A[bad] = np.eye(P)
+            b[bad] = 0
+            step = np.linalg.solve(A, b[..., None])[..., 0]
+            trial = p + step
+            if constrain is not None:
+                trial = constrain(trial)
+
+            mt, auxt = model(trial)
+            chi2t = (w * (f - mt)**2).sum(1)
+            better = np.isfinite(chi2t) * (chi2t <= chi2)
+            p[better] = trial[better]
+            m[better] = mt[better]
+            for a, at in zip(aux, auxt):
+                a[better] = at[better]
+            lam = np.where(better, lam / 10.0, lam * 10.0)
+
+            new_chi2 = np.where(better, chi2t, chi2)
+            if converged is not None and converged(step, p, chi2, new_chi2):
+                break
+            chi2 = new_chi2
+
+    return p
+
 
 # update module docstring
 from ..util import autodoc
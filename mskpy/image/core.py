@@ -8,6 +8,7 @@ image.core --- General image operations, generators.
    :toctree: generated/
 
    imshift
+   imshift_stack
    rarray
    rebin
    stack2grid
@@ -20,6 +21,7 @@ image.core --- General image operations, generators.
 
 __all__ = [
     'imshift',
+    'imshift_stack',
     'rarray',
     'rebin',
     'stack2grid',
@@ -31,7 +33,7 @@ __all__ = [
 
 import numpy as np
 
-def imshift(im, yx, subsample=4):
+def imshift(im, yx, subsample=4, method='rebin', order=3):
     """Shift an image, allowing for sub-pixel offsets.
 
     Parameters
@@ -42,27 +44,92 @@ def imshift(im, yx, subsample=4):
       `y, x` offsets.  Positive values move pixels to the
       up/right. [unsampled pixels]
     subsample : int, optional
-      The sub-sampling factor.  If <=1, then the image is only shifted
-      whole pixels.
+      The sub-sampling factor for `method='rebin'`.  If <=1, then the
+      image is only shifted whole pixels.
+    method : string, optional
+      'rebin': sub-sample the image, shift by whole sampled pixels,
+        and bin back to the original pixel scale.  Shifts are
+        quantized to `1 / subsample` pixels.
+      'fft': exact fractional shift with a Fourier phase ramp.
+      'spline': exact fractional shift with spline interpolation.
+    order : int, optional
+      The spline order for `method='spline'`.
 
     Returns
     -------
     sim : ndarray
       The shifted image (at the original pixel scale).
 
+    Notes
+    -----
+    The 'rebin' and 'fft' methods wrap pixels around the edges of the
+    image.  The 'spline' method fills pixels shifted in from outside
+    the image with the nearest edge value.  The 'fft' and 'spline'
+    methods require finite pixel values.
+
     """
 
-    if subsample <= 1:
-        subsample = 1
+    if method == 'rebin':
+        if subsample <= 1:
+            subsample = 1
+
+        sy = int(round(yx[0] * subsample)) # whole sampled pixels
+        sx = int(round(yx[1] * subsample))
+
+        sim = rebin(im, subsample, flux=True)
+        sim = np.roll(sim, sy, 0)
+        sim = np.roll(sim, sx, 1)
+
+        return rebin(sim, -subsample, flux=True)
+    elif method == 'fft':
+        return _fft_shift(im, yx)
+    elif method == 'spline':
+        from scipy import ndimage
+        return ndimage.shift(np.asarray(im, float), yx[:2], order=order,
+                             mode='nearest')
+    else:
+        raise ValueError("method must be one of 'rebin', 'fft', or"
+                         " 'spline'.")
+
+def imshift_stack(stack, yx, subsample=4, method='fft', order=3):
+    """Shift each image of a stack by its own offset.
+
+    Parameters
+    ----------
+    stack : ndarray
+      The images to shift, with shape `(N, ny, nx)`.
+    yx : array
+      `y, x` offsets for each image, with shape `(N, 2)`.  Positive
+      values move pixels to the up/right.
+    subsample : int, optional
+      The sub-sampling factor for `method='rebin'`.
+    method : string, optional
+      The shift method, see `imshift`.  With 'fft', the whole stack
+      is transformed at once.
+    order : int, optional
+      The spline order for `method='spline'`.
+
+    Returns
+    -------
+    sstack : ndarray
+      The shifted images.
 
-    sy = int(round(yx[0] * subsample)) # whole sampled pixels
-    sx = int(round(yx[1] * subsample))
+    """
 
-    sim = rebin(im, subsample, flux=True)
-    sim = np.roll(sim, sy, 0)
-    sim = np.roll(sim, sx, 1)
+    stack = np.asarray(stack)
+    yx = np.asarray(yx, float).reshape((-1, 2))
+    assert stack.ndim == 3, "stack must be three dimensional."
+    assert len(yx) == len(stack), "yx must have one offset per image."
 
-    return rebin(sim, -subsample, flux=True)
+    if method == 'fft':
+        return _fft_shift(stack, yx)
+
+    sstack = np.empty(stack.shape,
+                      stack.dtype if stack.dtype.kind == 'f' else float)
+    for i in range(len(stack)):
+        sstack[i] = imshift(stack[i], yx[i], subsample=subsample,
+                            method=method, order=order)
+    return sstack
 
 def rarray(shape, yx=None, subsample=0, dtype=float):
     """Array of distances from a point.
@@ -101,8 +168,13 @@ def rarray(shape, yx=None, subsample=0, dtype=float):
 
     return r
 
-def rebin(a, factor, flux=False, trim=False):
-    """Rebin a 1, 2, or 3 dimensional array by integer amounts.
+def rebin(a, factor, flux=False, trim=False, out=None):
+    """Rebin an N dimensional array by integer amounts.
+
+    All axes are rebinned by the same factor.  Arrays are minified by
+    reshaping each axis of length `n` into `(n / factor, factor)` and
+    summing over the new axes, and magnified by broadcasting into the
+    output, so the input is not copied.
 
     Parameters
     ----------
@@ -118,6 +190,9 @@ def rebin(a, factor, flux=False, trim=False):
     trim : bool
       Set to True to automatically trim the shape of the input array
       to be an integer multiple of factor.
+    out : ndarray, optional
+      Place the result in this array, which must have the correct
+      shape.  It need not be contiguous.
 
     Returns
     -------
@@ -130,47 +205,60 @@ def rebin(a, factor, flux=False, trim=False):
 
     """
 
-    def mini(a, factor):
-        b = a[::-factor]
-        for i in range(-factor - 1):
-            b += a[(i + 1)::-factor]
-        if not flux:
-            b /= float(-factor)
-        return b
-
-    def magni(a, factor):
-        s = np.array(a.shape)
-        s[0] *= factor
-        b = np.zeros(s)
-        for i in range(factor):
-            b[i::factor] = a
-        if flux:
-            b /= float(factor)
-        return b
+    a = np.asarray(a)
 
     if factor == 1:
         # done!
-        return a
+        if out is None:
+            return a
+        out[...] = a
+        return out
 
-    _a = a.copy()
+    f = abs(int(factor))
     if factor < 0:
-        for i in range(_a.ndim):
-            if trim:
-                r = _a.shape[i] % abs(factor)
-                if r != 0:
-                    _a = np.rollaxis(np.rollaxis(_a, i)[:-r], 0, i + 1)
+        if trim:
+            a = a[tuple(slice(0, n - n % f) for n in a.shape)]
 
-            assert (_a.shape[i] % factor) == 0, (
+        for i in range(a.ndim):
+            assert (a.shape[i] % f) == 0, (
                 "Axis {0} must be an integer multiple of "
                 "the minification factor.".format(i))
-        f = mini
-    else:
-        f = magni
 
-    b = f(_a, factor)
-    for i in range(len(_a.shape) - 1):
-        c = f(np.rollaxis(b, i + 1), factor)
-        b = np.rollaxis(c, 0, i + 2)
+        # (n, m) -> (n / f, f, m / f, f), then sum over the factor
+        # axes one at a time, outermost first, which keeps the
+        # summation order of the original strided algorithm
+        shape = ()
+        for n in a.shape:
+            shape += (n // f, f)
+
+        b = a.reshape(shape)
+        for i in range(a.ndim - 1):
+            b = b.sum(axis=i + 1)
+
+        if flux:
+            b = b.sum(axis=-1, out=out)
+        else:
+            b = np.true_divide(b.sum(axis=-1), f**a.ndim, out=out)
+    else:
+        # (n, m) -> (n, 1, m, 1), broadcast into (n, f, m, f)
+        shape = ()
+        expanded = ()
+        for n in a.shape:
+            shape += (n, f)
+            expanded += (n, 1)
+
+        if out is None:
+            dtype = a.dtype if a.dtype.kind == 'f' else float
+            out = np.empty(tuple(n * f for n in a.shape), dtype)
+
+        # write through a view of out: setting the shape raises
+        # rather than copying, unlike reshape()
+        b = out
+        view = out.view()
+        view.shape = shape
+        view[...] = a.reshape(expanded)
+        if flux:
+            b /= float(f**a.ndim)
 
     return b
 
@@ -284,7 +372,7 @@ def refine_center(func, im, yx, N, subsample, scale=0, **kwargs):
     yx_N += (yx - np.array([round(x) for x in yx]))
 
     # subsample the NxN region, where is the center of that?
-    shape_c = np.ones(2) * N * subsample
+    shape_c = (N * subsample, N * subsample)
     yx_c = (np.ones(2) * N * subsample - 1) / 2.0
     yx_c += (yx_N - np.array([round(x) for x in yx_N])) * subsample
 
@@ -294,7 +382,7 @@ def refine_center(func, im, yx, N, subsample, scale=0, **kwargs):
     refined_c *= subsample**scale
 
     # The region to be refined: xi, yi
-    yi, xi = np.indices((N, N)) - N / 2
+    yi, xi = np.indices((N, N)) - N // 2
     yi += int(round(yx[0]))
     xi += int(round(yx[1]))
 
@@ -312,7 +400,9 @@ def yx2rt(im, yx, dtdr=0, scale=None, bins=100, range=None,
     Parameters
     ----------
     im : array
-      The image on which to operate.
+      The image on which to operate.  Arrays with more than two
+      dimensions are treated as stacks of images, all transformed
+      with the same parameters.
     yx : array
       The center of the array `(y, x)`.
     dtdr : float, optional
@@ -336,40 +426,42 @@ def yx2rt(im, yx, dtdr=0, scale=None, bins=100, range=None,
       The image transformed to place radius along the first dimension,
       and theta along the second dimension.
     rbins : ndarray
-      The radial bins (from `np.histogram2d`). [pixels]
+      The mean radius of each bin. [pixels]
     thbins : ndarray
-      The azimuthal bins (from `np.histogram2d`). [radians]
+      The mean azimuth of each bin. [radians]
     n : ndarray
       The number of (sub)pixels that were placed into each bin.
 
+    Notes
+    -----
+    The bin index of each pixel is computed once for a given image
+    shape, center, `dtdr`, `scale`, `bins`, and `range`, and cached,
+    so that repeated transformations with the same parameters only
+    cost one `np.bincount` per image.
+
     """
 
+    im = np.asarray(im)
     if scale is not None:
-        image = rebin(im, scale)
-        if scale < 0:
-            scale = 1.0 / float(scale)
-        yx = np.array(yx, float) * scale + (scale - 1) / 2.0
+        stack = im.reshape((-1, ) + im.shape[-2:])
+        image = np.array([rebin(x, scale) for x in stack])
+        image = image.reshape(im.shape[:-2] + image.shape[-2:])
     else:
         image = im
-        scale = 1
-        yx = np.array(yx)
 
-    r = rarray(image.shape, yx=yx, subsample=10, dtype=dtype) / scale
-    th = tarray(image.shape, yx=yx, subsample=10, dtype=dtype) + np.pi
-    th = (th + dtdr * r) % (2 * np.pi)
-
-    r = r.flatten()
-    th = th.flatten()
-    image = image.flatten()
-
-    rt = np.histogram2d(r, th, bins=bins, range=range, weights=image)
-    rbin = np.histogram2d(r, th, bins=bins, range=range, weights=r)
-    thbin = np.histogram2d(r, th, bins=bins, range=range, weights=th)
-    n = np.histogram2d(r, th, bins=bins, range=range)[0]
+    index, n, rbin, thbin = _yx2rt_index(image.shape[-2:], yx, dtdr,
+                                         scale, bins, range, dtype)
+    stack = image.reshape((-1, index.size))
+    rt = np.empty((len(stack), n.size))
+    for i in xrange(len(stack)):
+        rt[i] = np.bincount(index, weights=stack[i],
+                            minlength=n.size + 1)[:n.size]
 
     nn = n.astype(float)
     nn[n == 0] = 1
-    return rt[0] / nn, rbin[0] / nn, thbin[0] / nn, n
+    rt /= nn.ravel()
+    rt = rt.reshape(image.shape[:-2] + n.shape)
+    return rt, rbin.copy(), thbin.copy(), n.copy()
 
 def xarray(shape, yx=[0, 0], rot=0, dtype=int):
     """Array of x values.
@@ -439,6 +531,129 @@ def yarray(shape, yx=[0, 0], rot=0, dtype=int):
 
     return y
 
+_yx2rt_cache = dict()
+def _yx2rt_index(shape, yx, dtdr, scale, bins, range, dtype, maxsize=16):
+    """Polar bin index of each pixel, cached.
+
+    Parameters
+    ----------
+    shape : tuple
+      The shape of the (rebinned) image.
+    yx, dtdr, scale, bins, range, dtype :
+      See `yx2rt`.
+    maxsize : int, optional
+      Keep at most this many index maps in the cache.
+
+    Returns
+    -------
+    index : ndarray
+      The flattened bin index of each pixel.  Pixels outside of the
+      range have index `n.size`.
+    n : ndarray
+      The number of pixels in each bin.
+    rbin, thbin : ndarray
+      The mean radius and azimuth of each bin.
+
+    """
+
+    def hashable(x):
+        if x is None or np.isscalar(x):
+            return x
+        return tuple(hashable(y) for y in x)
+
+    key = (tuple(shape), hashable(yx), dtdr, scale, hashable(bins),
+           hashable(range), np.dtype(dtype).str)
+    if key in _yx2rt_cache:
+        return _yx2rt_cache[key]
+
+    if scale is not None:
+        if scale < 0:
+            scale = 1.0 / abs(float(scale))
+        yx = np.array(yx, float) * scale + (scale - 1) / 2.0
+    else:
+        scale = 1
+        yx = np.array(yx)
+
+    r = rarray(shape, yx=yx, subsample=10, dtype=dtype) / scale
+    th = tarray(shape, yx=yx, subsample=10, dtype=dtype) + np.pi
+    th = (th + dtdr * r) % (2 * np.pi)
+    r = r.ravel()
+    th = th.ravel()
+
+    if np.ndim(bins) == 0 or len(bins) != 2:
+        bins = (bins, bins)
+    if range is None:
+        range = (None, None)
+
+    # bin edges and indices following np.histogram2d
+    nbins = []
+    index = np.zeros(r.size, int)
+    outside = np.zeros(r.size, bool)
+    for x, b, rng in zip((r, th), bins, range):
+        if np.ndim(b) == 0:
+            lo, hi = (x.min(), x.max()) if rng is None else rng
+            if lo == hi:
+                lo, hi = lo - 0.5, hi + 0.5
+            edges = np.linspace(lo, hi, b + 1)
+        else:
+            edges = np.asarray(b, float)
+        i = np.searchsorted(edges, x, side='right')
+        i[x == edges[-1]] -= 1
+        outside |= (i == 0) | (i == len(edges))
+        index = index * (len(edges) - 1) + i - 1
+        nbins.append(len(edges) - 1)
+
+    size = nbins[0] * nbins[1]
+    index[outside] = size
+    n = np.bincount(index, minlength=size + 1)[:size]
+    nn = n.astype(float)
+    nn[n == 0] = 1
+    rbin = np.bincount(index, weights=r, minlength=size + 1)[:size] / nn
+    thbin = np.bincount(index, weights=th, minlength=size + 1)[:size] / nn
+
+    result = (index, n.reshape(nbins), rbin.reshape(nbins),
+              thbin.reshape(nbins))
+    for x in result:
+        x.flags.writeable = False
+
+    if len(_yx2rt_cache) >= maxsize:
+        _yx2rt_cache.clear()
+    _yx2rt_cache[key] = result
+
+    return result
+
+def _fft_shift(im, yx):
+    """Shift images by a Fourier phase ramp.
+
+    Parameters
+    ----------
+    im : ndarray
+      The image, or images, to shift: `(..., ny, nx)`.
+    yx : array
+      The offsets: `(..., 2)`.
+
+    Returns
+    -------
+    sim : ndarray
+      The shifted images.
+
+    """
+
+    im = np.asarray(im, float)
+    yx = np.asarray(yx, float)
+    ny, nx = im.shape[-2:]
+
+    # the ramp is separable in y and x
+    dy = yx[..., 0][..., np.newaxis, np.newaxis]
+    dx = yx[..., 1][..., np.newaxis, np.newaxis]
+    ky = np.fft.fftfreq(ny)[:, np.newaxis]
+    kx = np.fft.rfftfreq(nx)[np.newaxis, :]
+
+    f = np.fft.rfft2(im)
+    f *= np.exp(-2j * np.pi * ky * dy)
+    f *= np.exp(-2j * np.pi * kx * dx)
+    return np.fft.irfft2(f, s=(ny, nx))
+
 # update module docstring
 from ..util import autodoc
 autodoc(globals())
@@ -13,8 +13,12 @@ image.process --- Process (astronomical) images.
    combine
    crclean
    fixpix
+   ialign_by_centroid
+   ialign_by_wcs
    mkflat
+   psf_grid
    psfmatch
+   psfmatch_tiled
    stripes
 
 """
@@ -23,6 +27,11 @@ from __future__ import print_function
 import numpy as np
 from . import core, analysis
 
+try:
+    _string_types = basestring
+except NameError:
+    _string_types = str
+
 __all__ = [
     'align_by_centroid',
     'align_by_wcs',
@@ -30,13 +39,17 @@ __all__ = [
     'combine',
     'crclean',
     'fixpix',
+    'ialign_by_centroid',
+    'ialign_by_wcs',
     'mkflat',
+    'psf_grid',
     'psfmatch',
+    'psfmatch_tiled',
     'stripes'
 ]
 
 def align_by_centroid(data, yx, cfunc=None, ckwargs=dict(box=5),
-                      **kwargs):
+                      out=None, **kwargs):
     """Align a set of images by centroid of a single source.
 
     Parameters
@@ -50,6 +63,9 @@ def align_by_centroid(data, yx, cfunc=None, ckwargs=dict(box=5),
       The centroiding function or `None` to use `gcentroid`.
     ckwargs : dict
       Keyword arguments for `cfunc`.
+    out : ndarray or string, optional
+      Write the aligned images to this array, or to a new
+      memory-mapped `.npy` file with this name.
     **kwargs
       Keyword arguments for `imshift`.
 
@@ -62,43 +78,12 @@ def align_by_centroid(data, yx, cfunc=None, ckwargs=dict(box=5),
 
     """
 
-    import astropy.units as u
-    from astropy.io import fits
-    from .analysis import gcentroid
-
-    if cfunc is None:
-        cfunc = gcentroid
-
-    if isinstance(data[0], str):
-        im = fits.getdata(files[0])
-        stack = np.zeros((len(data), ) + im.shape)
-        stack[0] = im
-        del im
-        for i in range(1, len(data)):
-            stack[i] = fits.getdata(data[i])
-    else:
-        stack = data.copy()
-
-    y0, x0 = cfunc(stack[0], yx, **ckwargs)
-
-    dyx = np.zeros((len(stack), 2))
-    for i in range(1, len(stack)):
-        y, x = cfunc(stack[i], yx, **ckwargs)
-        dyx[i] = y0 - y, x0 - x
-        stack[i] = core.imshift(stack[i], dyx[i], **kwargs)
-        if int(dyx[i, 0]) < 0:
-            stack[i, :, int(dyx[i, 0]):] = np.nan
-        elif int(dyx[i, 0]) > 0:
-            stack[i, :, :int(dyx[i, 0])] = np.nan
-        if int(dyx[i, 1]) < 0:
-            stack[i, int(dyx[i, 1]):] = np.nan
-        elif int(dyx[i, 1]) > 0:
-            stack[i, :int(dyx[i, 1])] = np.nan
-
-    return stack, dyx
+    frames = ialign_by_centroid(data, yx, cfunc=cfunc, ckwargs=ckwargs,
+                                **kwargs)
+    return _collect_frames(frames, len(data), out)
 
 def align_by_wcs(files, target=None, observer=None, time_key='DATE-OBS',
-                 **kwargs):
+                 out=None, nthreads=4, **kwargs):
     """Align a set of images using their world coordinate systems.
 
     Parameters
@@ -111,6 +96,11 @@ def align_by_wcs(files, target=None, observer=None, time_key='DATE-OBS',
       Observe `target` with this observer.
     time_key : string
       The header keyword for the observation time.
+    out : ndarray or string, optional
+      Write the aligned images to this array, or to a new
+      memory-mapped `.npy` file with this name.
+    nthreads : int, optional
+      The number of threads used to read headers and parse the WCS.
     **kwargs
       Keyword arguments for `imshift`.
 
@@ -123,50 +113,9 @@ def align_by_wcs(files, target=None, observer=None, time_key='DATE-OBS',
 
     """
 
-    import astropy.units as u
-    from astropy.io import fits
-    from astropy.wcs import WCS
-    from astropy.coordinates import Angle
-
-    im, h0 = fits.getdata(files[0], header=True)
-    wcs0 = WCS(h0)
-    stack = np.zeros((len(files), ) + im.shape)
-    stack[0] = im
-
-    y0, x0 = np.array(im.shape) / 2.0
-    if target is not None:
-        assert observer is not None, "observer required"
-        g0 = observer.observe(target, h0[time_key])
-        xt, yt = wcs0.wcs_world2pix(np.c_[g0.ra, g0.dec], 0)[0]
-
-    ra0, dec0 = Angle(wcs0.wcs_pix2world(np.c_[x0, y0], 0)[0] * u.deg)
-    dra = 0 * u.deg
-    ddec = 0 * u.deg
-
-    dyx = np.zeros((len(files), 2))
-    for i in range(1, len(files)):
-        im, h = fits.getdata(files[i], header=True)
-        wcs = WCS(h)
-        if target is not None:
-            g = observer.observe(target, h[time_key])
-            dra = g.ra - g0.ra
-            ddec = g.dec - g0.dec
-
-        x, y = wcs.wcs_world2pix(np.c_[ra0 + dra, dec0 + ddec], 0)[0]
-        dyx[i] = y0 - y, x0 - x
-        stack[i] = core.imshift(im, dyx[i], **kwargs)
-        if int(dyx[i, 0]) != 0:
-            if int(dyx[i, 0]) < 0:
-                stack[i, :, int(dyx[i, 0]):] = np.nan
-            else:
-                stack[i, :, :int(dyx[i, 0])] = np.nan
-        if int(dyx[i, 1]) != 0:
-            if int(dyx[i, 1]) < 0:
-                stack[i, int(dyx[i, 1]):] = np.nan
-            else:
-                stack[i, :int(dyx[i, 1])] = np.nan
-
-    return stack, dyx
+    frames = ialign_by_wcs(files, target=target, observer=observer,
+                           time_key=time_key, nthreads=nthreads, **kwargs)
+    return _collect_frames(frames, len(files), out)
 
 def columnpull(column, index, bg, stdev):
     """Define a column pull detector artifact.
@@ -329,19 +278,30 @@ def crclean(im, thresh, niter=1, unc=None, gain=1.0, rn=0.0, fwhm=2.0):
 
     return clean
 
-def fixpix(im, mask, max_area=10):
-    """Replace masked values replaced with a linear interpolation.
+def fixpix(im, mask, max_area=10, method='mean'):
+    """Replace masked values with an interpolation of their neighbors.
 
-    Probably only good for isolated bad pixels.
+    Bad pixels are grouped into domains (the mask dilated by one
+    pixel).  Each bad pixel is replaced with an interpolation of the
+    good pixels on the border of its domain.  Probably only good for
+    isolated bad pixels.
 
     Parameters
     ----------
     im : array
-      The image.
+      The image, or a cube of images (`Nframes x Ny x Nx`).  A cube
+      is cleaned with a single labelling of `mask`.
     mask : array
-      `True` where `im` contains bad pixels.
+      `True` where `im` contains bad pixels.  For a cube, either the
+      shape of one image (shared by all frames), or the shape of the
+      cube.
     max_area : int
       Only fix areas smaller or equal to this value.
+    method : string, optional
+      'mean' to use the mean of the good neighbors, 'idw' to weight
+      the good neighbors by inverse-distance squared, or
+      'biharmonic' to solve the biharmonic equation over the bad
+      pixels.
 
     Returns
     -------
@@ -349,27 +309,117 @@ def fixpix(im, mask, max_area=10):
 
     """
 
-    from scipy.interpolate import interp2d
-    from scipy.ndimage import binary_dilation, label, find_objects
+    im = np.asanyarray(im)
+    mask = np.asarray(mask, bool)
 
-    # create domains around masked pixels
-    dilated = binary_dilation(mask)
-    domains, n = label(dilated)
+    if im.ndim == 3 and mask.ndim == 3:
+        return np.array([fixpix(im[i], mask[i], max_area=max_area,
+                                method=method)
+                         for i in range(im.shape[0])])
+
+    assert mask.shape == im.shape[-2:], "mask and im shapes do not match"
+
+    bad, good, fill = _fixpix_filler(mask, max_area, method)
 
-    # loop through each domain, replace bad pixels with the average
-    # from nearest neigboors
     cleaned = im.copy()
-    for i in find_objects(domains):
-        submask = mask[i]
-        if submask.sum() > max_area:
-            continue
-        subim = im[i].copy()
-        subgood = (submask == False) * dilated[i]
-        subim[submask] = subim[subgood].mean()
-        cleaned[i] = subim
+    if len(bad) == 0:
+        return cleaned
+
+    if im.ndim == 2:
+        cleaned.flat[bad] = fill(im.flat[good])
+    else:
+        frames = cleaned.reshape((im.shape[0], -1))
+        frames[:, bad] = fill(frames[:, good].T).T
+        cleaned = frames.reshape(im.shape)
 
     return cleaned
 
+def ialign_by_centroid(data, yx, cfunc=None, ckwargs=dict(box=5),
+                       **kwargs):
+    """Align a set of images by centroid, one image at a time.
+
+    Only one image is held in memory at a time.  See
+    `align_by_centroid` for the parameters.
+
+    Yields
+    ------
+    im : ndarray
+      The aligned image.
+    dyx : ndarray
+      The offset.
+
+    """
+
+    from .analysis import gcentroid
+
+    if cfunc is None:
+        cfunc = gcentroid
+
+    for i, im in enumerate(_iter_frames(data)):
+        if i == 0:
+            y0, x0 = cfunc(im, yx, **ckwargs)
+            yield np.array(im, float), np.zeros(2)
+            continue
+
+        y, x = cfunc(im, yx, **ckwargs)
+        dyx = np.array((y0 - y, x0 - x))
+        im = core.imshift(im, dyx, **kwargs)
+        _blank_edges(im, dyx)
+        yield im, dyx
+
+def ialign_by_wcs(files, target=None, observer=None, time_key='DATE-OBS',
+                  nthreads=4, **kwargs):
+    """Align a set of images by their WCS, one image at a time.
+
+    Headers are read and world coordinate systems are parsed in a
+    thread pool, while only one image is held in memory at a time.
+    See `align_by_wcs` for the parameters.
+
+    Yields
+    ------
+    im : ndarray
+      The aligned image.
+    dyx : ndarray
+      The offset.
+
+    """
+
+    import astropy.units as u
+    from astropy.io import fits
+    from astropy.coordinates import Angle
+    from multiprocessing.pool import ThreadPool
+
+    pool = ThreadPool(nthreads)
+    try:
+        headers = pool.imap(_read_wcs, files)
+        for i, (h, wcs) in enumerate(headers):
+            im = fits.getdata(files[i])
+            if i == 0:
+                y0, x0 = np.array(im.shape) / 2.0
+                if target is not None:
+                    assert observer is not None, "observer required"
+                    g0 = observer.observe(target, h[time_key])
+
+                ra0, dec0 = Angle(wcs.wcs_pix2world(np.c_[x0, y0], 0)[0]
+                                  * u.deg)
+                dra = 0 * u.deg
+                ddec = 0 * u.deg
+                yield np.array(im, float), np.zeros(2)
+                continue
+
+            if target is not None:
+                g = observer.observe(target, h[time_key])
+                dra = g.ra - g0.ra
+                ddec = g.dec - g0.dec
+
+            x, y = wcs.wcs_world2pix(np.c_[ra0 + dra, dec0 + ddec], 0)[0]
+            dyx = np.array((y0 - y, x0 - x))
+            im = core.imshift(im, dyx, **kwargs)
+            _blank_edges(im, dyx)
+            yield im, dyx
+    finally:
+        pool.terminate()
+
 def mkflat(flat, **kwargs):
     """Flat field correction and bad pixel mask from an image.
 
@@ -402,7 +452,7 @@ def mkflat(flat, **kwargs):
 
     return flat
 
-def psfmatch(psf, psfr, ps=1, psr=1, smooth=None, mask=None):
+def psfmatch(psf, psfr, ps=1, psr=1, smooth=None, mask=None, reg=None):
     """Generate a convolution kernel to match the PSFs of two images.
 
     Parameters
@@ -423,6 +473,10 @@ def psfmatch(psf, psfr, ps=1, psr=1, smooth=None, mask=None):
       from the center of the kernel to 0 (i.e., mask the
       high-frequency components, which are usually dominated by
       noise).
+    reg : float, optional
+      If not `None`, regularize the Fourier division, `R / I`, as `R
+      I* / (|I|**2 + reg * max(|I|)**2)`, which suppresses the
+      frequencies where the input PSF has little power.
 
     Returns
     -------
@@ -438,28 +492,31 @@ def psfmatch(psf, psfr, ps=1, psr=1, smooth=None, mask=None):
     assert psf.shape[0] == psf.shape[1], "psf should have a square shape"
     assert psfr.shape[0] == psfr.shape[1], "psfr should have a square shape"
 
-    _psf = psf
+    _psf = np.array(psf, float)
 
     # rebin to match pixel scales?
     if ps != psr:
         _psfr = zoom(psfr, psr / ps) # change the reference PSF
     else:
-        _psfr = psfr
+        _psfr = np.array(psfr, float)
 
     # trim psfr?
     d = _psfr.shape[0] - _psf.shape[0]
     if d != 0:
-        sl = slice(np.floor(d / 2.), -np.ceil(d / 2.))
-        _psfr = rebin(_psfr, 2)
-        _psfr = rebin(_psfr[d:-d, d:-d], -2)
+        _psfr = core.rebin(_psfr, 2)
+        _psfr = core.rebin(_psfr[d:-d, d:-d], -2)
 
     # normalize to 1.
     _psfr /= _psfr.sum()
     _psf /= _psf.sum()
     R = fft.fft2(_psfr)
     I = fft.fft2(_psf)
-    K = fft.fft2(R / I).real
-    K = np.roll(np.roll(K, K.shape[0] / 2, 0), K.shape[1] / 2, 1)
+    if reg is None:
+        K = fft.ifft2(R / I).real
+    else:
+        I2 = np.abs(I)**2
+        K = fft.ifft2(R * I.conj() / (I2 + reg * I2.max())).real
+    K = np.roll(np.roll(K, K.shape[0] // 2, 0), K.shape[1] // 2, 1)
 
     if smooth is not None:
         K = gaussian_filter(K, smooth)
@@ -470,6 +527,144 @@ def psfmatch(psf, psfr, ps=1, psr=1, smooth=None, mask=None):
 
     return K / K.sum()
 
+def psfmatch_tiled(im, psf, psfr, ps=1, psr=1, smooth=None, mask=None,
+                   reg=None, nthreads=4):
+    """PSF match an image with a spatially variable kernel.
+
+    The image is divided into a grid of tiles, and a matching kernel
+    is computed for each tile with `psfmatch`.  The kernels are
+    applied with FFT overlap-add: the image is split into overlapping
+    pieces with bilinear weights centered on each tile, each piece is
+    convolved with its tile's kernel, and the results are summed.
+    Between tile centers, the effective kernel is the bilinear
+    interpolation of the neighboring kernels.
+
+    Parameters
+    ----------
+    im : array
+      The image to match.
+    psf, psfr : array
+      The input and reference PSFs (see `psfmatch`).  Either may be a
+      single PSF, or a grid of PSFs, one for each tile, with shape
+      `(Ny, Nx, N, N)`, e.g., from `psf_grid`.  The tiles evenly
+      divide the image.
+    ps, psr, smooth, mask, reg : optional
+      Passed to `psfmatch`.
+    nthreads : int, optional
+      Compute kernels and convolve tiles with this many threads.
+
+    Returns
+    -------
+    matched : ndarray
+      The PSF-matched image.
+    K : ndarray
+      The `(Ny, Nx, N, N)` grid of kernels, which may be passed back
+      as `psf` with `psfr` set to a delta function to match another
+      image with the same kernels.
+
+    """
+
+    from multiprocessing.pool import ThreadPool
+    from scipy.signal import fftconvolve
+
+    im = np.asarray(im, float)
+    psf = np.asarray(psf, float)
+    psfr = np.asarray(psfr, float)
+    if psf.ndim == 2:
+        psf = psf[None, None]
+    if psfr.ndim == 2:
+        psfr = psfr[None, None]
+    tiles = np.maximum(psf.shape[:2], psfr.shape[:2])
+    psf = np.broadcast_to(psf, tuple(tiles) + psf.shape[2:])
+    psfr = np.broadcast_to(psfr, tuple(tiles) + psfr.shape[2:])
+
+    def kernel(ij):
+        return psfmatch(psf[ij], psfr[ij], ps=ps, psr=psr, smooth=smooth,
+                        mask=mask, reg=reg)
+
+    def convolve(ij):
+        (ys, wy), (xs, wx) = weights[0][ij[0]], weights[1][ij[1]]
+        piece = im[ys, xs] * wy[:, None] * wx
+        return ys.start, xs.start, fftconvolve(piece, K[ij], mode='full')
+
+    ij = list(np.ndindex(*tiles))
+    pool = ThreadPool(nthreads)
+    try:
+        K = np.array(pool.map(kernel, ij))
+        K = K.reshape(tuple(tiles) + K.shape[1:])
+
+        weights = [_tile_weights(n, t) for n, t in zip(im.shape, tiles)]
+        c = np.array(K.shape[2:]) // 2
+        full = np.zeros(np.array(im.shape) + K.shape[2:] - 1)
+        for y0, x0, f in pool.imap_unordered(convolve, ij):
+            full[y0:y0 + f.shape[0], x0:x0 + f.shape[1]] += f
+    finally:
+        pool.close()
+
+    matched = full[c[0]:c[0] + im.shape[0], c[1]:c[1] + im.shape[1]]
+    return matched, K
+
+def psf_grid(im, yx, tiles, box=21):
+    """Estimate the PSF on a grid of tiles from a list of stars.
+
+    Each star is centered on its stamp with a Fourier shift and
+    normalized, and the PSF of each tile is the median of its stars.
+    Tiles without any stars take the PSF of the nearest tile that has
+    stars.
+
+    Parameters
+    ----------
+    im : array
+      The image.
+    yx : array
+      `Nx2` array of the precise `y, x` centers of the stars.
+    tiles : int or array
+      The number of tiles along `y` and `x`.  The tiles evenly divide
+      the image.
+    box : int, optional
+      The PSF image size, which should be odd.
+
+    Returns
+    -------
+    psf : ndarray
+      `(Ny, Nx, box, box)` grid of PSFs, suitable for
+      `psfmatch_tiled`.
+
+    """
+
+    from scipy.ndimage import distance_transform_edt
+    from .analysis import _stamps
+
+    im = np.asarray(im, float)
+    yx = np.asarray(yx, float).reshape((-1, 2))
+    tiles = np.ones(2, int) * tiles
+
+    halfbox = np.ones(2, int) * (box // 2)
+    stamps, origin = _stamps(im, yx, halfbox)
+    keep = np.isfinite(stamps).all(2).all(1)
+    stamps, yx = stamps[keep], yx[keep]
+    stamps = core.imshift_stack(stamps, (origin[keep] + halfbox) - yx,
+                                method='fft')
+    stamps /= stamps.sum(2).sum(1)[:, None, None]
+
+    t = [np.clip(np.floor(yx[:, i] * tiles[i] / im.shape[i]).astype(int),
+                 0, tiles[i] - 1) for i in range(2)]
+    psf = np.empty(tuple(tiles) + stamps.shape[1:])
+    empty = np.ones(tiles, bool)
+    for i, j in np.ndindex(*tiles):
+        k = (t[0] == i) * (t[1] == j)
+        if k.any():
+            psf[i, j] = np.median(stamps[k], 0)
+            empty[i, j] = False
+
+    assert not empty.all(), "No stars found in the image."
+    if empty.any():
+        nearest = distance_transform_edt(empty, return_distances=False,
+                                         return_indices=True)
+        psf[empty] = psf[nearest[0][empty], nearest[1][empty]]
+
+    return psf
+
 def stripes(im, axis=0, stat=np.median, **keywords):
     """Find and compute column/row stripe artifacts in an image.
 
@@ -511,6 +706,241 @@ def stripes(im, axis=0, stat=np.median, **keywords):
     
     return s
 
+def _blank_edges(im, dyx):
+    """Set pixels wrapped around the image edges by a shift to NaN."""
+    dy, dx = int(dyx[0]), int(dyx[1])
+    if dy > 0:
+        im[:dy] = np.nan
+    elif dy < 0:
+        im[dy:] = np.nan
+    if dx > 0:
+        im[:, :dx] = np.nan
+    elif dx < 0:
+        im[:, dx:] = np.nan
+
+def _collect_frames(frames, n, out=None):
+    """Gather aligned frames into a stack.
+
+    Parameters
+    ----------
+    frames : iterable
+      `(im, dyx)` pairs.
+    n : int
+      The number of frames.
+    out : ndarray or string, optional
+      The output array, or the name of a new memory-mapped `.npy`
+      file.  If `None`, a new array is created.
+
+    Returns
+    -------
+    stack : ndarray
+    dyx : ndarray
+
+    """
+
+    dyx = np.zeros((n, 2))
+    for i, (im, d) in enumerate(frames):
+        if i == 0:
+            shape = (n, ) + im.shape
+            if out is None:
+                stack = np.zeros(shape)
+            elif isinstance(out, _string_types):
+                stack = np.lib.format.open_memmap(out, mode='w+',
+                                                  dtype=float, shape=shape)
+            else:
+                stack = out
+        stack[i] = im
+        dyx[i] = d
+
+    if isinstance(stack, np.memmap):
+        stack.flush()
+
+    return stack, dyx
+
+def _fixpix_filler(mask, max_area, method):
+    """Bad-pixel interpolator for `fixpix`.
+
+    Parameters
+    ----------
+    mask : ndarray
+      `True` for bad pixels.
+    max_area : int
+      Maximum number of bad pixels in a domain.
+    method : string
+      'mean', 'idw', or 'biharmonic'.
+
+    Returns
+    -------
+    bad : ndarray
+      Flat indices of the bad pixels to replace.
+    good : ndarray
+      Flat indices of the pixels the interpolation depends on.
+    fill : function
+      `fill(im.flat[good])` returns the values for `im.flat[bad]`.
+      The argument may have a trailing frame axis.
+
+    """
+
+    import scipy.sparse as sp
+    from scipy.ndimage import binary_dilation, label
+
+    if method not in ['mean', 'idw', 'biharmonic']:
+        raise ValueError("method must be 'mean', 'idw', or 'biharmonic'.")
+
+    # create domains around masked pixels
+    dilated = binary_dilation(mask)
+    domains, n = label(dilated)
+    domains = domains.ravel()
+    m = mask.ravel()
+
+    # domain areas and good-neighbor counts, in one pass over labels
+    area = np.bincount(domains[m], minlength=n + 1)
+    ring = np.flatnonzero(~m & (domains > 0))
+    count = np.bincount(domains[ring], minlength=n + 1)
+    ok = (area <= max_area) & (count > 0)
+    ok[0] = False
+
+    bad = np.flatnonzero(m & ok[domains])
+    ring = ring[ok[domains[ring]]]
+    if len(bad) == 0:
+        return bad, ring, None
+
+    if method == 'biharmonic':
+        return _fixpix_biharmonic(mask, bad)
+
+    # pair each bad pixel with every good pixel in its domain
+    bad = bad[np.argsort(domains[bad], kind='mergesort')]
+    ring = ring[np.argsort(domains[ring], kind='mergesort')]
+    lbad = domains[bad]
+    # offsets of each domain's good pixels within `ring`
+    first = np.cumsum(count * ok) - count * ok
+    nper = count[lbad]
+    i = np.repeat(np.arange(len(bad)), nper)
+    j = (np.arange(nper.sum())
+         - np.repeat(np.cumsum(nper) - nper, nper)
+         + np.repeat(first[lbad], nper))
+
+    if method == 'mean':
+        w = 1.0 / nper[i]
+    else:
+        ny, nx = mask.shape
+        d2 = ((bad[i] // nx - ring[j] // nx)**2
+              + (bad[i] % nx - ring[j] % nx)**2).astype(float)
+        w = 1.0 / d2
+        w /= np.bincount(i, w)[i]
+
+    W = sp.csr_matrix((w, (i, j)), shape=(len(bad), len(ring)))
+    return bad, ring, W.dot
+
+def _fixpix_biharmonic(mask, bad):
+    """Biharmonic interpolator for `_fixpix_filler`.
+
+    Solves the 13-point discrete biharmonic equation over all bad
+    pixels at once.  Where the stencil reaches beyond the image or
+    into bad pixels that are not being replaced, the 5-point Laplace
+    equation is used instead.
+
+    """
+
+    import scipy.sparse as sp
+    from scipy.sparse.linalg import splu
+
+    ny, nx = mask.shape
+    y, x = bad // nx, bad % nx
+    unknown = np.empty(mask.size, int)
+    unknown.fill(-1)
+    unknown[bad] = np.arange(len(bad))
+
+    stencil = np.array([
+        (0, 0, 20), (-1, 0, -8), (1, 0, -8), (0, -1, -8), (0, 1, -8),
+        (-1, -1, 2), (-1, 1, 2), (1, -1, 2), (1, 1, 2),
+        (-2, 0, 1), (2, 0, 1), (0, -2, 1), (0, 2, 1)])
+    sy = y[:, None] + stencil[:, 0]
+    sx = x[:, None] + stencil[:, 1]
+    inside = (sy >= 0) & (sy < ny) & (sx >= 0) & (sx < nx)
+    k = np.where(inside, sy * nx + sx, 0)
+    u = np.where(inside, unknown[k], -1)
+    valid = inside & ((u >= 0) | ~mask.ravel()[k])
+
+    # fall back on the Laplace equation where the stencil is broken
+    c = np.repeat(stencil[None, :, 2], len(bad), 0).astype(float)
+    laplace = ~valid.all(1)
+    c[laplace] = 0
+    c[laplace, 1:5] = np.where(valid[laplace, 1:5], 1.0, 0)
+    c[laplace, 0] = -c[laplace, 1:5].sum(1)
+    c[~valid] = 0
+
+    # unknown neighbors go into the matrix, known ones into the
+    # right-hand side
+    row = np.repeat(np.arange(len(bad))[:, None], len(stencil), 1)
+    s = (u >= 0) & (c != 0)
+    A = sp.csc_matrix((c[s], (row[s], u[s])), shape=(len(bad),) * 2)
+    s = (u < 0) & (c != 0)
+    good, j = np.unique(k[s], return_inverse=True)
+    B = sp.csr_matrix((-c[s], (row[s], j)), shape=(len(bad), len(good)))
+
+    lu = splu(A)
+
+    def fill(values):
+        return lu.solve(np.asarray(B.dot(values), float))
+
+    return bad, good, fill
+
+def _tile_weights(n, tiles):
+    """Bilinear tile weights along one axis for `psfmatch_tiled`.
+
+    Each weight is 1 at its tile center, falls linearly to 0 at the
+    neighboring tile centers, and is 1 from the outermost centers to
+    the edges of the image.  The weights sum to 1 at every pixel.
+
+    Returns
+    -------
+    weights : list
+      For each tile, the slice of the image where the weight is
+      non-zero, and the weights over that slice.
+
+    """
+
+    edges = np.linspace(0, n, tiles + 1)
+    centers = (edges[:-1] + edges[1:]) / 2.0 - 0.5
+    x = np.arange(n)
+    weights = []
+    for i in range(tiles):
+        w = np.ones(n)
+        if i > 0:
+            w = np.minimum(w, (x - centers[i - 1])
+                           / (centers[i] - centers[i - 1]))
+        if i < tiles - 1:
+            w = np.minimum(w, (centers[i + 1] - x)
+                           / (centers[i + 1] - centers[i]))
+        w = np.clip(w, 0, 1)
+        i0, i1 = np.flatnonzero(w)[[0, -1]]
+        weights.append((slice(i0, i1 + 1), w[i0:i1 + 1]))
+    return weights
+
+def _iter_frames(data):
+    """Iterate over a list of FITS files or a stack of images."""
+    from astropy.io import fits
+    if isinstance(data[0], _string_types):
+        for f in data:
+            yield fits.getdata(f)
+    else:
+        for im in data:
+            yield im
+
+def _read_wcs(filename):
+    """Header and WCS of the first image extension in a FITS file."""
+    from astropy.io import fits
+    from astropy.wcs import WCS
+    with fits.open(filename) as hdulist:
+        for hdu in hdulist:
+            if hdu.header.get('NAXIS', 0) > 0:
+                h = hdu.header.copy()
+                break
+        else:
+            h = hdulist[0].header.copy()
+    return h, WCS(h)
+
 # update module docstring
 from ..util import autodoc
 autodoc(globals())
@@ -14,6 +14,12 @@ observing --- Observing stuff
    file2targets
    plot_transit_time
 
+   Scheduling
+   ----------
+   Scheduler
+   greedy_timeline
+   windows
+
 """
 from __future__ import print_function
 import numpy as np
@@ -21,9 +27,11 @@ import astropy.units as u
 from astropy.coordinates import Angle
 
 from . import core
+from . import scheduler
 from .core import *
+from .scheduler import *
 
-__all__ = core.__all__ + [
+__all__ = core.__all__ + scheduler.__all__ + [
     'Observer',
     'Target',
 
@@ -70,6 +78,10 @@ class Observer(object):
       `None`, `date` will be set to now.
     name : string
       The name of the observer/observatory.
+    ephem_step : Quantity, optional
+      Moving target coordinates are computed for a whole night at
+      this step, cached, and linearly interpolated.  Set to `None` to
+      compute them at each date.
 
     Properties
     ----------
@@ -80,6 +92,8 @@ class Observer(object):
     -------
     airmass
     altaz
+    altaz_grid
+    clear_cache
     finding_chart
     lst
     lst0
@@ -88,11 +102,14 @@ class Observer(object):
 
     """
 
-    def __init__(self, lon, lat, tz, date, name=None):
+    def __init__(self, lon, lat, tz, date, name=None,
+                 ephem_step=1 * u.hr):
         from .. import util
         self.lon = Angle(lon)
         self.lat = Angle(lat)
         self.tz = tz
+        self.ephem_step = ephem_step
+        self._cache = dict()
         if date is None:
             self.date = util.date2time(None)
         else:
@@ -117,13 +134,13 @@ class Observer(object):
     @property
     def lst(self):
         """Local sidereal time."""
-        return Angle(core.ct2lst(self.date, self.lon.degree, self.tz),
+        return Angle(core.jd2lst(self.date.jd, self.lon.degree, self.tz),
                      unit=u.hr)
 
     @property
     def lst0(self):
         """Local sidereal time at nearest midnight."""
-        return Angle(core.ct2lst0(self.date, self.lon.degree, self.tz),
+        return Angle(core.ct2lst0(self.date.jd, self.lon.degree, self.tz),
                      unit=u.hr)
 
     def __repr__(self):
@@ -136,16 +153,67 @@ class Observer(object):
 
 
     def _radec(self, target, date):
+        """Target coordinates at `date` (civil time).
+
+        Moving targets are observed from the geocenter at the
+        corresponding UT.
+
+        """
+
+        if isinstance(target, Target):
+            return target.ra, target.dec
+
         from ..ephem import Earth, SolarSysObject
-        if isinstance(target, SolarSysObject):
-            g = Earth.observe(target, date, ltt=True)
-            ra = g['ra']
-            dec = g['dec']
-        else:
-            ra = target.ra
-            dec = target.dec
+        from ..util import jd2time
+
+        if not isinstance(target, SolarSysObject):
+            return target.ra, target.dec
+
+        jd = core._jd(date)
+        if self.ephem_step is None:
+            ut = jd - core._tzoff(jd, self.tz) / 24.0
+            g = Earth.observe(target, jd2time(ut), ltt=True)
+            return g['ra'], g['dec']
+
+        shape = np.shape(jd)
+        jd = np.atleast_1d(jd)
+        ra = np.empty(jd.shape)
+        dec = np.empty(jd.shape)
+        night = np.round(jd - 0.5) + 0.5
+        for jd0 in np.unique(night):
+            i = night == jd0
+            t, r, d = self._ephemeris(target, jd0)
+            ra[i] = np.interp(jd[i], t, r)
+            dec[i] = np.interp(jd[i], t, d)
+
+        ra = Angle(ra.reshape(shape) % 360, u.deg)
+        dec = Angle(dec.reshape(shape), u.deg)
         return ra, dec
 
+    def _ephemeris(self, target, jd0):
+        """Cached coordinates of `target` for the night of `jd0`.
+
+        `jd0` is a civil midnight, and the grid is in civil time.
+
+        """
+        from ..ephem import Earth
+        from ..util import jd2time
+
+        step = u.Quantity(self.ephem_step, u.day).value
+        key = ('ephemeris', target, jd0, step, self.tz)
+        if key not in self._cache:
+            n = int(np.ceil(1.0 / step))
+            t = jd0 + np.linspace(-0.5, 0.5, n + 1)
+            ut = t - core._tzoff(jd0, self.tz) / 24.0
+            g = Earth.observe(target, jd2time(ut), ltt=True)
+            ra = np.degrees(np.unwrap(g['ra'].radian))
+            self._cache[key] = t, ra, g['dec'].degree
+        return self._cache[key]
+
+    def clear_cache(self):
+        """Remove the cached moving target coordinates."""
+        self._cache = dict()
+
     def airmass(self, target):
         """Target airmass.
 
@@ -189,6 +257,52 @@ class Observer(object):
                                    self.lat.degree)
         return Angle(alt, unit=u.deg), Angle(az, unit=u.deg)
 
+    def altaz_grid(self, targets, dt=None):
+        """Altitude, azimuth, and airmass of targets over a night.
+
+        Fixed and moving targets are computed together, see
+        `core.altaz_grid`.
+
+        Parameters
+        ----------
+        targets : Target or array
+          The target(s) to observe.
+        dt : Quantity, optional
+          Time offsets from the nearest midnight, default is 100 steps
+          from -12 to +12 hr.
+
+        Returns
+        -------
+        alt, az : Angle
+          `(N, M)` altitude and azimuth for `N` targets and `M` times.
+        am : ndarray
+          `(N, M)` airmass.
+
+        """
+
+        from ..util import jd2time
+
+        if not isinstance(targets, (list, tuple)):
+            targets = [targets]
+
+        if dt is None:
+            dt = np.linspace(-12, 12, 100) * u.hr
+        dt = u.Quantity(dt, u.hr)
+
+        # round to nearest day
+        date = jd2time(round(self.date.jd - 0.5) + 0.5) + dt
+
+        ra = np.empty((len(targets), len(dt)))
+        dec = np.empty((len(targets), len(dt)))
+        for i, target in enumerate(targets):
+            r, d = self._radec(target, date)
+            ra[i] = r.degree
+            dec[i] = d.degree
+
+        alt, az, am = core.altaz_grid(ra, dec, date, self.lon.degree,
+                                      self.lat.degree, self.tz)
+        return Angle(alt, unit=u.deg), Angle(az, unit=u.deg), am
+
     def finding_chart(self, target, ds9, trange=[-6, 6] * u.hr, ticks=1 * u.hr,
                       fov=1 * u.arcmin, frame=1, dss=True):
         """Plot a DS9 finding chart for a moving target.
@@ -216,7 +330,7 @@ class Observer(object):
 
         import matplotlib.pyplot as plt
         import pysao
-        from ..ephem import Earth, SolarSysObject
+        from ..ephem import SolarSysObject
 
         assert isinstance(target, SolarSysObject), "target must be a SolarSysObject"
         trange = u.Quantity(trange, u.hr)
@@ -224,13 +338,13 @@ class Observer(object):
         ds9 = ds9 if ds9 is not None else pysao.ds9()
 
         # DSS
-        g = Earth.observe(target, self.date, ltt=True)
+        ra, dec = self._radec(target, self.date)
         ds9.set('frame {}'.format(frame))
         ds9.set('dsssao frame current')
         ds9.set('dsssao size 60 60')
         ds9.set('dsssao coord {} {}'.format(
-            g['ra'].to_string(u.hr, sep=':'),
-            g['dec'].to_string(u.deg, sep=':')))
+            ra.to_string(u.hr, sep=':'),
+            dec.to_string(u.deg, sep=':')))
         ds9.set('dsssao close')
         ds9.set('cmap b')
         ds9.set('align')
@@ -241,20 +355,20 @@ class Observer(object):
                 fov = [fov, fov]
             fov_deg = u.Quantity(fov, u.deg).value
             reg = 'fk5; box {} {} {} {} 0'.format(
-                g['ra'].to_string(u.hr, sep=':'),
-                g['dec'].to_string(u.deg, sep=':'),
+                ra.to_string(u.hr, sep=':'),
+                dec.to_string(u.deg, sep=':'),
                 fov_deg[0], fov_deg[1])
             ds9.set('regions', reg)
 
         # path
         dt = np.linspace(trange[0], trange[1], 31)
-        g = Earth.observe(target, self.date + dt, ltt=True)
-        for i in range(len(g) - 1):
+        ra, dec = self._radec(target, self.date + dt)
+        for i in range(len(ra) - 1):
             ds9.set('regions', 'fk5; line {} {} {} {}'.format(
-                g[i]['ra'].to_string(u.hr, sep=':'),
-                g[i]['dec'].to_string(u.deg, sep=':'),
-                g[i+1]['ra'].to_string(u.hr, sep=':'),
-                g[i+1]['dec'].to_string(u.deg, sep=':')))
+                ra[i].to_string(u.hr, sep=':'),
+                dec[i].to_string(u.deg, sep=':'),
+                ra[i+1].to_string(u.hr, sep=':'),
+                dec[i+1].to_string(u.deg, sep=':')))
 
         # ticks
         dt1 = np.arange(0, trange[0].value, -ticks.value)
@@ -265,19 +379,19 @@ class Observer(object):
             dt2 = np.concatenate((dt2, [trange[1].value]))
         dt = np.concatenate((dt1[::-1], dt2)) * u.hr
         del dt1, dt2
-        g = Earth.observe(target, self.date + dt, ltt=True)
-        for i in range(len(g)):
+        ra, dec = self._radec(target, self.date + dt)
+        for i in range(len(ra)):
             s = 'fk5; point({},{}) # point=cross'.format(
-                g[i]['ra'].to_string(u.hr, sep=':'),
-                g[i]['dec'].to_string(u.deg, sep=':'))
+                ra[i].to_string(u.hr, sep=':'),
+                dec[i].to_string(u.deg, sep=':'))
             if i == 0:
                 s = s.replace('cross', 'circle')
             ds9.set('regions', s)
 
-        g = Earth.observe(target, self.date, ltt=True)
+        ra, dec = self._radec(target, self.date)
         ds9.set('regions', 'fk5; point({},{}) # point=x'.format(
-            g['ra'].to_string(u.hr, sep=':'),
-            g['dec'].to_string(u.deg, sep=':')))
+            ra.to_string(u.hr, sep=':'),
+            dec.to_string(u.deg, sep=':')))
 
         return ds9
 
@@ -302,34 +416,26 @@ class Observer(object):
 
         """
 
-        from datetime import timedelta
         import matplotlib.pyplot as plt
-        from ..util import jd2time
 
         if ax is None:
             ax = plt.gca()
         label = kwargs.pop('label', target.name)
 
-        # round to nearest day
-        date = jd2time(round(self.date.jd - 0.5) + 0.5)
-
-        am = np.zeros(N)
         dt = np.linspace(-12, 12, N) * u.hr
-        for i in range(N):
-            ra, dec = self._radec(target, date + dt[i])
-            am[i] = core.airmass(ra.degree, dec.degree,
-                                 date + dt[i],
-                                 self.lon.degree, self.lat.degree,
-                                 self.tz)
-
+        am = self.altaz_grid(target, dt)[2][0]
         return ax.plot(dt.value, am, label=label, **kwargs)
 
     def rts(self, target, limit=20):
         """Rise, transit, set times for targets.
 
+        Fixed targets are computed analytically with `core.rts`,
+        moving targets with `core.rts_moving`.  Both return the first
+        events from noon to noon around the nearest midnight.
+
         Parameters
         ----------
-        target : Target or array
+        target : Target, SolarSysObject, or array
           The target(s) to observe.
         limit : float
           The altitude at which the target is considered risen/set.
@@ -339,38 +445,60 @@ class Observer(object):
         r, t, s : Quantity
           Rise, transit, set times.  `rise` and `set` will be `None`
           if the target never sets.  `transit` will be `None` if the
-          target never rises.
+          target never rises.  For an array of targets, a tuple of
+          `(r, t, s)` is returned.
 
         """
 
         from ..util import dh2hms
 
-        if isinstance(target, (list, tuple)):
-            times = ()
-            for t in target:
-                times += (self.rts(t, limit=limit), )
-            return times
-
-        ra, dec = self._radec(target, self.date)
-        r, t, s = rts(ra.degree, dec.degree, self.date, self.lon.degree,
-                      self.lat.degree, self.tz, limit)
-        if t is not None:
-            t = t * u.hr
-
-        if r is not None:
-            r = r * u.hr
-            s = s * u.hr
-
-        rr, tt, ss = None, None, None
-        if r is not None:
-            rr = dh2hms(r.value, '{:02d}:{:02d}')
-        if t is not None:
-            tt = dh2hms(t.value, '{:02d}:{:02d}')
-        if s is not None:
-            ss = dh2hms(s.value, '{:02d}:{:02d}')
-        print("{:32s} {} {} {}".format(target.name, rr, tt, ss))
-
-        return r, t, s
+        targets = target
+        if not isinstance(target, (list, tuple)):
+            targets = [target]
+
+        times = np.empty((len(targets), 3))
+        fixed = [isinstance(t, Target) for t in targets]
+        i = np.flatnonzero(fixed)
+        if len(i) > 0:
+            ra = [targets[k].ra.degree for k in i]
+            dec = [targets[k].dec.degree for k in i]
+            times[i] = np.array(
+                rts(ra, dec, self.date, self.lon.degree,
+                    self.lat.degree, self.tz, limit)).T
+
+        i = np.flatnonzero(~np.array(fixed))
+        if len(i) > 0:
+            radec = self._radec_function([targets[k] for k in i])
+            times[i] = np.array(
+                rts_moving(radec, self.date, self.lon.degree,
+                           self.lat.degree, self.tz, limit)).T
+
+        results = ()
+        for t, rts_ in zip(targets, times):
+            rts_ = [None if np.isnan(x) else x * u.hr for x in rts_]
+            hms = [None if x is None else dh2hms(x.value, '{:02d}:{:02d}')
+                   for x in rts_]
+            print("{:32s} {} {} {}".format(t.name, *hms))
+            results += (tuple(rts_), )
+
+        if not isinstance(target, (list, tuple)):
+            return results[0]
+        return results
+
+    def _radec_function(self, targets):
+        """Target positions as a function of date, for `core.rts_moving`."""
+
+        def radec(jd):
+            jd = np.broadcast_to(jd, (len(targets), jd.shape[1]))
+            ra = np.empty(jd.shape)
+            dec = np.empty(jd.shape)
+            for i, target in enumerate(targets):
+                r, d = self._radec(target, jd[i])
+                ra[i] = r.degree
+                dec[i] = d.degree
+            return ra, dec
+
+        return radec
 
 def am_plot(targets, observer, fig=None, ylim=[2.5, 1], **kwargs):
     """Generate a letter-sized, pretty airmass plot for a night.
@@ -387,7 +515,7 @@ def am_plot(targets, observer, fig=None, ylim=[2.5, 1], **kwargs):
     ylim : array
       Y-axis limits (airmass).
     **kwargs
-      Keyword arguments for `Observer.plot_am`.
+      Any `matplotlib.pyplot.plot` keywords.
 
     Returns
     -------
@@ -423,14 +551,22 @@ def am_plot(targets, observer, fig=None, ylim=[2.5, 1], **kwargs):
     civil_twilight = ephem.getspiceobj('Sun', kernel='planets.bsp',
                                        name='Civil twilight')
 
-    for target in targets:
+    # airmass for all targets at once
+    dt = np.linspace(-12, 12, 100) * u.hr
+    am = observer.altaz_grid(list(targets) + [ephem.Sun, ephem.Moon],
+                             dt)[2]
+
+    for i, target in enumerate(targets):
         ls, color = linestyles.next()
-        observer.plot_am(target, color=color, ls=ls, **kwargs)
+        ax.plot(dt.value, am[i], color=color, ls=ls, label=target.name,
+                **kwargs)
         observer.rts(target, limit=25)
 
     print()
-    for target, ls in zip((ephem.Sun, ephem.Moon), ('y--', 'k:')):
-        observer.plot_am(target, color=ls[0], ls=ls[1:], **kwargs)
+    for i, target, ls in zip((-2, -1), (ephem.Sun, ephem.Moon),
+                             ('y--', 'k:')):
+        ax.plot(dt.value, am[i], color=ls[0], ls=ls[1:],
+                label=target.name, **kwargs)
         observer.rts(target, limit=0)
 
     at_rts = observer.rts(astro_twilight, limit=-18)
@@ -6,10 +6,13 @@ observing.core --- Core observing functions
    Functions
    ---------
    airmass
+   altaz_grid
    ct2lst
    ct2lst0
    hadec2altaz
+   jd2lst
    rts
+   rts_moving
 
 """
 
@@ -17,10 +20,13 @@ import numpy as np
 
 __all__ = [
     'airmass',
+    'altaz_grid',
     'ct2lst',
     'ct2lst0',
     'hadec2altaz',
-    'rts'
+    'jd2lst',
+    'rts',
+    'rts_moving'
 ]
 
 def airmass(ra, dec, date, lon, lat, tz):
@@ -50,26 +56,54 @@ def airmass(ra, dec, date, lon, lat, tz):
 
     """
 
-    lst = ct2lst(date, lon, tz) * 15.0
+    lst = jd2lst(_jd(date), lon, tz) * 15.0
     ha = lst - ra
     alt = hadec2altaz(ha, dec, lat)[0]
+    return _airmass(alt)
 
-    old = np.seterr(invalid='ignore')
-    secz = 1.0 / np.cos(np.radians(90.0 - alt))
-    am = 1.0 / (np.sin(np.radians(alt)) + 0.1500 * (alt + 3.885)**-1.253)
-    np.seterr(**old)
+def altaz_grid(ra, dec, date, lon, lat, tz):
+    """Altitude, azimuth, and airmass of many targets at many times.
 
-    if np.iterable(am):
-        am[alt < 1.0] = np.nan
-    else:
-        if alt < 1.0:
-            am = np.nan
-    return am
+    Parameters
+    ----------
+    ra, dec : float or array
+      Right ascension and declination of the targets.  Fixed targets
+      have shape `(N,)`, moving targets may be given at each date,
+      `(N, M)`. [deg]
+    date : string, float, astropy Time, datetime, or array
+      The `M` dates (civil time), passed to `util.date2time`.
+    lon, lat : float
+      The (east) longitude, and latitude of the Earth-bound
+      observer. [deg]
+    tz : float or string
+      float: The UTC offset of the observer. [hr]
+      string: A timezone name processed with `pytz` (e.g., US/Arizona).
+
+    Returns
+    -------
+    alt, az, am : ndarray
+      `(N, M)` arrays of altitude, azimuth [deg], and airmass.  See
+      `airmass` for the airmass method.
+
+    """
+
+    lst = np.atleast_1d(jd2lst(_jd(date), lon, tz)) * 15.0
+    ra = np.atleast_1d(np.asarray(ra, float))
+    dec = np.atleast_1d(np.asarray(dec, float))
+    if ra.ndim == 1:
+        ra = ra[:, np.newaxis]
+    if dec.ndim == 1:
+        dec = dec[:, np.newaxis]
+
+    alt, az = hadec2altaz(lst - ra, dec, lat)
+    return alt, az, _airmass(alt)
 
 def ct2lst(date, lon, tz):
     """Convert civil time to local sidereal time.
 
-    See Meeus, Astronomical Algorithms.
+    See Meeus, Astronomical Algorithms.  Julian dates are processed
+    directly with `jd2lst`, other dates are converted with
+    `util.date2time`.
 
     Parameters
     ----------
@@ -88,22 +122,7 @@ def ct2lst(date, lon, tz):
 
     """
 
-    from ..util import date2time, tz2utc
-
-    d = date2time(date)
-    jd = d.jd
-    if isinstance(tz, float):
-        tzoff = tz
-    else:
-        tzoff = tz2utc(d, tz).total_seconds() / 3600.0
-
-    jd0 = np.round(jd - tzoff / 24.0 - 1.0) + 0.5  # JD for 0h UT
-    T = (jd - 2451545.0) / 36525  # JD2000 = 2451545
-    th0 = 280.46061837 + 360.98564736629 * (jd - 2451545.0) + \
-        0.000387933 * T**2 - T**3 / 38710000.0
-    th0 = th0 % 360.0
-    lst = ((th0 + lon) / 15.0  - tzoff) % 24.0
-    return lst
+    return jd2lst(_jd(date), lon, tz)
 
 def ct2lst0(date, lon, tz):
     """Convert civil time to local sidereal time at nearest midnight.
@@ -127,11 +146,8 @@ def ct2lst0(date, lon, tz):
 
     """
 
-    from ..util import date2time
-
-    d = date2time(date)
-    jd = round(d.jd - 0.5) + 0.5
-    return ct2lst(jd, lon, tz)
+    jd = np.round(_jd(date) - 0.5) + 0.5
+    return jd2lst(jd, lon, tz)
 
 def hadec2altaz(ha, dec, lat):
     """Convert hour angle and declination to altitude and azimuth.
@@ -176,15 +192,60 @@ def hadec2altaz(ha, dec, lat):
 
     return alt, az
 
-def rts(ra, dec, date, lon, lat, tz, limit=20, precision=1440):
+def jd2lst(jd, lon, tz=0.0):
+    """Local sidereal time from Julian dates.
+
+    See Meeus, Astronomical Algorithms.
+
+    Parameters
+    ----------
+    jd : float or array
+      The Julian dates (civil time).
+    lon : float
+      The East longitude of the observer. [deg]
+    tz : float or string, optional
+      float: The UTC offset of the observer. [hr]
+      string: A timezone name processed with `pytz` (e.g., US/Arizona).
+        The offset is computed once per night, at the nearest
+        midnight, and cached.
+
+    Returns
+    -------
+    lst : float or ndarray
+      The local sidereal time.  [hr]
+
+    """
+
+    # evaluated in place to avoid temporary arrays
+    jd = np.asarray(jd, float)
+    d = jd - (2451545.0 + _tzoff(jd, tz) / 24.0)  # UT - JD2000
+    T = d / 36525
+    th0 = T / -38710000.0
+    th0 += 0.000387933
+    th0 *= T
+    th0 *= T
+    th0 += 360.98564736629 * d
+    th0 += 280.46061837 + lon
+
+    # (th0 / 15) % 24, but faster
+    lst = th0
+    lst /= 360.0
+    lst -= np.floor(lst)
+    lst *= 24.0
+    return lst if lst.ndim > 0 else float(lst)
+
+def rts(ra, dec, date, lon, lat, tz, limit=20, precision=None):
     """Rise, transit, set times for an object.
 
-    Rise and set may be at the horizon, or elsewhere.
+    Rise and set may be at the horizon, or elsewhere.  The times are
+    computed analytically from the hour angle of the `limit`
+    crossing.  For moving targets, see `rts_moving`, which follows
+    the same conventions.
 
     Parameters
     ----------
-    ra, dec : float
-      Right ascension and declination of the target. [deg]
+    ra, dec : float or array
+      Right ascension and declination of the target(s). [deg]
     date : string, float, astropy Time, datetime, or array
       The current date (civil time), passed to `util.date2time`.
     lon, lat : float
@@ -196,58 +257,204 @@ def rts(ra, dec, date, lon, lat, tz, limit=20, precision=1440):
     limit : float
       The altitude at which the object should be considered
       risen/set. [deg]
-    precision : int
-      Number of steps to take per day, affecting the r/t/s precision.
+    precision : int, optional
+      Unused, kept for backwards compatibility.
 
     Returns
     -------
-    r, t, s : float
-      Rise, transit, set times for `date`.  If the object does not
+    r, t, s : float or ndarray
+      Rise, transit, set times: the first of each in the 24 hr
+      centered on the midnight nearest `date`, i.e., from noon to
+      noon.  The rise may follow the set.  If the object does not
       set, `r` and `s` will be `None`.  If the object is always lower
-      than `limit`, `t` will be `None`. [hr]
+      than `limit`, `t` will be `None`.  For arrays of targets, these
+      cases are NaN. [hr]
 
     """
 
-    from ..util import date2time, nearest, deriv
+    ra = np.asarray(ra, float)
+    dec = np.asarray(dec, float)
+    scalar = (ra.ndim == 0) and (dec.ndim == 0)
+    ra, dec = np.broadcast_arrays(np.atleast_1d(ra), np.atleast_1d(dec))
 
-    # truncate the date
-    lst0 = ct2lst0(date, lon, tz) * 15.0 # deg
+    # transit time, relative to midnight, in [-12, 12) hr
+    lst0 = ct2lst0(date, lon, tz)  # hr
+    t = ((ra / 15.0 - lst0 + 12) % 24 - 12) / _sidereal_rate
 
-    ha = np.linspace(-180, 180, precision, endpoint=False)
-    ct = np.linspace(-12, 12, precision, endpoint=False)  # civil time
-    ct[ct < 0] += 24
+    # hour angle of the limit crossing
+    d = np.radians(dec)
+    phi = np.radians(lat)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cosh = ((np.sin(np.radians(limit)) - np.sin(phi) * np.sin(d))
+                / (np.cos(phi) * np.cos(d)))
+        dt = np.degrees(np.arccos(cosh)) / 15.0 / _sidereal_rate
 
-    # roll ha, so that we get the correct hour angle at midnight
-    ha0 = (lst0 - ra) % 360.0  # HA at midnight
-    if ha0 > 180:
-        ha0 -= 360.0
+    # the first of each event after noon, one sidereal day apart
+    day = 24 / _sidereal_rate
+    r, t, s = [((x + 12) % day - 12) % 24 for x in (t - dt, t, t + dt)]
 
-    i = nearest(ha, ha0)
-    ha = np.roll(ha, precision / 2 - i)
+    up = cosh < -1  # never sets
+    down = ~(cosh <= 1)  # never rises
+    r[up + down] = np.nan
+    s[up + down] = np.nan
+    t[down] = np.nan
 
-    alt = hadec2altaz(ha, dec, lat)[0]
-
-    # make a branch cut at alt.min()
-    cut = alt.argmin()
-    alt = np.roll(alt, -cut)
-    ct = np.roll(ct, -cut)
-    dalt = deriv(alt)
-
-    transit = alt.argmax()
-    if not any(alt < limit):
-        r, t, s = None, ct[transit], None
-    elif all(alt < limit):
-        r, t, s = None, None, None
-    else:
-        t = ct[transit]
-        i = nearest(alt[:transit], limit)
-        j = transit + nearest(alt[transit:], limit)
-        if dalt[i] > 0:
-            r = ct[i]
-            s = ct[j]
-        else:
-            r = ct[j]
-            s = ct[i]
+    if scalar:
+        r, t, s = [None if np.isnan(x[0]) else x[0] for x in (r, t, s)]
 
     return r, t, s
-        
+
+def rts_moving(radec, date, lon, lat, tz, limit=20, steps=48, tol=0.01):
+    """Rise, transit, set times for moving objects.
+
+    The events are bracketed on a coarse time grid, then refined by
+    bisection, for all targets at once.
+
+    Parameters
+    ----------
+    radec : function
+      Called as `ra, dec = radec(jd)` to compute the positions of `N`
+      targets.  `jd` is an array of dates (civil time), either `(1,
+      K)` for `K` dates common to all targets, or `(N, 1)` for one
+      date per target, and `ra`, `dec` are `(N, K)` or `(N, 1)`. [deg]
+    date : string, float, astropy Time, datetime
+      The current date (civil time), passed to `util.date2time`.
+    lon, lat : float
+      The (east) longitude, and latitude of the Earth-bound
+      observer. [deg]
+    tz : float or string
+      float: The UTC offset of the observer. [hr]
+      string: A timezone name processed with `pytz` (e.g., US/Arizona).
+    limit : float or array
+      The altitude at which the object should be considered
+      risen/set, may be given per target. [deg]
+    steps : int, optional
+      Number of steps per day for the coarse grid.  Events closer
+      together than a step may be missed.
+    tol : float, optional
+      Precision of the results. [s]
+
+    Returns
+    -------
+    r, t, s : ndarray
+      Rise, transit, set times: the first of each in the 24 hr
+      centered on the midnight nearest `date`, i.e., from noon to
+      noon, as in `rts`, or NaN if there is no such event.  The
+      transit is NaN if the object is always lower than `limit`.
+      [hr]
+
+    """
+
+    jd0 = round(float(_jd(date)) - 0.5) + 0.5
+    jd = jd0 + np.linspace(-0.5, 0.5, steps + 1)
+
+    def ha_alt(jd):
+        ra, dec = radec(jd)
+        lst = jd2lst(jd, lon, tz) * 15.0
+        ha = (lst - ra + 180) % 360 - 180
+        return ha, hadec2altaz(ha, dec, lat)[0]
+
+    ha, alt = ha_alt(jd[np.newaxis])
+    n = ha.shape[0]
+    limit = np.resize(np.asarray(limit, float), n)[:, np.newaxis]
+
+    # the hour angle increases through 0 at transit; avoid the
+    # +/-180 branch cut
+    f = ha.copy()
+    f[:, 1:][np.abs(np.diff(ha, axis=1)) > 180] = np.nan
+    with np.errstate(invalid='ignore'):
+        t = _first_root(lambda x: ha_alt(x)[0], jd, f, True, tol)
+        r = _first_root(lambda x: ha_alt(x)[1] - limit, jd, alt - limit,
+                        True, tol)
+        s = _first_root(lambda x: ha_alt(x)[1] - limit, jd, alt - limit,
+                        False, tol)
+    t[(alt < limit).all(1)] = np.nan
+
+    return [(x - jd0) * 24 % 24 for x in (r, t, s)]
+
+def _first_root(func, x, f, rising, tol):
+    """First root of each row of `f`, refined by bisection.
+
+    Parameters
+    ----------
+    func : function
+      `func(x)` for `(N, 1)` arrays of `x`, used for refinement.
+    x : ndarray
+      `(M,)` grid.
+    f : ndarray
+      `(N, M)` array of `func` evaluated on `x`.
+    rising : bool
+      Find crossings from negative to positive values, else the
+      reverse.
+    tol : float
+      Precision of the roots. [s]
+
+    Returns
+    -------
+    x0 : ndarray
+      The `(N,)` roots in units of `x`, NaN for rows without a root.
+
+    """
+
+    if rising:
+        cross = (f[:, :-1] < 0) * (f[:, 1:] >= 0)
+    else:
+        cross = (f[:, :-1] >= 0) * (f[:, 1:] < 0)
+    ok = cross.any(1)
+    k = cross.argmax(1)
+
+    a = x[k]
+    b = x[k + 1]
+    fa = f[np.arange(len(f)), k]
+    tol = tol / 86400.0
+    while np.any(ok * (b - a > tol)):
+        c = (a + b) / 2.0
+        fc = func(c[:, np.newaxis])[:, 0]
+        left = (fa < 0) == (fc < 0)
+        a = np.where(left, c, a)
+        fa = np.where(left, fc, fa)
+        b = np.where(left, b, c)
+
+    return np.where(ok, (a + b) / 2.0, np.nan)
+
+def _airmass(alt):
+    """Airmass at altitude `alt`, see `airmass`."""
+    alt = np.asarray(alt, float)
+    with np.errstate(invalid='ignore'):
+        am = 1.0 / (np.sin(np.radians(alt))
+                    + 0.1500 * (alt + 3.885)**-1.253)
+        am = np.where(alt < 1.0, np.nan, am)
+    return am if am.ndim > 0 else float(am)
+
+def _jd(date):
+    """Julian dates of `date`; numeric arrays are passed through."""
+    from ..util import date2time
+    if (isinstance(date, (float, int, np.ndarray))
+        and np.issubdtype(np.asarray(date).dtype, np.number)):
+        return np.asarray(date, float)
+    return date2time(date).jd
+
+def _tzoff(jd, tz):
+    """UTC offset of `tz` at Julian dates `jd`, see `jd2lst`. [hr]"""
+    from ..util import jd2time, tz2utc
+
+    if isinstance(tz, (float, int)):
+        return float(tz)
+
+    # one offset per night, at the nearest midnight
+    night = np.round(np.asarray(jd, float) - 0.5) + 0.5
+    n0 = night.min()
+    midnights = n0 + np.arange(int(night.max() - n0) + 1)
+    for m in midnights:
+        if (tz, m) not in _tzoff_cache:
+            dt = tz2utc(jd2time(m), tz)
+            _tzoff_cache[(tz, m)] = dt.total_seconds() / 3600.0
+    offsets = np.array([_tzoff_cache[(tz, m)] for m in midnights])
+    if np.all(offsets == offsets[0]):
+        return offsets[0]
+    return offsets[(night - n0).astype(int)]
+
+_tzoff_cache = dict()
+
+# ratio of sidereal to solar (civil) time
+_sidereal_rate = 1.00273790935
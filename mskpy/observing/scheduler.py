@@ -0,0 +1,386 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+scheduler --- Observability windows and night plans
+===================================================
+
+   Classes
+   -------
+   Scheduler
+
+   Functions
+   ---------
+   greedy_timeline
+   windows
+
+"""
+
+from __future__ import print_function
+import numpy as np
+import astropy.units as u
+
+from . import core
+
+__all__ = [
+    'Scheduler',
+    'greedy_timeline',
+    'windows'
+]
+
+class Scheduler(object):
+    """Observability windows and timelines for a list of targets.
+
+    A night runs from evening to morning twilight, centered on the
+    midnight nearest a date.  Targets are observable when they are
+    below `max_airmass` and far enough from the Moon and Sun.
+    Coordinates of moving targets, the Sun, and the Moon are cached
+    by `observer`, see `Observer.ephem_step`.
+
+    Parameters
+    ----------
+    observer : Observer
+      The observer.
+    targets : list of Target or SolarSysObject
+      The targets, e.g., from `file2targets`.
+    max_airmass : float or array, optional
+      Airmass limit, may be given per target.
+    twilight : float, optional
+      The solar altitude at the beginning and end of the night. [deg]
+    min_moon_sep : float, optional
+      Minimum separation from the Moon. [deg]
+    min_elong : float, optional
+      Minimum solar elongation. [deg]
+    step : Quantity, optional
+      Time resolution of the observability grid.
+    sun, moon : SolarSysObject or Target, optional
+      The objects used for twilight, elongation, and Moon separation.
+      Default is `ephem.Sun` and `ephem.Moon`.
+
+    Methods
+    -------
+    night - The start and end of a night.
+    observability - Observability of all targets over a night.
+    plan - Greedy timeline for a range of nights.
+    windows - Observability windows for a range of nights.
+
+    """
+
+    def __init__(self, observer, targets, max_airmass=2.0, twilight=-12,
+                 min_moon_sep=30, min_elong=45, step=5 * u.min,
+                 sun=None, moon=None):
+        from . import Target
+
+        self.observer = observer
+        self.targets = list(targets)
+        self.max_airmass = np.resize(np.asarray(max_airmass, float),
+                                     len(self.targets))
+        self.twilight = twilight
+        self.min_moon_sep = min_moon_sep
+        self.min_elong = min_elong
+        self.step = u.Quantity(step, u.day).value
+
+        if sun is None or moon is None:
+            from .. import ephem
+            sun = ephem.Sun if sun is None else sun
+            moon = ephem.Moon if moon is None else moon
+        self.sun = sun
+        self.moon = moon
+
+        self._fixed = np.array([isinstance(t, Target)
+                                for t in self.targets], bool)
+        self._ra = np.zeros(len(self.targets))
+        self._dec = np.zeros(len(self.targets))
+        for i in np.flatnonzero(self._fixed):
+            self._ra[i] = self.targets[i].ra.degree
+            self._dec[i] = self.targets[i].dec.degree
+
+    def _jd0(self, date):
+        """Civil midnight nearest `date`."""
+        from ..util import date2time
+        return round(date2time(date).jd - 0.5) + 0.5
+
+    def _ephemeris(self, target, jd):
+        """RA and Dec of `target` at civil Julian dates `jd`."""
+        ra, dec = self.observer._radec(target, jd)
+        ra = ra.degree * np.ones(jd.shape)
+        dec = dec.degree * np.ones(jd.shape)
+        return ra, dec
+
+    def night(self, date):
+        """The start and end of a night.
+
+        Parameters
+        ----------
+        date : string, float, astropy Time, datetime
+          The night is centered on the civil midnight nearest this
+          date, see `util.date2time`.
+
+        Returns
+        -------
+        start, end : float
+          The Julian dates (civil time) of evening and morning
+          twilight.  If the Sun does not reach `twilight`, they are
+          equal.
+
+        """
+
+        jd0 = self._jd0(date)
+
+        def radec(jd):
+            return self._ephemeris(self.sun, jd)
+
+        lon = self.observer.lon.degree
+        lat = self.observer.lat.degree
+        r, t, s = core.rts_moving(radec, jd0, lon, lat, self.observer.tz,
+                                  limit=self.twilight)
+        if np.isnan(r[0]) or np.isnan(s[0]):
+            ra, dec = radec(np.array([jd0]))
+            alt = core.altaz_grid(ra, dec, jd0, lon, lat,
+                                  self.observer.tz)[0]
+            if alt[0, 0] < self.twilight:
+                return jd0 - 0.5, jd0 + 0.5
+            return jd0, jd0
+
+        start = jd0 + ((s[0] + 12) % 24 - 12) / 24.0
+        end = jd0 + ((r[0] + 12) % 24 - 12) / 24.0
+        return start, end
+
+    def observability(self, date):
+        """Observability of all targets over a night.
+
+        Parameters
+        ----------
+        date : string, float, astropy Time, datetime
+          The night is centered on the civil midnight nearest this
+          date, see `util.date2time`.
+
+        Returns
+        -------
+        jd : ndarray
+          The `M` Julian dates (civil time) of the grid, from evening
+          to morning twilight.
+        mask : ndarray
+          `(N, M)` array, `True` where each target is observable.
+        am : ndarray
+          `(N, M)` array of airmass.
+
+        """
+
+        start, end = self.night(date)
+        jd = np.arange(start, end, self.step)
+        n = len(self.targets)
+        if len(jd) == 0:
+            return jd, np.zeros((n, 0), bool), np.zeros((n, 0))
+
+        ra = np.repeat(self._ra[:, np.newaxis], len(jd), 1)
+        dec = np.repeat(self._dec[:, np.newaxis], len(jd), 1)
+        for i in np.flatnonzero(~self._fixed):
+            ra[i], dec[i] = self._ephemeris(self.targets[i], jd)
+
+        am = core.altaz_grid(ra, dec, jd, self.observer.lon.degree,
+                             self.observer.lat.degree,
+                             self.observer.tz)[2]
+
+        with np.errstate(invalid='ignore'):
+            mask = am <= self.max_airmass[:, np.newaxis]
+        for obj, limit in ((self.moon, self.min_moon_sep),
+                           (self.sun, self.min_elong)):
+            if limit is None or limit <= 0:
+                continue
+            ra1, dec1 = self._ephemeris(obj, jd)
+            mask *= _separation(ra, dec, ra1, dec1) >= limit
+
+        return jd, mask, am
+
+    def windows(self, dates):
+        """Observability windows for a range of nights.
+
+        Parameters
+        ----------
+        dates : array
+          The nights, see `observability`.
+
+        Returns
+        -------
+        win : ndarray
+          A structured array of windows, with fields `night` (index
+          of `dates`), `target` (index of `targets`), `start`, and
+          `end` (Julian dates, civil time).
+
+        """
+
+        win = []
+        for night, date in enumerate(dates):
+            jd, mask, am = self.observability(date)
+            w = windows(mask, jd.astype(float))
+            win.append(np.zeros(len(w), dtype=_plan_dtype[:4]))
+            win[-1]['night'] = night
+            for k in ['target', 'start', 'end']:
+                win[-1][k] = w[k]
+
+        if len(win) == 0:
+            return np.zeros(0, dtype=_plan_dtype[:4])
+        return np.concatenate(win)
+
+    def plan(self, dates, duration=30 * u.min, priority=None, nvisits=1):
+        """Greedy timeline for a range of nights.
+
+        Each night is planned with `greedy_timeline`.  A target is
+        observed at most once per night, until it has been observed
+        `nvisits` times.
+
+        Parameters
+        ----------
+        dates : array
+          The nights, see `observability`.
+        duration : Quantity, optional
+          Duration of each observation, may be given per target.
+        priority : array, optional
+          Target priorities, larger first.  Default is equal
+          priority.
+        nvisits : int or array, optional
+          Number of visits per target.
+
+        Returns
+        -------
+        plan : ndarray
+          A structured array of the observations, in time order, with
+          fields `night` (index of `dates`), `target` (index of
+          `targets`), `start`, `end` (Julian dates, civil time), and
+          `airmass` (at the start).
+
+        """
+
+        n = len(self.targets)
+        steps = u.Quantity(duration, u.day).value / self.step
+        steps = np.resize(np.ceil(steps - 1e-6).astype(int), n)
+        remaining = np.resize(np.asarray(nvisits, int), n)
+
+        plan = []
+        for night, date in enumerate(dates):
+            jd, mask, am = self.observability(date)
+            mask *= (remaining > 0)[:, np.newaxis]
+            i, k = greedy_timeline(mask, steps, priority=priority)
+            remaining[i] -= 1
+
+            p = np.zeros(len(i), dtype=_plan_dtype)
+            p['night'] = night
+            p['target'] = i
+            if len(jd) > 0:
+                p['start'] = jd[k]
+                p['end'] = jd[0] + (k + steps[i]) * self.step
+                p['airmass'] = am[i, k]
+            plan.append(p)
+
+        if len(plan) == 0:
+            return np.zeros(0, dtype=_plan_dtype)
+        return np.concatenate(plan)
+
+def windows(mask, jd=None):
+    """Contiguous observability windows.
+
+    Parameters
+    ----------
+    mask : array
+      `(N, M)` array, `True` where each of `N` targets is observable
+      at each of `M` times.
+    jd : array, optional
+      The `M` times.  If `None`, the window limits are indices.
+
+    Returns
+    -------
+    win : ndarray
+      A structured array with fields `target`, `start`, and `end`,
+      sorted by target.  `end` is the last observable time of each
+      window.
+
+    """
+
+    mask = np.atleast_2d(np.asarray(mask, bool))
+    n, m = mask.shape
+    edges = np.zeros((n, m + 2), np.int8)
+    edges[:, 1:-1] = mask
+    edges = np.diff(edges, axis=1)
+    i, k0 = np.nonzero(edges == 1)
+    k1 = np.nonzero(edges == -1)[1] - 1
+
+    if jd is None:
+        jd = np.arange(m)
+    jd = np.asarray(jd)
+
+    win = np.zeros(len(i), dtype=[('target', int), ('start', jd.dtype),
+                                  ('end', jd.dtype)])
+    win['target'] = i
+    win['start'] = jd[k0]
+    win['end'] = jd[k1]
+    return win
+
+def greedy_timeline(mask, duration, priority=None):
+    """Greedy timeline from an observability mask.
+
+    Starting at the first time step, the highest priority target that
+    is observable for its full duration is scheduled, then the
+    timeline advances to the end of the observation.  Ties go to the
+    target with the least observable time remaining in the night.
+    Each target is scheduled at most once.
+
+    Parameters
+    ----------
+    mask : array
+      `(N, M)` array, `True` where each of `N` targets is observable
+      at each of `M` time steps.
+    duration : int or array
+      Duration of the observations in time steps, may be given per
+      target.
+    priority : array, optional
+      Target priorities, larger first.  Default is equal priority.
+
+    Returns
+    -------
+    i, k : ndarray
+      Indices of the scheduled targets and their starting time steps,
+      in time order.
+
+    """
+
+    mask = np.atleast_2d(np.asarray(mask, bool))
+    n, m = mask.shape
+    duration = np.maximum(np.resize(np.asarray(duration, int), n), 1)
+    if priority is None:
+        priority = np.zeros(n)
+    priority = np.resize(np.asarray(priority, float), n)
+
+    # number of consecutive observable steps starting at each step,
+    # and the number of observable steps remaining
+    runs = np.zeros((n, m + 1), int)
+    for k in range(m - 1, -1, -1):
+        runs[:, k] = (runs[:, k + 1] + 1) * mask[:, k]
+    left = np.cumsum(mask[:, ::-1], 1)[:, ::-1]
+
+    done = np.zeros(n, bool)
+    scheduled = []
+    k = 0
+    while k < m:
+        j = np.flatnonzero((runs[:, k] >= duration) * ~done)
+        if len(j) == 0:
+            k += 1
+            continue
+
+        j = j[np.lexsort((left[j, k], -priority[j]))[0]]
+        scheduled.append((j, k))
+        done[j] = True
+        k += duration[j]
+
+    if len(scheduled) == 0:
+        return np.zeros(0, int), np.zeros(0, int)
+    i, k = np.array(scheduled).T
+    return i, k
+
+def _separation(ra0, dec0, ra1, dec1):
+    """Angular separation, broadcasting the arguments. [deg]"""
+    ra0, dec0, ra1, dec1 = [np.radians(x) for x in (ra0, dec0, ra1, dec1)]
+    c = (np.sin(dec0) * np.sin(dec1)
+         + np.cos(dec0) * np.cos(dec1) * np.cos(ra0 - ra1))
+    return np.degrees(np.arccos(np.clip(c, -1, 1)))
+
+_plan_dtype = [('night', int), ('target', int), ('start', float),
+               ('end', float), ('airmass', float)]
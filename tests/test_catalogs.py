@@ -0,0 +1,172 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+This package contains utilities to run the test suite.
+"""
+
+import numpy as np
+import pytest
+from mskpy import catalogs
+
+def _rotated_catalogs(N=200, theta=20.0, scale=1.05, seed=0):
+    rs = np.random.RandomState(seed)
+    cat0 = rs.rand(2, N) * 500
+    flux0 = rs.pareto(1.5, N)
+    th = np.radians(theta)
+    R = scale * np.array([[np.cos(th), -np.sin(th)],
+                          [np.sin(th), np.cos(th)]])
+    cat1 = R.dot(cat0) + np.array([[15.0], [-30.0]])
+    return cat0, flux0, cat1, R
+
+class TestCatalogs():
+    def test_triangles(self):
+        y = np.array([0, 0, 1, 0.0])
+        x = np.array([0, 1, 0, 100.0])
+        v, s = catalogs.triangles(y, x, max_ratio=10)
+        assert v.shape == (3, 1)
+        assert s.shape == (4, 1)
+        assert set(v[:, 0]) == set([0, 1, 2])
+
+    def test_triangle_match(self):
+        cat0, flux0, cat1, R = _rotated_catalogs(N=20)
+        matches, frac = catalogs.triangle_match(cat0, cat1[:, ::-1],
+                                                verbose=False)
+        assert len(matches) == 20
+        assert all([b == 19 - a for a, b in matches.items()])
+
+    def test_pattern_match(self):
+        cat0, flux0, cat1, R = _rotated_catalogs()
+        i = np.random.RandomState(1).permutation(200)[:150]
+        matches, frac = catalogs.pattern_match(
+            cat0, cat1[:, i], flux0, flux0[i], nbright=30, match_tol=0.5,
+            verbose=False)
+        assert len(matches) == 150
+        assert all([i[b] == a for a, b in matches.items()])
+        assert sum([f > 0 for f in frac.values()]) >= 10
+
+        # without fluxes, shuffled catalogs share few bright stars
+        matches, frac = catalogs.pattern_match(cat0, cat1[:, i],
+                                               nbright=30, verbose=False)
+        assert len(matches) == 0
+
+    def test_solve_transform(self):
+        cat0, flux0, cat1, R = _rotated_catalogs()
+        cat1 += np.random.RandomState(2).randn(*cat1.shape) * 0.05
+        matches = dict([(i, i) for i in range(20)]
+                       + [(i, 199 - i) for i in range(20, 30)])
+        T, inliers, stats = catalogs.solve_transform(cat1, cat0, matches,
+                                                     seed=0)
+        assert np.allclose(T[:2, :2], R, atol=1e-3)
+        assert np.allclose(T[:2, 2], (15, -30), atol=0.1)
+        assert len(inliers) == 200
+        assert stats['rms'] < 0.15
+        assert np.isclose(stats['scale'], 1.05, rtol=1e-3)
+        assert np.allclose(catalogs.apply_transform(cat0, T), cat1,
+                           atol=0.3)
+
+        T, inliers, stats = catalogs.solve_transform(cat1, cat0, matches,
+                                                     model='shift',
+                                                     rematch=False,
+                                                     tol=100)
+        assert np.allclose(T[:2, :2], np.eye(2))
+
+        # unrelated candidate matches, or no matches and no fluxes
+        rs = np.random.RandomState(3)
+        matches = dict(zip(range(30), rs.permutation(200)[:30]))
+        with pytest.raises(RuntimeError):
+            catalogs.solve_transform(cat1, cat0, matches, seed=0)
+        with pytest.raises(ValueError):
+            catalogs.solve_transform(cat1, cat0[:, rs.permutation(200)])
+
+        # pattern_match with the source catalog fluxes
+        i = rs.permutation(200)
+        c1 = catalogs.SourceCatalog.from_array(cat1, flux=flux0)
+        c0 = catalogs.SourceCatalog.from_array(cat0[:, i], flux=flux0[i])
+        T, inliers, stats = catalogs.solve_transform(c1, c0, seed=0)
+        assert np.allclose(T[:2, :2], R, atol=1e-3)
+        assert len(inliers) == 200
+
+    def test_catalog_store(self, tmpdir):
+        from astropy.coordinates import SkyCoord
+        import astropy.units as u
+        rs = np.random.RandomState(3)
+        ra = rs.rand(10000) * 20 - 10
+        dec = rs.rand(10000) * 20 - 10
+        mag = rs.rand(10000)
+        path = str(tmpdir.join('store'))
+        catalogs.CatalogStore.create(path, ra * u.deg, dec, mag=mag)
+        store = catalogs.CatalogStore(path)
+        assert len(store) == 10000
+        assert store.columns == ['ra', 'dec', 'mag']
+
+        c, data = store.cone(0.5, -0.2, 2.0)
+        sep = SkyCoord(ra, dec, unit='deg').separation(
+            SkyCoord(0.5, -0.2, unit='deg'))
+        assert len(c) == (sep.deg <= 2.0).sum()
+        assert np.allclose(np.sort(data['mag']),
+                           np.sort(mag[sep.deg <= 2.0]))
+
+        c, data = store.box([355, 2], [1, 3], columns=['mag'])
+        i = (ra <= 2) * (ra >= -5) * (dec >= 1) * (dec <= 3)
+        assert len(c) == i.sum()
+        assert sorted(data.keys()) == ['mag', 'row']
+
+    def test_source_catalog(self):
+        cat0, flux0, cat1, R = _rotated_catalogs()
+        cat = catalogs.SourceCatalog.from_array(cat0, flux=flux0)
+        assert len(cat) == 200
+        assert cat.columns == ['y', 'x', 'flux']
+        assert cat['y'].base is cat0
+        assert np.asarray(cat) is cat0
+        assert cat[u'flux'] is cat['flux']
+
+        b = cat.brightest(5)
+        assert np.all(b['flux'] == np.sort(flux0)[::-1][:5])
+        b, i = catalogs.brightest(cat, u'flux', 5, full_output=True)
+        assert np.all(b['x'] == cat0[1, i])
+        f = catalogs.faintest(cat0, flux0, 5)
+        assert np.all(f == cat0[:, np.argsort(flux0)[:5]])
+
+        tree = cat.tree
+        matches, dyx = catalogs.nearest_match(cat, cat0[:, ::-1] + 0.1)
+        assert cat.tree is tree
+        assert len(matches) == 200
+        assert np.allclose(dyx, -0.1)
+
+        cat['y'] = cat['y'] + 1
+        assert cat.tree is not tree
+        assert np.allclose(cat.yx[0], cat0[0] + 1)
+
+    def test_sky_match(self):
+        from astropy.coordinates import SkyCoord
+        import astropy.units as u
+        rs = np.random.RandomState(4)
+        ra = rs.rand(1000) * 360
+        dec = np.degrees(np.arcsin(rs.rand(1000) * 2 - 1))
+        c0 = SkyCoord(ra, dec, unit='deg')
+        c1 = SkyCoord(ra[::-1] + 1e-4, dec[::-1], unit='deg')
+
+        i0, i1, sep = catalogs.sky_match(c0, c1, 1 * u.arcsec)
+        assert len(i0) == 1000
+        assert np.all(i0 == 999 - i1)
+        assert np.allclose(sep.deg, c0[i0].separation(c1[i1]).deg)
+
+        i0, i1, sep = catalogs.sky_match((ra, dec), c1, 1 * u.arcsec,
+                                         mode='mutual', chunk=300)
+        assert len(i0) == 1000
+
+        i0, i1, sep = catalogs.sky_match(c0, c0, 5.0, mode='all',
+                                         chunk=300)
+        xyz = c0.cartesian.xyz.value
+        n = (xyz.T.dot(xyz) >= np.cos(np.radians(5.0))).sum()
+        assert len(i0) == n
+        assert np.all(np.diff(i1) >= 0)
+
+        # no matches, or no sources
+        for mode in ['one-to-one', 'all', 'mutual']:
+            i0, i1, sep = catalogs.sky_match(
+                ([10., 20.], [0., 0.]), ([100., 120.], [5., 5.]), 1.0,
+                mode=mode)
+            assert len(i0) == len(i1) == len(sep) == 0
+            i0, i1, sep = catalogs.sky_match(([], []), (ra, dec), 1.0,
+                                             mode=mode)
+            assert len(i0) == len(i1) == len(sep) == 0
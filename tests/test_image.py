@@ -3,6 +3,7 @@
 This package contains utilities to run the test suite.
 """
 
+import os
 import numpy as np
 from numpy import pi
 from mskpy import image
@@ -13,6 +14,21 @@ class TestImageCore():
         b = image.imshift(a, [0.5, 0], subsample=2)
         assert b[0] == 2.0
 
+    def test_imshift_methods(self):
+        y, x = np.indices((32, 32))
+        g = lambda y0, x0: np.exp(-((y - y0)**2 + (x - x0)**2) / 8.0)
+        a = g(15, 15)
+        b = image.imshift(a, (2, -3), subsample=1)
+        assert np.allclose(b, g(17, 12))
+        b = image.imshift(a, (1.3, -2.7), method='fft')
+        assert np.allclose(b, g(16.3, 12.3))
+        b = image.imshift(a, (1.3, -2.7), method='spline')
+        assert np.allclose(b, g(16.3, 12.3), atol=1e-3)
+
+        s = image.imshift_stack([a, a], [[0, 0], [1.3, -2.7]])
+        assert np.allclose(s[0], a)
+        assert np.allclose(s[1], g(16.3, 12.3))
+
     def test_rarray(self):
         r = image.rarray((10, 10), subsample=10)
         assert all(r[4:6, 4] == r[4:6, 5])
@@ -31,6 +47,29 @@ class TestImageCore():
         assert b.shape == (1, 1)
         assert b[0, 0] == 16.
 
+    def test_rebin_nd(self):
+        a = np.arange(64.).reshape((4, 4, 4))
+        b = image.rebin(a, -2)
+        assert b.shape == (2, 2, 2)
+        assert b[0, 0, 0] == a[:2, :2, :2].mean()
+        c = image.rebin(b, 2, flux=True)
+        assert c.shape == (4, 4, 4)
+        assert c[1, 1, 1] == b[0, 0, 0] / 8.
+
+        out = np.zeros((2, 2, 2))
+        b = image.rebin(a, -2, flux=True, out=out)
+        assert b is out
+        assert out[1, 1, 1] == a[2:, 2:, 2:].sum()
+
+        # non-contiguous output, magnifying and minifying
+        out = np.zeros((4, 4, 4)).transpose(2, 0, 1)
+        c = image.rebin(b, 2, out=out)
+        assert c is out
+        assert np.all(out == image.rebin(b, 2))
+        out = np.zeros((4, 4))[::2, ::2]
+        image.rebin(a[0], -2, out=out)
+        assert np.all(out == image.rebin(a[0], -2))
+
     def test_stack2grid(self):
         a = np.arange(16).reshape((4, 2, 2))
         b = image.stack2grid(a)
@@ -46,6 +85,21 @@ class TestImageCore():
         assert t[100, 0] == pi / 2
         assert t[100, 100] == pi  / 4
 
+    def test_yx2rt(self):
+        im = image.rarray((51, 51), subsample=10)
+        rt, r, th, n = image.yx2rt(im, (25, 25), bins=(10, 8))
+        assert rt.shape == (10, 8)
+        assert np.allclose(rt, r)
+        assert np.allclose(rt[3], rt[3].mean(), rtol=0.01)
+
+        cube = np.array([im, 2 * im])
+        rt2 = image.yx2rt(cube, (25, 25), bins=(10, 8))[0]
+        assert rt2.shape == (2, 10, 8)
+        assert np.allclose(rt2[1], 2 * rt)
+
+        rt, r = image.yx2rt(im[:50, :50], (25, 25), scale=-2, bins=5)[:2]
+        assert np.allclose(rt, r, rtol=0.05)
+
     def unwrap(self):
         im = image.rarray((101, 101))
         rt, r, th, n = image.unwrap(im, [50, 50], bins=10)
@@ -73,3 +127,275 @@ class TestImageCore():
         assert np.allclose(y[4, 0], 2 * np.sqrt(2))
         assert np.allclose(y[0, 0], 0)
 
+class TestImageAnalysis():
+    def test_fwhm_batch(self):
+        y, x = np.indices((60, 60))
+        yx = [(15.3, 20), (40, 44.6), (-20, -20)]
+        im = 5 + sum([100 * np.exp(-((y - y0)**2 + (x - x0)**2) / 2 / 1.5**2)
+                      for y0, x0 in yx[:2]])
+        fw, amp, bg, good, summary = image.fwhm_batch(im, yx, box=15)
+        assert np.all(good == [True, True, False])
+        assert np.allclose(fw[:2], 1.5 * 2.3548, rtol=0.01)
+        assert np.allclose(amp[:2], 100, rtol=0.01)
+        assert np.allclose(bg[:2], 5, atol=0.1)
+        assert np.allclose(summary[0], 1.5 * 2.3548, rtol=0.01)
+        assert summary[2] == 2
+
+    def test_gcentroid_batch(self):
+        y, x = np.indices((50, 50))
+        im = (np.exp(-((y - 12)**2 + (x - 12)**2) / 8.0)
+              + np.exp(-((y - 37)**2 + (x - 37)**2) / 8.0))
+        im[:, 25:] *= y[:, 25:] > 25
+        yx = [[11, 13], [37, 36], [12, 38]]
+        cyx, good = image.gcentroid_batch(im, yx, box=9, niter=2)
+        assert np.allclose(cyx[:2], [[12, 12], [37, 37]], atol=0.01)
+        assert np.all(good == [True, True, False])
+
+    def test_apphot_series(self, tmpdir):
+        from astropy.io import fits
+        from astropy.wcs import WCS
+        from astropy.coordinates import SkyCoord
+
+        y, x = np.indices((50, 50))
+        files = []
+        for i in range(3):
+            w = WCS(naxis=2)
+            w.wcs.crpix = (25 + i, 25)
+            w.wcs.cdelt = (-1 / 3600., 1 / 3600.)
+            w.wcs.crval = (10, 20)
+            w.wcs.ctype = ('RA---TAN', 'DEC--TAN')
+            h = w.to_header()
+            h['DATE-OBS'] = '2020-01-0{}'.format(i + 1)
+            im = 1 + 100 * np.exp(-((y - 24)**2 + (x - 24 - i)**2) / 4.0)
+            files.append(str(tmpdir.join('{}.fits'.format(i))))
+            fits.writeto(files[-1], im, h)
+
+        coords = SkyCoord([10, 10.01], [20, 20], unit='deg')
+        out = str(tmpdir.join('phot.fits'))
+        assert image.apphot_series(files[:2], coords, [3, 6], out,
+                                   bgap=(8, 12)) == 2
+        assert image.apphot_series(files, coords, [3, 6], out,
+                                   bgap=(8, 12)) == 1
+
+        tab = image.read_apphot_series(out)
+        assert len(tab) == 3
+        assert np.all(tab['frame'] == [0, 1, 2])
+        assert np.all(tab['source'] == 0)
+        assert np.allclose(tab['x'], [24, 25, 26], atol=0.01)
+        assert np.allclose(tab['bg'], 1)
+        f = tab['flux'] - tab['bg'][:, np.newaxis] * tab['n']
+        assert np.allclose(f[:, 1], 400 * np.pi, rtol=0.01)
+        assert tab['time'][2] == '2020-01-03'
+
+        # an interrupted write is detected and the image measured again
+        size = os.path.getsize(out)
+        with open(out, 'r+b') as outf:
+            outf.truncate(size - 2880)
+        assert image.apphot_series(files, coords, [3, 6], out,
+                                   bgap=(8, 12)) == 1
+        assert len(image.read_apphot_series(out)) == 3
+
+    def test_bgfit(self):
+        y, x = np.indices((40, 50))
+        plane = 5 + 0.1 * y - 0.2 * x
+        im = plane + 0.01 * x * y
+        im[3, 3] = np.nan
+        bg = image.bgfit(plane, order=1)
+        assert np.allclose(bg, plane)
+        bg = image.bgfit(im, order=2, cross=True, step=3)
+        assert np.allclose(bg, plane + 0.01 * x * y)
+        bg = image.bgfit([im, 2 * im], order=2, cross=True)
+        assert np.allclose(bg[1], 2 * (plane + 0.01 * x * y))
+
+        cx, cy, cov = image.polyfit2d(plane, y, x, order=1)
+        assert np.allclose((cy[0], cx[0], cy[1] + cx[1]), (0.1, -0.2, 5))
+        assert cov.shape == (4, 4)
+
+    def test_bgphot(self):
+        from mskpy.util import meanclip
+        np.random.seed(0)
+        im = np.random.randn(3, 60, 60) + 10
+        im[:, 20, 25] = 100
+        im[1, 30, 30] = np.nan
+        yx = [(20, 20), (30, 35), (-10, -10)]
+        n, bg, sig = image.bgphot(im, yx, (3, 8))
+        assert bg.shape == (3, 3)
+        for i in range(3):
+            for j in range(2):
+                r = image.rarray((60, 60), yx=yx[j], subsample=10)
+                f = im[i][(r >= 3) * (r <= 8)]
+                m, s = meanclip(f, full_output=True)[:2]
+                assert np.allclose((bg[i, j], sig[i, j]), (m, s))
+        assert np.all(np.isnan(bg[:, 2]))
+
+    def test_detect(self):
+        y, x = np.indices((60, 60))
+        im = (np.exp(-((y - 15.3)**2 + (x - 20)**2) / 8.0)
+              + np.exp(-((y - 40)**2 + (x - 44.6)**2) / 8.0)) * 100
+        im[40, 40] = np.nan
+        cat = image.detect(im, sigma=1, thresh=5, fwhm=1)
+        assert len(cat) == 2
+        assert cat['flags'][0] == 0
+        assert np.allclose((cat['y'][0], cat['x'][0]), (15.3, 20), atol=0.01)
+        assert cat['flags'][1] & 1
+
+    def test_find_catalog(self):
+        y, x = np.indices((60, 60))
+        im = (np.exp(-((y - 15.3)**2 + (x - 20)**2) / 8.0)
+              + np.exp(-((y - 40)**2 + (x - 44.6)**2) / 8.0)) * 100
+        cat = image.find(im, sigma=1, thresh=5, fwhm=1, catalog=True)
+        assert len(cat) == 2
+        assert 'flags' in cat.columns
+        assert np.allclose(cat.yx[:, 0], (15.3, 20), atol=0.01)
+
+        # gcentroid keywords from before detect was the default
+        yx, f = image.find(im, sigma=1, thresh=5, fwhm=1, box=(7, 7),
+                           shrink=False, silent=False)
+        assert np.allclose(yx[0], (15.3, 20), atol=0.01)
+
+    def test_linecut(self):
+        im = np.ones((50, 50))
+        x, n, f = image.linecut(im, (25, 25), 2, 20, 30)
+        assert len(x) == 10
+        assert np.allclose(n, 4, rtol=0.02)
+        assert np.allclose(f, n)
+        x, n, f = image.linecut(im, (25, 25), 2, 20, [0, 45, 90])
+        assert n.shape == (3, 10)
+        assert np.allclose(n, 4, rtol=0.1)
+        f = image.linecut([im, 2 * im], (25, 25), 2, 20, [0, 90])[2]
+        assert f.shape == (2, 2, 10)
+        assert np.allclose(f[:, 1], 8)
+
+    def test_radprof(self):
+        im = 10 - image.rarray((41, 41), subsample=10)
+        rc, sb, n, rmean = image.radprof(im, (20, 20), bins=10,
+                                         range=(0, 10))
+        assert np.allclose(rc, np.arange(10) + 0.5)
+        assert np.allclose(sb, 10 - rmean, rtol=1e-3)
+        assert np.allclose(n.sum(), np.pi * 10**2, rtol=0.01)
+
+        f = image.radprof(2 * im, (20, 20), bins=10, range=(0, 10))[1]
+        assert np.allclose(f, 2 * sb)
+
+        aa = image.azavg(im, (20, 20), raps=np.arange(1, 20.))
+        assert np.allclose(aa[20, 25], sb[5], rtol=0.05)
+
+class TestImageProcess():
+    def test_align_by_centroid(self, tmpdir):
+        from astropy.io import fits
+        y, x = np.indices((40, 40))
+        yx = [(20, 20), (22, 17), (18.5, 21.5)]
+        data = np.array([np.exp(-((y - y0)**2 + (x - x0)**2) / 8.0)
+                         for y0, x0 in yx])
+        cfunc = lambda im, yx, **kwargs: image.gcentroid_batch(
+            im, yx, **kwargs)[0]
+        stack, dyx = image.align_by_centroid(data, (20, 20), cfunc=cfunc,
+                                             ckwargs=dict(box=9, niter=2),
+                                             method='fft')
+        assert np.allclose(dyx, [(0, 0), (-2, 3), (1.5, -1.5)], atol=0.01)
+        assert np.all(np.isnan(stack[1, -2:])) # shifted down
+        assert np.all(np.isnan(stack[1, :, :3])) # shifted right
+        assert np.allclose(stack[1, 10:30, 10:30], data[0, 10:30, 10:30],
+                           atol=0.01)
+
+        # unicode paths, as on Python 2 with unicode_literals
+        files = []
+        for i in range(3):
+            files.append(u'{}'.format(tmpdir.join('{}.fits'.format(i))))
+            fits.writeto(files[-1], data[i])
+
+        out = u'{}'.format(tmpdir.join('aligned.npy'))
+        stack2, dyx2 = image.align_by_centroid(files, (20, 20),
+                                               cfunc=cfunc,
+                                               ckwargs=dict(box=9, niter=2),
+                                               method='fft', out=out)
+        assert isinstance(stack2, np.memmap)
+        assert np.allclose(dyx, dyx2)
+        assert np.allclose(np.load(out), stack, equal_nan=True)
+
+    def test_align_by_wcs(self, tmpdir):
+        from astropy.io import fits
+        from astropy.wcs import WCS
+        files = []
+        for i, crpix in enumerate([(20, 20), (23, 18)]):
+            w = WCS(naxis=2)
+            w.wcs.crpix = crpix
+            w.wcs.cdelt = (-1 / 3600., 1 / 3600.)
+            w.wcs.crval = (10, 20)
+            w.wcs.ctype = ('RA---TAN', 'DEC--TAN')
+            files.append(str(tmpdir.join('{}.fits'.format(i))))
+            fits.writeto(files[-1], np.ones((40, 40)), w.to_header())
+
+        frames = list(image.ialign_by_wcs(files, subsample=1))
+        assert len(frames) == 2
+        assert np.allclose(frames[1][1], (2, -3))
+
+    def test_fixpix(self):
+        y, x = np.indices((30, 30))
+        im = 1 + 0.1 * x + 0.2 * y + 0.01 * (x - 15)**2
+        mask = np.zeros(im.shape, bool)
+        mask[5, 5] = mask[10, 20:22] = mask[0, 0] = True
+        mask[20:25, 20:25] = True  # too large
+        bad = im.copy()
+        bad[mask] = 1e6
+
+        cleaned = image.fixpix(bad, mask, max_area=10)
+        assert np.isclose(cleaned[5, 5], np.mean(im[[4, 5, 5, 6],
+                                                    [5, 4, 6, 5]]))
+        assert np.all(cleaned[20:25, 20:25] == 1e6)
+
+        cleaned = image.fixpix(bad, mask, method='biharmonic')
+        fixed = mask.copy()
+        fixed[20:25, 20:25] = False
+        assert np.allclose(cleaned[fixed], im[fixed], atol=0.01)
+
+        cube = image.fixpix(np.array([bad, 2 * bad]), mask, method='idw')
+        assert np.allclose(cube[0], image.fixpix(bad, mask, method='idw'))
+        assert np.allclose(cube[1][fixed], 2 * cube[0][fixed])
+
+    def test_psfmatch_tiled(self):
+        from scipy.signal import fftconvolve
+        y, x = np.indices((31, 31))
+        psf = np.exp(-((y - 15)**2 + (x - 15)**2) / 2.0 / 1.5**2)
+        psfr = np.exp(-((y - 16)**2 + (x - 14)**2) / 2.0 / 2.5**2)
+        K = image.psfmatch(psf, psfr, reg=1e-10)
+        m = fftconvolve(psf / psf.sum(), K, mode='same')
+        assert np.allclose(m, psfr / psfr.sum(), atol=1e-5)
+
+        im = np.random.RandomState(1).rand(80, 100)
+        matched, kgrid = image.psfmatch_tiled(im, np.tile(psf, (2, 3, 1, 1)),
+                                              psfr, reg=1e-10)
+        assert kgrid.shape == (2, 3, 31, 31)
+        assert np.allclose(matched, fftconvolve(im, K, mode='same'))
+
+        y, x = np.indices((80, 100))
+        yx = [(30.2, 25.6), (45.7, 70.1)]
+        im = sum([np.exp(-((y - y0)**2 + (x - x0)**2) / 2.0 / s**2)
+                  for (y0, x0), s in zip(yx, [1.5, 2.5])])
+        psfs = image.psf_grid(im, yx, (1, 2), box=31)
+        assert psfs.shape == (1, 2, 31, 31)
+        assert np.allclose(psfs[0, 0], psf / psf.sum(), atol=1e-4)
+        assert np.allclose(psfs[0, 1].sum(), 1)
+
+class TestImage():
+    def test_cache(self):
+        a = np.arange(400.0).reshape((20, 20))
+        im = image.Image(a, yx=(9.2, 10.6))
+        n, f = im.anphot([2, 4])
+        assert np.allclose(f, image.anphot(a, (9.2, 10.6), [2, 4])[1])
+
+        # per-source radius maps and annulus indices are not kept
+        im.anphot([2, 4], yx=[[5, 5], [9, 9], [12, 14]])
+        im.bgphot([2, 4], yx=[12, 14])
+        assert len(im._cache) == 0
+
+        bg = im.bgfit(order=1)
+        assert len(im._cache) > 0
+        bg[0, 0] = -1  # a writeable copy
+        assert im.bgfit(order=1)[0, 0] != -1
+        im[0, 0] = 1
+        assert len(im._cache) == 0
+        im.bgfit(order=1)
+        im *= 2
+        assert len(im._cache) == 0
+        assert np.allclose(im.anphot([2, 4])[1], 2 * f)
@@ -0,0 +1,276 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+This package contains utilities to run the test suite.
+"""
+
+import numpy as np
+import pytest
+import astropy.units as u
+from astropy.coordinates import Angle
+from mskpy import observing
+from mskpy.observing import core, scheduler
+from mskpy.util import date2time
+
+# Mt. Bigelow, AZ
+lon, lat, tz = -110.79, 32.44, -7.0
+
+def _moving_target(monkeypatch):
+    """A stub moving target, with `Earth.observe` counting calls.
+
+    The target moves 13 deg/day in RA, wrapping through 0 deg near JD
+    2458923.6 (UT).
+
+    """
+
+    ephem = pytest.importorskip('mskpy.ephem')
+
+    class Stub(ephem.SolarSysObject):
+        def __init__(self):
+            self.name = 'stub'
+
+    calls = []
+    def observe(target, date, ltt=False):
+        calls.append(date)
+        return dict(zip(('ra', 'dec'), _stub_radec(date.jd)))
+
+    monkeypatch.setattr(ephem.Earth, 'observe', observe)
+    return Stub(), calls
+
+def _stub_radec(jd):
+    """Coordinates of the stub moving target at UT Julian dates."""
+    t = np.asarray(jd) - 2458923.5
+    ra = (358.7 + 13.0 * t) % 360
+    dec = 10 + 5 * np.sin(t)
+    return Angle(ra, u.deg), Angle(dec, u.deg)
+
+class TestObserving():
+    def test_altaz_grid(self):
+        rs = np.random.RandomState(0)
+        ra = rs.rand(5) * 360
+        dec = rs.rand(5) * 150 - 75
+        jd = 2458923.5 + np.linspace(-0.5, 0.5, 7)
+        alt, az, am = core.altaz_grid(ra, dec, jd, lon, lat, tz)
+        assert alt.shape == (5, 7)
+        for i in range(5):
+            lst = core.ct2lst(jd, lon, tz) * 15.0
+            a, z = core.hadec2altaz(lst - ra[i], dec[i], lat)
+            assert np.allclose(alt[i], a)
+            assert np.allclose(az[i], z)
+            assert np.allclose(am[i], core.airmass(ra[i], dec[i], jd,
+                                                   lon, lat, tz),
+                               equal_nan=True)
+
+    def test_jd2lst(self):
+        # Meeus, Astronomical Algorithms, examples 12.a and 12.b:
+        # 1987 Apr 10 0h and 19h21m UT
+        ut = np.array([2446895.5, 2446896.30625])
+        gmst = np.array([13 + (10 + 46.3668 / 60.0) / 60.0,
+                         8 + (34 + 57.0896 / 60.0) / 60.0])
+        lst = core.jd2lst(ut, 0.0)
+        assert np.allclose(lst, gmst, rtol=0, atol=1e-3 / 3600)
+
+        # civil time and east longitude
+        lst = core.jd2lst(ut + tz / 24.0, lon, tz)
+        assert np.allclose(lst, (gmst + lon / 15.0) % 24, rtol=0,
+                           atol=1e-3 / 3600)
+        assert np.isclose(core.jd2lst(ut[0], 0.0), gmst[0], rtol=0,
+                          atol=1e-3 / 3600)
+
+        jd = 2458937.5 + np.linspace(-3, 3, 13)
+
+        # UTC+0 to UTC+1 on 2020 Mar 29
+        lst = core.jd2lst(jd, 0.0, 'Europe/London')
+        assert np.allclose(lst[:6], core.jd2lst(jd[:6], 0.0, 0.0))
+        assert np.allclose(lst[7:], core.jd2lst(jd[7:], 0.0, 1.0))
+
+    def test_rts(self):
+        date = '2020-03-15 12:00'
+        ra = np.array([30.0, 30.0, 30.0])
+        dec = np.array([20.0, 85.0, -80.0])
+        r, t, s = core.rts(ra, dec, date, lon, lat, tz, limit=20)
+
+        # transit and set altitudes
+        jd0 = np.round(date2time(date).jd - 0.5) + 0.5
+        jd = jd0 + (np.array([t[0], s[0]]) - 24) / 24.0
+        lst = core.ct2lst(jd, lon, tz) * 15.0
+        alt = core.hadec2altaz(lst - ra[0], dec[0], lat)[0]
+        assert np.allclose(alt, [90 - abs(dec[0] - lat), 20], atol=0.05)
+
+        # circumpolar and never risen
+        assert np.isnan([r[1], s[1], r[2], t[2], s[2]]).all()
+        assert np.isfinite(t[1])
+
+        # scalar interface
+        r0, t0, s0 = core.rts(30.0, 20.0, date, lon, lat, tz, limit=20)
+        assert np.allclose([r0, t0, s0], [r[0], t[0], s[0]])
+        assert core.rts(30.0, -80.0, date, lon, lat, tz) == (None, None,
+                                                              None)
+
+    def test_observer_altaz_grid(self):
+        observer = observing.Observer(lon * u.deg, lat * u.deg, tz,
+                                      '2020-03-15')
+        targets = [observing.Target(Angle(30, u.deg), Angle(20, u.deg)),
+                   observing.Target(Angle(150, u.deg), Angle(-10, u.deg))]
+        dt = np.linspace(-6, 6, 13) * u.hr
+        alt, az, am = observer.altaz_grid(targets, dt)
+        assert alt.shape == (2, 13)
+        am1 = observer.altaz_grid(targets[1], dt)[2]
+        assert np.allclose(am[1], am1[0], equal_nan=True)
+
+    def test_ephemeris_memo(self, monkeypatch):
+        target, calls = _moving_target(monkeypatch)
+        observer = observing.Observer(lon * u.deg, lat * u.deg, tz,
+                                      '2020-03-15', ephem_step=1 * u.hr)
+
+        # one night, crossing RA = 0: one evaluation, interpolated
+        jd = 2458923.5 + np.linspace(-0.45, 0.45, 301)
+        ra, dec = observer._radec(target, jd)
+        assert len(calls) == 1
+        assert len(calls[0]) == 25
+        ra0, dec0 = _stub_radec(jd - tz / 24.0)
+        assert ra.degree.min() < 1 and ra.degree.max() > 359
+        assert np.allclose((ra - ra0).wrap_at(180 * u.deg).degree, 0,
+                           atol=1e-6)
+        assert np.allclose(dec.degree, dec0.degree, atol=2e-3)
+
+        # reused for other dates that night, scalar or array
+        ra, dec = observer._radec(target, jd[10])
+        assert np.isscalar(ra.degree)
+        observer.airmass(target)
+        assert len(calls) == 1
+
+        # a second night is a second evaluation
+        observer._radec(target, jd + 0.5)
+        assert len(calls) == 2
+
+        observer.clear_cache()
+        observer._radec(target, jd)
+        assert len(calls) == 3
+
+        # no memo
+        observer.ephem_step = None
+        ra, dec = observer._radec(target, jd[:5])
+        assert len(calls) == 4
+        assert len(calls[-1]) == 5
+        assert np.allclose(ra.degree, ra0.degree[:5])
+
+    def test_rts_moving(self):
+        date = '2020-03-15 12:00'
+        jd0 = np.round(date2time(date).jd - 0.5) + 0.5
+
+        # a fast mover and a target that never rises
+        def radec(jd):
+            ra = 30.0 + np.array([[5.0], [0.0]]) * (jd - jd0)
+            dec = np.array([[20.0], [-80.0]]) + (jd - jd0) * np.array(
+                [[2.0], [0.0]])
+            return ra, dec
+
+        r, t, s = core.rts_moving(radec, date, lon, lat, tz, limit=20,
+                                  tol=0.01)
+        assert np.isnan([r[1], t[1], s[1]]).all()
+
+        for x, f in ((r[0], 20), (t[0], None), (s[0], 20)):
+            jd = jd0 + ((x + 12) % 24 - 12) / 24.0
+            ra, dec = radec(np.array([[jd]]))
+            ha = core.ct2lst(jd, lon, tz) * 15.0 - ra[0, 0]
+            ha = (ha + 180) % 360 - 180
+            if f is None:
+                assert abs(ha) < 1e-3
+            else:
+                alt = core.hadec2altaz(ha, dec[0, 0], lat)[0]
+                assert abs(alt - f) < 1e-3
+
+    def test_rts_fixed_vs_moving(self):
+        # fixed positions, including rises before noon and sets after
+        # the next noon
+        date = '2020-03-15 12:00'
+        rs = np.random.RandomState(1)
+        ra = rs.uniform(0, 360, 200)
+        dec = rs.uniform(-60, 90, 200)
+        rts0 = core.rts(ra, dec, date, lon, lat, tz, limit=20)
+
+        def radec(jd):
+            return (ra[:, np.newaxis] * np.ones(jd.shape),
+                    dec[:, np.newaxis] * np.ones(jd.shape))
+
+        rts1 = core.rts_moving(radec, date, lon, lat, tz, limit=20,
+                               steps=96)
+        for a, b in zip(rts0, rts1):
+            assert np.all(np.isnan(a) == np.isnan(b))
+            i = np.isfinite(a)
+            assert np.allclose((a[i] - b[i] + 12) % 24 - 12, 0,
+                               atol=0.1 / 3600)
+
+class TestScheduler():
+    def test_windows(self):
+        mask = np.array([[0, 1, 1, 0, 1],
+                         [0, 0, 0, 0, 0],
+                         [1, 1, 1, 1, 1]], bool)
+        win = scheduler.windows(mask, np.arange(5) * 10.0)
+        assert np.all(win['target'] == [0, 0, 2])
+        assert np.all(win['start'] == [10, 40, 0])
+        assert np.all(win['end'] == [20, 40, 40])
+
+    def test_greedy_timeline(self):
+        mask = np.array([[1, 1, 1, 1, 0, 0],
+                         [0, 0, 1, 1, 1, 1],
+                         [1, 1, 1, 1, 1, 1],
+                         [1, 0, 0, 0, 0, 0]], bool)
+        # target 0 sets first; target 3 is never observable for 2 steps
+        i, k = scheduler.greedy_timeline(mask, 2)
+        assert np.all(i == [0, 1, 2])
+        assert np.all(k == [0, 2, 4])
+
+        i, k = scheduler.greedy_timeline(mask, 2, priority=[0, 0, 1, 0])
+        assert np.all(i == [2, 0, 1])
+        assert np.all(k == [0, 2, 4])
+
+    def test_scheduler(self):
+        observer = observing.Observer(lon * u.deg, lat * u.deg, tz,
+                                      '2020-03-15')
+        rs = np.random.RandomState(1)
+        targets = [observing.Target(Angle(rs.rand() * 360, u.deg),
+                                    Angle(rs.rand() * 110 - 40, u.deg))
+                   for i in range(50)]
+        sun = observing.Target(Angle(355, u.deg), Angle(-2, u.deg))
+        moon = observing.Target(Angle(250, u.deg), Angle(-20, u.deg))
+        s = scheduler.Scheduler(observer, targets, sun=sun, moon=moon)
+
+        # evening and morning twilight
+        start, end = s.night('2020-03-15')
+        for jd in (start, end):
+            alt = core.altaz_grid(355, -2, jd, lon, lat, tz)[0]
+            assert np.allclose(alt, -12, atol=1e-3)
+
+        plan = s.plan(['2020-03-14', '2020-03-15'], duration=1 * u.hr,
+                      nvisits=1)
+        assert len(np.unique(plan['target'])) == len(plan)
+        assert np.all(plan['airmass'] <= 2)
+        for p in plan:
+            assert p['start'] >= start - 1 - 1e-6
+            assert p['end'] <= end + 1e-6
+        night0 = plan[plan['night'] == 0]
+        assert np.all(night0['start'][1:] >= night0['end'][:-1] - 1e-6)
+
+        win = s.windows(['2020-03-15'])
+        assert set(plan['target'][plan['night'] == 1]) <= set(
+            win['target'])
+
+        assert len(s.windows([])) == 0
+        assert len(s.plan([])) == 0
+        assert s.plan([]).dtype == plan.dtype
+
+    def test_scheduler_time_scale(self, monkeypatch):
+        target, calls = _moving_target(monkeypatch)
+        observer = observing.Observer(lon * u.deg, lat * u.deg, tz,
+                                      '2020-03-15')
+        s = scheduler.Scheduler(observer, [target], sun=target,
+                                moon=target)
+
+        # civil dates everywhere; the ephemeris is evaluated at UT
+        jd = 2458923.5 + np.linspace(-0.3, 0.3, 7)
+        ra, dec = s._ephemeris(target, jd)
+        ra0, dec0 = observer._radec(target, jd)
+        assert np.allclose(ra, ra0.degree)
+        ra1 = _stub_radec(jd - tz / 24.0)[0].degree
+        assert np.allclose((ra - ra1 + 180) % 360 - 180, 0, atol=1e-3)